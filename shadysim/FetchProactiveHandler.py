@@ -1,5 +1,6 @@
 from pySim.transport import ProactiveHandler
 from pySim.cat import SendShortMessage, DeviceIdentities, Result, CommandDetails
+from pySim.sms import ConcatSmsReassembler
 from osmocom.utils import b2h
 
 
@@ -26,6 +27,9 @@ class FetchProactiveHandler(ProactiveHandler):
         self.stillMoreData = False
         self.parsedResponse = ''
         self.parsedCmdSw = ''
+        # number of commands executed, as reported in the PoR
+        self.parsedCmdCount = None
+        self.reassembler = ConcatSmsReassembler()
 
     def receive_fetch(self, pcmd):
         """Fallback si no hay un handler específico."""
@@ -47,7 +51,9 @@ class FetchProactiveHandler(ProactiveHandler):
 
                 self.parsedResponse = self.parsedResponse + resdata
                 self.parsedCmdSw = self.parsedCmdSw if self.stillMoreData is False else "6310"
-        return self.prepare_response(pcmd, general_result='command_beyond_terminal_capability')
+        # The PoR has been consumed here, so report the SMS as sent; this makes the card
+        # continue with the next part of a multi-part response.
+        return self.prepare_response(pcmd, general_result='performed_successfully')
 
 
 
@@ -110,7 +116,8 @@ class FetchProactiveHandler(ProactiveHandler):
 
     def _extract_status_word(self, data: str, offset: int, header: str) -> tuple:
         """Extract Status Word and adjust data if padding exists."""
-        offset += 2  # Skip Command Counter
+        self.parsedCmdCount = int(data[offset:offset + 2], 16)
+        offset += 2  # Command Counter
         status_word = data[offset:offset + 4]
         offset += 4
 
@@ -166,8 +173,18 @@ class FetchProactiveHandler(ProactiveHandler):
         tp_udl = int(envelope_data[idx:idx + 2], 16)  # TP-User Data Length
         idx += 2
 
+        # A PoR exceeding a single SMS arrives as concatenated SMS; only parse
+        # it once all segments have been received.
+        user_data = envelope_data[idx:]
+        if tp_mti & 0x40:  # TP-UDHI
+            reassembled = self.reassembler.feed(user_data)
+            if reassembled is None:
+                return ('', '9000')
+            udh, payload = reassembled
+            user_data = b2h(udh.to_bytes() + payload)
+
         # Procesar resto de datos
-        return self.parse_response_data(envelope_data[idx:], more_data)
+        return self.parse_response_data(user_data, more_data)
 
     def handle_DisplayText(self, decoded):
         print("[UI] Display Text")
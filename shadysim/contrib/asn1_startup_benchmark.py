@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+"""Benchmark of the eSIM ASN.1 specification startup cost: time to import pySim.esim.{rsp,saip} and
+to perform the first encode, with a cold (empty) and a warm compiled-specification cache.  Each
+measurement is run in a fresh interpreter."""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import subprocess
+
+TOPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SNIPPETS = {
+    'rsp': "rsp.asn1.encode('ConfigureISDPRequest', {})",
+    'saip': "saip.asn1.encode('ProfileElement', ('end', {'end-header': {'mandated': None, 'identification': 1}}))",
+}
+
+def run(snippet: str, cache_dir: str) -> float:
+    """Run snippet in a fresh interpreter, return the elapsed wall-clock time."""
+    pythonpath = os.pathsep.join(filter(None, [TOPDIR, os.environ.get('PYTHONPATH')]))
+    env = dict(os.environ, PYSIM_ASN1_CACHE_DIR=cache_dir, PYTHONPATH=pythonpath)
+    t_start = time.monotonic()
+    subprocess.run([sys.executable, '-c', snippet], env=env, cwd=TOPDIR, check=True)
+    return time.monotonic() - t_start
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--count', type=int, default=5, help='Number of runs to average the warm cache case over')
+
+if __name__ == '__main__':
+    opts = parser.parse_args()
+    baseline = run('import pySim.esim', tempfile.mkdtemp())
+    print("%-30s %8.3f s" % ('interpreter + pySim.esim', baseline))
+    for name, code in SNIPPETS.items():
+        imp = 'from pySim.esim import %s' % name
+        with tempfile.TemporaryDirectory() as cache_dir:
+            print("%-30s %8.3f s" % ('import %s' % name, run(imp, cache_dir)))
+            print("%-30s %8.3f s" % ('first encode (cold cache)', run(imp + '; ' + code, cache_dir)))
+            warm = sum(run(imp + '; ' + code, cache_dir) for i in range(opts.count)) / opts.count
+            print("%-30s %8.3f s" % ('first encode (warm cache)', warm))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""Take a snapshot of the contents of all files of a card (as known from the pySim file system
+model) into a compact binary container, show the contents of such a snapshot, or restore a card to a
+desired image writing only what differs from its snapshot."""
+
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from osmocom.utils import h2b, b2h
+
+from pySim.transport import argparse_add_reader_args, init_reader
+from pySim.utils import sanitize_pin_adm
+from pySim.snapshot import Snapshot, SnapshotWriter, SnapshotReader, SnapshotStats, dump_card
+from pySim.restore import RestorePlan, image_from_dict, image_from_saip
+
+def init_card(opts):
+    from pySim.app import init_card
+    sl = init_reader(opts)
+    rs, card = init_card(sl)
+    if rs is None:
+        raise SystemExit('Unsupported card')
+    if opts.pin_adm or opts.pin_adm_hex:
+        rs.lchan[0].scc.verify_chv(card._adm_chv_num, h2b(sanitize_pin_adm(opts.pin_adm, opts.pin_adm_hex)))
+    return sl, rs
+
+def file_system_model():
+    """File system model of a generic UICC with USIM, ISIM and all add-ons, for use without a card."""
+    from pySim.filesystem import CardMF
+    from pySim.ts_102_221 import CardProfileUICC
+    from pySim.ts_31_102 import CardApplicationUSIM
+    from pySim.ts_31_103 import CardApplicationISIM
+    profile = CardProfileUICC()
+    profile.add_application(CardApplicationUSIM())
+    profile.add_application(CardApplicationISIM())
+    mf = CardMF(profile=profile)
+    for addon_cls in profile.addons:
+        for f in addon_cls().files_in_mf:
+            mf.add_file(f)
+    for a in profile.applications:
+        if a.adf:
+            mf.add_application_df(a.adf)
+    for f in profile.files_in_mf:
+        mf.add_file(f)
+    return mf
+
+def do_dump(opts):
+    sl, rs = init_card(opts)
+    stats = SnapshotStats()
+    with open(opts.snapshot, 'wb') as f:
+        writer = SnapshotWriter(f, h2b(sl.get_atr()))
+        dump_card(rs.lchan[0], writer, opts.skip_empty, stats)
+    print(stats)
+
+def do_show(opts):
+    mf = None
+    if opts.decode:
+        mf = file_system_model()
+    with open(opts.snapshot, 'rb') as f:
+        reader = SnapshotReader(f, mf)
+        print('ATR: %s, created: %s' % (b2h(reader.atr) if reader.atr else '-', reader.created))
+        for fs in reader:
+            print(fs)
+            if opts.decode and fs.decoded is not None:
+                print('    %s' % fs.decoded)
+
+def do_restore(opts):
+    # the writes must refer to the file model of the card they are sent to
+    sl, rs = (None, None) if opts.dry_run else init_card(opts)
+    mf = rs.mf if rs else file_system_model()
+    current = Snapshot.load(opts.snapshot, mf)
+    if opts.saip:
+        from pySim.esim.saip import ProfileElementSequence
+        with open(opts.saip, 'rb') as f:
+            desired = image_from_saip(ProfileElementSequence.from_der(f.read()), mf)
+    elif opts.json:
+        with open(opts.json, 'r') as f:
+            desired = image_from_dict(mf, json.load(f), current)
+    else:
+        desired = Snapshot.load(opts.image, mf)
+    plan = RestorePlan(current, desired)
+    print(plan)
+    for fw in plan.files:
+        print('  %s' % fw)
+    for fs in plan.missing:
+        print('  %s: not on card' % (fs.name or fs.path_str))
+    if opts.dry_run or not plan.files:
+        return
+    if not opts.force:
+        try:
+            plan.check_card(rs.lchan[0])
+        except ValueError as e:
+            raise SystemExit('%s; use --force to restore anyway' % e)
+    try:
+        plan.execute(rs.lchan[0], force=True)
+    finally:
+        # the snapshot reflects all writes that succeeded
+        current.save(opts.snapshot)
+
+def add_adm_args(p: argparse.ArgumentParser, action: str):
+    p.add_argument('-a', '--pin-adm', help='ADM PIN to verify before %s' % action)
+    p.add_argument('-A', '--pin-adm-hex', help='ADM PIN to verify before %s, in hex' % action)
+
+parser = argparse.ArgumentParser(description=__doc__)
+subparsers = parser.add_subparsers(dest='command', required=True)
+dump_parser = subparsers.add_parser('dump', help='Take a snapshot of the card in the reader')
+argparse_add_reader_args(dump_parser)
+add_adm_args(dump_parser, 'reading')
+dump_parser.add_argument('--skip-empty', action='store_true', help='Skip records consisting of 0xFF only')
+dump_parser.add_argument('snapshot', help='File to write the snapshot to')
+dump_parser.set_defaults(func=do_dump)
+show_parser = subparsers.add_parser('show', help='Show the contents of a snapshot')
+show_parser.add_argument('--decode', action='store_true', help='Decode the file contents')
+show_parser.add_argument('snapshot', help='Snapshot file to read')
+show_parser.set_defaults(func=do_show)
+restore_parser = subparsers.add_parser('restore', help='Write the differences between a desired image and the snapshot of the card in the reader')
+argparse_add_reader_args(restore_parser)
+add_adm_args(restore_parser, 'writing')
+restore_parser.add_argument('--dry-run', action='store_true', help='Only show the writes required, without accessing the card')
+restore_parser.add_argument('--force', action='store_true',
+                            help='Write even if ATR or ICCID of the card differ from those in the snapshot')
+image_group = restore_parser.add_mutually_exclusive_group(required=True)
+image_group.add_argument('--image', help='Snapshot (e.g. of a reference card) to restore')
+image_group.add_argument('--json', help='JSON file with the (decoded or hex) contents of the files to restore, by path')
+image_group.add_argument('--saip', help='SAIP profile (DER) with the file contents to restore')
+restore_parser.add_argument('snapshot', help='Snapshot of the card, updated after writing')
+restore_parser.set_defaults(func=do_restore)
+
+if __name__ == '__main__':
+    opts = parser.parse_args()
+    opts.func(opts)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""Benchmark of the CAT TLV codec: proactive commands decoded per second (as done for each FETCH
+response) and TERMINAL RESPONSEs encoded per second, over a corpus of typical proactive commands."""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from osmocom.utils import h2b, b2h
+from osmocom.tlv import bertlv_encode_len
+from pySim.cat import ProactiveCommand
+from pySim.transport import ProactiveHandler
+
+def tlv(tag: int, value: str) -> str:
+    return '%02x' % tag + b2h(bertlv_encode_len(len(value) // 2)) + value
+
+def pcmd(num: int, cmd_type: int, qualifier: int, dest: int, *ies: str) -> bytes:
+    """Encode a proactive command: CommandDetails, DeviceIdentities (UICC -> dest) and further IEs."""
+    body = tlv(0x81, '%02x%02x%02x' % (num, cmd_type, qualifier)) + tlv(0x82, '81%02x' % dest) + ''.join(ies)
+    return h2b(tlv(0xd0, body))
+
+def text(s: str) -> str:
+    return '04' + b2h(s.encode('ascii'))
+
+CORPUS = [
+    # DISPLAY TEXT
+    pcmd(1, 0x21, 0x80, 0x02, tlv(0x8d, text('Toolkit Test 1'))),
+    # GET INKEY
+    pcmd(1, 0x22, 0x00, 0x82, tlv(0x8d, text('Enter "+"'))),
+    # GET INPUT
+    pcmd(1, 0x23, 0x00, 0x82, tlv(0x8d, text('Enter 12345')), tlv(0x91, '0505')),
+    # SET UP MENU
+    pcmd(1, 0x25, 0x00, 0x82, tlv(0x8f, '01' + b2h(b'Item 1')),
+         tlv(0x8f, '02' + b2h(b'Item 2')), tlv(0x8f, '03' + b2h(b'Item 3'))),
+    # SELECT ITEM
+    pcmd(1, 0x24, 0x00, 0x82, tlv(0x8f, '01' + b2h(b'Item 1')),
+         tlv(0x8f, '02' + b2h(b'Item 2'))),
+    # PROVIDE LOCAL INFORMATION
+    pcmd(1, 0x26, 0x00, 0x82),
+    # SEND SHORT MESSAGE
+    pcmd(1, 0x13, 0x00, 0x83, tlv(0x86, '91112233445566'),
+         tlv(0x8b, '0100099110325476f840f00c54657374204d657373616765')),
+    # POLL INTERVAL
+    pcmd(1, 0x03, 0x00, 0x82, tlv(0x84, '0114')),
+    # TIMER MANAGEMENT
+    pcmd(1, 0x27, 0x00, 0x82, tlv(0xa4, '01'), tlv(0xa5, '000150')),
+    # SET UP EVENT LIST
+    pcmd(1, 0x05, 0x00, 0x82, tlv(0x99, '0405')),
+    # REFRESH
+    pcmd(1, 0x01, 0x01, 0x82, tlv(0x92, '013f007fff6f07')),
+    # OPEN CHANNEL
+    pcmd(1, 0x40, 0x01, 0x82, tlv(0x35, '0203040203041f02'), tlv(0x39, '0578'),
+         tlv(0x3c, '01' + '1f90'), tlv(0x3e, '21' + 'c0a80001')),
+    # SEND DATA
+    pcmd(1, 0x43, 0x01, 0x21, tlv(0xb6, '00' * 64)),
+    # RECEIVE DATA
+    pcmd(1, 0x42, 0x00, 0x21, tlv(0xb7, '40')),
+    # CLOSE CHANNEL
+    pcmd(1, 0x41, 0x00, 0x21),
+]
+
+def bench(name: str, count: int, fn):
+    t_start = time.monotonic()
+    fn()
+    elapsed = time.monotonic() - t_start
+    print("%-30s %8.0f /s" % (name, count / elapsed))
+
+def decode(count: int):
+    for i in range(count):
+        ProactiveCommand().from_tlv(CORPUS[i % len(CORPUS)])
+
+def encode(count: int):
+    handler = ProactiveHandler()
+    decoded = []
+    for data in CORPUS:
+        pcmd = ProactiveCommand()
+        pcmd.from_tlv(data)
+        decoded.append(pcmd.decoded)
+    for i in range(count):
+        ti_list = handler.prepare_response(decoded[i % len(decoded)])
+        b''.join([x.to_tlv() for x in ti_list])
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--count', type=int, default=20000, help='Number of commands to decode / encode')
+parser.add_argument('--dump', action='store_true', help='Print the decoded corpus')
+
+if __name__ == '__main__':
+    opts = parser.parse_args()
+    if opts.dump:
+        for data in CORPUS:
+            print(b2h(data), ProactiveCommand().from_tlv(data))
+    bench('decode proactive command', opts.count, lambda: decode(opts.count))
+    bench('encode terminal response', opts.count, lambda: encode(opts.count))
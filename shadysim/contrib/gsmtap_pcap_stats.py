@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+"""Count the APDUs (by command) and card resets in a pcap / pcapng file of GSMTAP-SIM messages (as
+generated by simtrace2-sniff), reading the file natively and optionally in several worker processes."""
+
+import os
+import sys
+import time
+import argparse
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pySim.apdu import ApduCommand
+from pySim.apdu_source.pcap_gsmtap import map_gsmtap_sim_pcap
+
+def count_shard(packets) -> collections.Counter:
+    counts = collections.Counter()
+    for p in packets:
+        if isinstance(p, ApduCommand):
+            counts[p._name] += 1
+        else:
+            counts[type(p).__name__] += 1
+    return counts
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('pcap', help='pcap / pcapng file to read')
+parser.add_argument('--processes', type=int, default=0, help='Number of worker processes')
+parser.add_argument('--shards', type=int, default=None, help='Number of shards (default: one per process)')
+
+if __name__ == '__main__':
+    opts = parser.parse_args()
+    t_start = time.monotonic()
+    total = collections.Counter()
+    for counts in map_gsmtap_sim_pcap(opts.pcap, count_shard, opts.processes, opts.shards):
+        total.update(counts)
+    elapsed = time.monotonic() - t_start
+    for name, count in total.most_common():
+        print('%-24s %10u' % (name, count))
+    num = sum(total.values())
+    print('%u packets in %.1f s, %.0f packets/s' % (num, elapsed, num / elapsed if elapsed else 0.0))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""Benchmark of the OTA SMS-PP command encoder: messages/second of the per-call path (no header
+template or algorithm caching) versus OtaDialect.encode_cmds(), optionally fanned out to processes."""
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from osmocom.utils import h2b
+from pySim.ota import OtaKeyset, OtaDialectSms, OtaAlgoAuth, OtaAlgoCrypt
+
+SPI = {'counter': 'no_counter', 'ciphering': True, 'rc_cc_ds': 'cc', 'por_in_submit': False,
+       'por_shall_be_ciphered': True, 'por_rc_cc_ds': 'cc', 'por': 'por_required'}
+TAR = h2b('b00010')
+# SELECT MF/DF.GSM/EF.IMSI + READ BINARY
+APDU = h2b('a0a40000023f00' + 'a0a40000027f20' + 'a0a40000026f07' + 'a0b0000009')
+
+class UncachedOtaKeyset(OtaKeyset):
+    """OtaKeyset resolving the algorithm class on every access, like before the caching."""
+    @property
+    def auth(self):
+        return OtaAlgoAuth.from_keyset(self)
+
+    @property
+    def crypt(self):
+        return OtaAlgoCrypt.from_keyset(self)
+
+class UncachedOtaDialectSms(OtaDialectSms):
+    """OtaDialectSms building the complete header via construct for every message, like before
+    the header template cache."""
+    def _build_hdr(self, chl: int, spi: dict, otak: OtaKeyset, tar: bytes) -> bytes:
+        kic = {'key': otak.kic_idx, 'algo': otak.algo_crypt}
+        kid = {'key': otak.kid_idx, 'algo': otak.algo_auth}
+        return self.hdr_construct.build({'chl': chl, 'spi':spi, 'kic':kic, 'kid':kid, 'tar':tar})
+
+def gen_cmds(count: int, keyset_cls=OtaKeyset):
+    for i in range(count):
+        # card-individual (pseudo-random) keys
+        kic = hashlib.sha256(b'KIC%u' % i).digest()[:16]
+        kid = hashlib.sha256(b'KID%u' % i).digest()[:16]
+        otak = keyset_cls(algo_crypt='triple_des_cbc2', kic_idx=1, kic=kic,
+                         algo_auth='triple_des_cbc2', kid_idx=1, kid=kid, cntr=i)
+        yield (otak, TAR, SPI, APDU)
+
+def bench(name: str, count: int, fn):
+    t_start = time.monotonic()
+    fn()
+    elapsed = time.monotonic() - t_start
+    print("%-30s %8.0f msgs/s" % (name, count / elapsed))
+
+def per_call(count: int):
+    # the baseline: none of the caches used by encode_cmds()
+    for cmd in gen_cmds(count, UncachedOtaKeyset):
+        UncachedOtaDialectSms().encode_cmd(*cmd)
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--count', type=int, default=20000, help='Number of messages to encode')
+parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Number of worker processes')
+
+if __name__ == '__main__':
+    opts = parser.parse_args()
+    bench('per-call encode_cmd', opts.count, lambda: per_call(opts.count))
+    bench('encode_cmds', opts.count, lambda: OtaDialectSms().encode_cmds(gen_cmds(opts.count)))
+    bench('encode_cmds (%u processes)' % opts.processes, opts.count,
+          lambda: OtaDialectSms().encode_cmds(gen_cmds(opts.count), processes=opts.processes))
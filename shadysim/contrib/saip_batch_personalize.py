@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""Generate personalized SAIP profiles (UPPs) in bulk from a template profile and a CSV file with one
+row of card-individual parameters per profile, reporting the achieved throughput."""
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pySim.card_key_provider import CardKeyProviderCsv, CardKeyProviderCsvIndexed
+from pySim.esim.saip import personalization
+from pySim.esim.saip.personalization import BatchPersonalizer, BatchStats, ConfigurableParameter
+
+DEFAULT_PARAMS = ['ICCID=Iccid', 'IMSI=Imsi', 'KI=K', 'OPC=Opc']
+
+def parse_param(arg: str):
+    column, cls_name = arg.split('=', 1)
+    param_cls = getattr(personalization, cls_name, None)
+    if not isinstance(param_cls, type) or not issubclass(param_cls, ConfigurableParameter):
+        raise argparse.ArgumentTypeError('Unknown ConfigurableParameter %s' % cls_name)
+    return column.upper(), param_cls
+
+def parse_column_key(arg: str):
+    column, key = arg.split(':', 1)
+    return column.upper(), key
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('template', help='DER encoded template profile')
+parser.add_argument('csv', help='CSV file with the card-individual parameters, one profile per row')
+parser.add_argument('--output-dir', default='.', help='Directory to write the <ICCID>.der files to')
+parser.add_argument('--param', type=parse_param, action='append',
+                    help='CSV column and ConfigurableParameter class applied from it, like KI=K (default: %s)' %
+                    ' '.join(DEFAULT_PARAMS))
+parser.add_argument('--csv-column-key', type=parse_column_key, action='append', default=[],
+                    help='Transport key of an encrypted CSV column, like KI:<hex-key>')
+parser.add_argument('--indexed', action='store_true', help='Read the CSV file through its memory-mapped index')
+parser.add_argument('--processes', type=int, default=0, help='Number of worker processes')
+parser.add_argument('--chunksize', type=int, default=64, help='Number of profiles handed to a worker at once')
+
+if __name__ == '__main__':
+    opts = parser.parse_args()
+    params = dict(opts.param or [parse_param(p) for p in DEFAULT_PARAMS])
+    transport_keys = dict(opts.csv_column_key)
+    if opts.indexed:
+        provider = CardKeyProviderCsvIndexed(opts.csv, transport_keys)
+    else:
+        provider = CardKeyProviderCsv(opts.csv, transport_keys)
+    fields = list(params.keys())
+    if 'ICCID' not in fields:
+        fields.append('ICCID')
+
+    with open(opts.template, 'rb') as f:
+        bp = BatchPersonalizer(f.read(), params)
+    rows = list(provider.iter_rows(fields))
+    stats = BatchStats()
+    for row, der in zip(rows, bp.personalize_many(rows, opts.processes, opts.chunksize, stats)):
+        with open(os.path.join(opts.output_dir, '%s.der' % row['ICCID']), 'wb') as f:
+            f.write(der)
+    print(stats)
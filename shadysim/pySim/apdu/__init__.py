@@ -26,8 +26,9 @@ we already know in pySim about the filesystem structure, file encoding, etc.
 
 
 import abc
+import time
 import typing
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Iterable, Iterator
 from termcolor import colored
 from construct import Byte, GreedyBytes
 from construct import Optional as COptional
@@ -60,6 +61,9 @@ class ApduCommandMeta(abc.ABCMeta):
 
 BytesOrHex = typing.Union[bytes, Hexstr]
 
+# marker for a cmd_dict/rsp_dict that has not been decoded yet
+_NOT_DECODED = object()
+
 class Tpdu:
     def __init__(self, cmd: BytesOrHex, rsp: Optional[BytesOrHex] = None):
         if isinstance(cmd, str):
@@ -154,24 +158,72 @@ class ApduCommand(Apdu, metaclass=ApduCommandMeta):
     _tlv = None
     _tlv_rsp = None
 
-    def __init__(self, cmd: BytesOrHex, rsp: Optional[BytesOrHex] = None):
-        """Instantiate a new ApduCommand from give cmd + resp."""
+    def __init__(self, cmd: BytesOrHex, rsp: Optional[BytesOrHex] = None, lazy: bool = False):
+        """Instantiate a new ApduCommand from give cmd + resp.
+
+        Args:
+            cmd : the command part (header + data) of the APDU
+            rsp : the response part (data + SW) of the APDU
+            lazy : defer the decode of cmd_dict/rsp_dict until they are first accessed
+        """
         # store raw data
         super().__init__(cmd, rsp)
         # default to 'empty' ID column. To be set to useful values (like record number)
         # by derived class {cmd_rsp}_to_dict() or process() methods
-        self.col_id = '-'
+        self._col_id = '-'
         # fields only set by process_* methods
         self.file = None
         self.lchan = None
         self.processed = None
-        # the methods below could raise exceptions and those handlers might assume cmd_{dict,resp}
-        self.cmd_dict = None
-        self.rsp_dict = None
-        # interpret the data
-        self.cmd_dict = self.cmd_to_dict()
-        self.rsp_dict = self.rsp_to_dict() if self.rsp else {}
+        self._cmd_dict = _NOT_DECODED
+        self._rsp_dict = _NOT_DECODED
+        if not lazy:
+            # interpret the data
+            self._decode_cmd_dict()
+            self._decode_rsp_dict()
+
+    def _decode_cmd_dict(self):
+        # the method below could raise exceptions and those handlers might assume cmd_dict
+        self._cmd_dict = None
+        self._cmd_dict = self.cmd_to_dict()
+
+    def _decode_rsp_dict(self):
+        # the method below could raise exceptions and those handlers might assume rsp_dict
+        self._rsp_dict = None
+        self._rsp_dict = self.rsp_to_dict() if self.rsp else {}
+
+    @property
+    def cmd_dict(self) -> Optional[Dict]:
+        """The decoded Command part of the APDU (decoded on first access in lazy mode)."""
+        if self._cmd_dict is _NOT_DECODED:
+            self._decode_cmd_dict()
+        return self._cmd_dict
+
+    @cmd_dict.setter
+    def cmd_dict(self, value: Optional[Dict]):
+        self._cmd_dict = value
+
+    @property
+    def rsp_dict(self) -> Optional[Dict]:
+        """The decoded Response part of the APDU (decoded on first access in lazy mode)."""
+        if self._rsp_dict is _NOT_DECODED:
+            self._decode_rsp_dict()
+        return self._rsp_dict
+
+    @rsp_dict.setter
+    def rsp_dict(self, value: Optional[Dict]):
+        self._rsp_dict = value
+
+    @property
+    def col_id(self) -> str:
+        """ID column (like a record number); may be set as a side effect of decoding the command."""
+        if self._cmd_dict is _NOT_DECODED:
+            self._decode_cmd_dict()
+        return self._col_id
 
+    @col_id.setter
+    def col_id(self, value: str):
+        self._col_id = value
 
     @classmethod
     def from_apdu(cls, apdu:Apdu, **kwargs) -> 'ApduCommand':
@@ -179,7 +231,7 @@ class ApduCommand(Apdu, metaclass=ApduCommandMeta):
         return cls(cmd=apdu.cmd, rsp=apdu.rsp, **kwargs)
 
     @classmethod
-    def from_bytes(cls, buffer:bytes) -> 'ApduCommand':
+    def from_bytes(cls, buffer:bytes, **kwargs) -> 'ApduCommand':
         """Instantiate an ApduCommand from a linear byte buffer containing hdr,cmd,rsp,sw.
         This is for example used when parsing GSMTAP traces that traditionally contain the
         full command and response portion in one packet: "CLA INS P1 P2 P3 DATA SW" and we
@@ -187,11 +239,11 @@ class ApduCommand(Apdu, metaclass=ApduCommandMeta):
         apdu_case = cls.get_apdu_case(buffer)
         if apdu_case in [1, 2]:
             # data is part of response
-            return cls(buffer[:5], buffer[5:])
+            return cls(buffer[:5], buffer[5:], **kwargs)
         if apdu_case in [3, 4]:
             # data is part of command
             lc = buffer[4]
-            return cls(buffer[:5+lc], buffer[5+lc:])
+            return cls(buffer[:5+lc], buffer[5+lc:], **kwargs)
         raise ValueError('%s: Invalid APDU Case %u' % (cls.__name__, apdu_case))
 
     @property
@@ -354,6 +406,7 @@ class ApduCommandSet:
     def __init__(self, name: str, cmds: List[ApduCommand] =[]):
         self.name = name
         self.cmds = {c._ins: c for c in cmds}
+        self._dispatch = None
 
     def __str__(self) -> str:
         return self.name
@@ -373,39 +426,107 @@ class ApduCommandSet:
         else:
             raise ValueError(
                 '%s: Unsupported type to add operator: %s' % (self, other))
+        # the set of commands has changed, re-compile the dispatch table on next use
+        self._dispatch = None
         return self
 
+    @property
+    def dispatch_table(self) -> List[Optional[ApduCommand]]:
+        """Dispatch table of 256x256 entries, indexed by (CLA << 8) | INS.  Each entry contains the
+        ApduCommand derived class matching that CLA + INS, or None.  Compiled on first use, so that
+        the CLA patterns of the commands don't need to be evaluated for every single APDU."""
+        if self._dispatch is None:
+            table = [None] * 0x10000
+            for ins, cmd in self.cmds.items():
+                for cla in range(256):
+                    if cmd.match_cla(cla):
+                        table[cla << 8 | ins] = cmd
+            self._dispatch = table
+        return self._dispatch
+
     def lookup(self, ins, cla=None) -> Optional[ApduCommand]:
         """look-up the command within the CommandSet."""
         ins = int(ins)
-        if not ins in self.cmds:
-            return None
-        cmd = self.cmds[ins]
-        if cla and not cmd.match_cla(cla):
-            return None
-        return cmd
+        if not cla:
+            return self.cmds.get(ins, None)
+        if isinstance(cla, str):
+            cla = int(cla, 16)
+        return self.dispatch_table[cla << 8 | ins]
 
-    def parse_cmd_apdu(self, apdu: Apdu) -> ApduCommand:
+    def parse_cmd_apdu(self, apdu: Apdu, lazy: bool = False) -> ApduCommand:
         """Parse a Command-APDU. Returns an instance of an ApduCommand derived class."""
         # first look-up which of our member classes match CLA + INS
         a_cls = self.lookup(apdu.ins, apdu.cla)
         if not a_cls:
             raise ValueError('Unknown CLA=%02X INS=%02X' % (apdu.cla, apdu.ins))
         # then create an instance of that class and return it
-        return a_cls.from_apdu(apdu)
+        return a_cls.from_apdu(apdu, lazy=lazy)
 
-    def parse_cmd_bytes(self, buf:bytes) -> ApduCommand:
+    def parse_cmd_bytes(self, buf:bytes, lazy: bool = False) -> ApduCommand:
         """Parse from a buffer (simtrace style). Returns an instance of an ApduCommand derived class."""
         # first look-up which of our member classes match CLA + INS
         cla = buf[0]
         ins = buf[1]
-        a_cls = self.lookup(ins, cla)
+        a_cls = self.dispatch_table[cla << 8 | ins]
         if not a_cls:
             raise ValueError('Unknown CLA=%02X INS=%02X' % (cla, ins))
         # then create an instance of that class and return it
-        return a_cls.from_bytes(buf)
+        return a_cls.from_bytes(buf, lazy=lazy)
 
 
+class DecodeStats:
+    """Statistics about the decode of a trace."""
+    def __init__(self):
+        self.apdus = 0
+        self.unknown = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    @property
+    def apdus_per_sec(self) -> float:
+        return self.apdus / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return "Decoded %u APDUs (%u bytes, %u unknown) in %.1f s, %.0f APDUs/s" % \
+            (self.apdus, self.bytes, self.unknown, self.elapsed, self.apdus_per_sec)
+
+
+def decode_trace(bufs: Iterable[bytes], cmd_set: ApduCommandSet, lazy: bool = True,
+                 strict: bool = False, stats: Optional[DecodeStats] = None) -> Iterator[ApduCommand]:
+    """Decode a sequence of simtrace style buffers ("CLA INS P1 P2 P3 DATA SW", as contained in
+    GSMTAP-SIM messages) into ApduCommand instances.
+
+    This is the batch equivalent of calling ApduCommandSet.parse_cmd_bytes() for each buffer.  By
+    default, the decode of cmd_dict/rsp_dict is deferred until they are accessed, so that
+    filtering a large capture only pays for the APDUs that are actually looked at.
+
+    Args:
+        bufs : iterable of buffers, one APDU each
+        cmd_set : the set of commands to decode against
+        lazy : defer the decode of cmd_dict/rsp_dict until they are first accessed
+        strict : raise ValueError on unknown CLA/INS instead of skipping the APDU
+        stats : optional DecodeStats to update while decoding
+    Returns:
+        generator of ApduCommand derived class instances
+    """
+    table = cmd_set.dispatch_table
+    if stats is None:
+        stats = DecodeStats()
+    start = time.monotonic()
+    try:
+        for buf in bufs:
+            a_cls = table[buf[0] << 8 | buf[1]]
+            stats.bytes += len(buf)
+            if not a_cls:
+                stats.unknown += 1
+                if strict:
+                    raise ValueError('Unknown CLA=%02X INS=%02X' % (buf[0], buf[1]))
+                continue
+            stats.apdus += 1
+            yield a_cls.from_bytes(buf, lazy=lazy)
+    finally:
+        stats.elapsed = time.monotonic() - start
+
 
 class ApduHandler(abc.ABC):
     @abc.abstractmethod
@@ -0,0 +1,407 @@
+# coding=utf-8
+"""ApduSource reading GSMTAP-SIM messages directly from pcap / pcapng files.
+
+Unlike the pyshark based sources, this does not need tshark: the capture file is memory-mapped and
+the UDP payload of each packet is located by a few struct lookups, which is several orders of
+magnitude faster.  Large captures can additionally be split into shards at record boundaries and
+processed by several worker processes.
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import mmap
+import struct
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from pySim.apdu.ts_102_221 import ApduCommands as UiccApduCommands
+from pySim.apdu.ts_102_222 import ApduCommands as UiccAdmApduCommands
+from pySim.apdu.ts_31_102 import ApduCommands as UsimApduCommands
+from pySim.apdu.global_platform import ApduCommands as GpApduCommands
+
+from . import ApduSource, PacketType, CardReset
+
+ApduCommands = UiccApduCommands + UiccAdmApduCommands + UsimApduCommands + GpApduCommands
+
+logger = logging.getLogger(__name__)
+
+GSMTAP_UDP_PORT = 4729
+GSMTAP_VERSION = 0x02
+GSMTAP_TYPE_SIM = 0x04
+# GSMTAP_SIM_* sub-types
+GSMTAP_SIM_APDU = 0x00
+GSMTAP_SIM_ATR = 0x01
+GSMTAP_SIM_PPS_REQ = 0x02
+GSMTAP_SIM_PPS_RSP = 0x03
+
+# pcap file header magic: byte order and timestamp resolution (usec/nsec)
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': '<',
+    b'\xa1\xb2\xc3\xd4': '>',
+    b'\x4d\x3c\xb2\xa1': '<',
+    b'\xa1\xb2\x3c\x4d': '>',
+}
+PCAP_FILE_HDR_LEN = 24
+PCAP_REC_HDR_LEN = 16
+
+# pcapng block types
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+# link-layer header types (https://www.tcpdump.org/linktypes.html)
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+IPPROTO_UDP = 17
+
+# number of consecutive well-formed records required to accept a re-synchronisation point
+RESYNC_RECORDS = 8
+# maximum difference of the timestamps (in seconds) within such a chain of pcap records
+RESYNC_MAX_TS_DELTA = 3600
+
+
+def udp_payload(linktype: int, pkt: memoryview, port: int = GSMTAP_UDP_PORT) -> Optional[memoryview]:
+    """Return the UDP payload of a captured packet if it was sent from or to the given port.
+
+    Args:
+        linktype: LINKTYPE_* of the interface on which the packet was captured
+        pkt: the captured packet, starting with the link-layer header
+        port: UDP port to filter on
+    Returns:
+        UDP payload; None for non-UDP packets, other ports, IP fragments or unsupported link types
+    """
+    try:
+        if linktype == LINKTYPE_ETHERNET:
+            ethertype = pkt[12] << 8 | pkt[13]
+            off = 14
+            while ethertype in ETHERTYPE_VLAN:
+                ethertype = pkt[off+2] << 8 | pkt[off+3]
+                off += 4
+            if ethertype not in (0x0800, 0x86dd):
+                return None
+        elif linktype == LINKTYPE_LINUX_SLL:
+            off = 16
+        elif linktype == LINKTYPE_LINUX_SLL2:
+            off = 20
+        elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+            off = 4
+        elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+            off = 0
+        else:
+            return None
+        version = pkt[off] >> 4
+        if version == 4:
+            # skip fragments: 'more fragments' flag or non-zero fragment offset
+            if pkt[off+6] & 0x3f or pkt[off+7]:
+                return None
+            if pkt[off+9] != IPPROTO_UDP:
+                return None
+            off += (pkt[off] & 0x0f) * 4
+        elif version == 6:
+            # extension headers are not supported
+            if pkt[off+6] != IPPROTO_UDP:
+                return None
+            off += 40
+        else:
+            return None
+        sport = pkt[off] << 8 | pkt[off+1]
+        dport = pkt[off+2] << 8 | pkt[off+3]
+        if port not in (sport, dport):
+            return None
+        udp_len = pkt[off+4] << 8 | pkt[off+5]
+        return pkt[off+8:off+udp_len]
+    except IndexError:
+        # truncated packet (snaplen)
+        return None
+
+
+def gsmtap_sim(payload: memoryview) -> Optional[Tuple[int, bytes]]:
+    """Return GSMTAP-SIM sub-type and body of a GSMTAP message, None for other GSMTAP types."""
+    if len(payload) < 16 or payload[0] != GSMTAP_VERSION or payload[2] != GSMTAP_TYPE_SIM:
+        return None
+    # hdr_len is in units of 32bit words
+    return payload[12], bytes(payload[payload[1]*4:])
+
+
+class PcapFile:
+    """Minimal memory-mapped reader for pcap and pcapng files, yielding the captured packets.
+
+    Sharding assumes that all pcapng interfaces are described at the start of the file, as is the
+    case for files written by dumpcap / wireshark / mergecap.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self.mm[:4]
+        if magic in PCAP_MAGIC:
+            self.pcapng = False
+            self.endian = PCAP_MAGIC[magic]
+            _vmaj, _vmin, _tz, _sigfigs, self.snaplen, linktype = \
+                struct.unpack_from(self.endian + 'HHiIII', self.mm, 4)
+            # upper bits may carry the FCS length
+            self.linktypes = [linktype & 0x0fffffff]
+            self.first_record = PCAP_FILE_HDR_LEN
+        elif struct.unpack_from('<I', self.mm, 0)[0] == PCAPNG_SHB:
+            self.pcapng = True
+            self.endian = None
+            self.linktypes = []
+            # read the leading SHB and IDBs, so that shards can start anywhere behind them
+            offset = 0
+            while offset < len(self.mm):
+                btype, blen = self._block_hdr(offset)
+                if btype not in (PCAPNG_SHB, PCAPNG_IDB):
+                    break
+                self._process_block(btype, offset)
+                offset += blen
+            self.first_record = offset
+        else:
+            raise ValueError('%s: neither a pcap nor a pcapng file' % filename)
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _block_hdr(self, offset: int) -> Tuple[int, int]:
+        """Return type and total length of the pcapng block at offset."""
+        if struct.unpack_from('<I', self.mm, offset)[0] == PCAPNG_SHB:
+            bom = struct.unpack_from('<I', self.mm, offset + 8)[0]
+            self.endian = '<' if bom == PCAPNG_BYTE_ORDER_MAGIC else '>'
+        return struct.unpack_from(self.endian + 'II', self.mm, offset)
+
+    def _process_block(self, btype: int, offset: int):
+        """Update the section state (interfaces) from a SHB or IDB."""
+        if btype == PCAPNG_SHB:
+            self.linktypes = []
+        elif btype == PCAPNG_IDB:
+            self.linktypes.append(struct.unpack_from(self.endian + 'H', self.mm, offset + 8)[0])
+
+    def _valid_record_at(self, offset: int) -> bool:
+        """Is there a chain of well-formed records starting at offset?"""
+        mm = self.mm
+        size = len(mm)
+        first_sec = None
+        for _i in range(RESYNC_RECORDS):
+            if offset == size:
+                return True
+            if self.pcapng:
+                if offset + 12 > size:
+                    return False
+                _btype, blen = struct.unpack_from(self.endian + 'II', mm, offset)
+                if blen < 12 or blen % 4 or offset + blen > size:
+                    return False
+                if struct.unpack_from(self.endian + 'I', mm, offset + blen - 4)[0] != blen:
+                    return False
+                offset += blen
+            else:
+                if offset + PCAP_REC_HDR_LEN > size:
+                    return False
+                sec, usec, incl_len, orig_len = struct.unpack_from(self.endian + 'IIII', mm, offset)
+                if usec >= 1000000000 or incl_len > self.snaplen or incl_len > orig_len:
+                    return False
+                # consecutive packets of a capture are close in time
+                if first_sec is None:
+                    first_sec = sec
+                elif abs(sec - first_sec) > RESYNC_MAX_TS_DELTA:
+                    return False
+                offset += PCAP_REC_HDR_LEN + incl_len
+                if offset > size:
+                    return False
+        return True
+
+    def find_record(self, offset: int) -> int:
+        """Return the offset of the first record starting at or behind the given file offset."""
+        if offset <= self.first_record:
+            return self.first_record
+        step = 1
+        if self.pcapng:
+            # blocks are 32bit aligned
+            offset += -offset % 4
+            step = 4
+        while offset < len(self.mm):
+            if self._valid_record_at(offset):
+                return offset
+            offset += step
+        return len(self.mm)
+
+    def shards(self, num_shards: int) -> List[Tuple[int, int]]:
+        """Split the file into (up to) num_shards ranges of (start, end) offsets at record boundaries."""
+        size = len(self.mm)
+        data_len = size - self.first_record
+        bounds = [self.first_record]
+        for i in range(1, num_shards):
+            b = self.find_record(self.first_record + data_len * i // num_shards)
+            if b > bounds[-1]:
+                bounds.append(b)
+        bounds.append(size)
+        return [(bounds[i], bounds[i+1]) for i in range(len(bounds) - 1) if bounds[i] < bounds[i+1]]
+
+    def packets(self, start: Optional[int] = None, end: Optional[int] = None) -> Iterator[Tuple[int, memoryview]]:
+        """Yield (linktype, packet) of all packets in records starting within [start, end)."""
+        mm = self.mm
+        buf = memoryview(mm)
+        offset = self.first_record if start is None else start
+        end = len(mm) if end is None else end
+        try:
+            if not self.pcapng:
+                hdr = struct.Struct(self.endian + '8xI4x')
+                linktype = self.linktypes[0]
+                end = min(end, len(mm) - PCAP_REC_HDR_LEN + 1)
+                while offset < end:
+                    incl_len, = hdr.unpack_from(mm, offset)
+                    offset += PCAP_REC_HDR_LEN
+                    yield linktype, buf[offset:offset+incl_len]
+                    offset += incl_len
+                return
+            end = min(end, len(mm) - 12 + 1)
+            while offset < end:
+                btype, blen = self._block_hdr(offset)
+                if blen < 12:
+                    raise ValueError('%s: invalid pcapng block length %u at offset %u' %
+                                     (self.filename, blen, offset))
+                if btype == PCAPNG_EPB:
+                    if_id, _ts_hi, _ts_lo, cap_len = struct.unpack_from(self.endian + 'IIII', mm, offset + 8)
+                    if if_id < len(self.linktypes):
+                        yield self.linktypes[if_id], buf[offset+28:offset+28+cap_len]
+                elif btype == PCAPNG_SPB:
+                    orig_len, = struct.unpack_from(self.endian + 'I', mm, offset + 8)
+                    cap_len = min(orig_len, blen - 16)
+                    if self.linktypes:
+                        yield self.linktypes[0], buf[offset+12:offset+12+cap_len]
+                else:
+                    self._process_block(btype, offset)
+                offset += blen
+        finally:
+            buf.release()
+
+    def gsmtap_sim(self, start: Optional[int] = None, end: Optional[int] = None) -> Iterator[Tuple[int, bytes]]:
+        """Yield (sub_type, body) of all GSMTAP-SIM messages in records starting within [start, end)."""
+        for linktype, pkt in self.packets(start, end):
+            payload = udp_payload(linktype, pkt)
+            if payload is None:
+                continue
+            msg = gsmtap_sim(payload)
+            if msg:
+                yield msg
+
+
+def _parse_gsmtap_sim(sub_type: int, body: bytes, lazy: bool) -> PacketType:
+    if sub_type == GSMTAP_SIM_APDU:
+        return ApduCommands.parse_cmd_bytes(body, lazy=lazy)
+    if sub_type == GSMTAP_SIM_ATR:
+        # card has been reset
+        return CardReset(body)
+    if sub_type in [GSMTAP_SIM_PPS_REQ, GSMTAP_SIM_PPS_RSP]:
+        # simply ignore for now
+        return None
+    raise ValueError('Unsupported GSMTAP-SIM sub-type %u' % sub_type)
+
+
+def read_gsmtap_sim_pcap(filename: str, start: Optional[int] = None, end: Optional[int] = None,
+                         lazy: bool = True) -> Iterator[PacketType]:
+    """Yield the decoded ApduCommand / CardReset of all GSMTAP-SIM messages in a pcap / pcapng file.
+
+    Args:
+        filename: file name of the pcap / pcapng file
+        start, end: only read the records starting within this range of file offsets
+        lazy: defer the decode of cmd_dict/rsp_dict until they are first accessed
+    """
+    with PcapFile(filename) as pcap:
+        msgs = pcap.gsmtap_sim(start, end)
+        try:
+            for sub_type, body in msgs:
+                p = _parse_gsmtap_sim(sub_type, body, lazy)
+                if p:
+                    yield p
+        finally:
+            # release the views into the mapping before closing it
+            msgs.close()
+
+
+def _shard_worker(args) -> object:
+    """Helper for map_gsmtap_sim_pcap() running in a worker process."""
+    fn, filename, start, end, lazy = args
+    return fn(read_gsmtap_sim_pcap(filename, start, end, lazy))
+
+
+def map_gsmtap_sim_pcap(filename: str, fn: Callable[[Iterator[PacketType]], object], processes: int = 0,
+                        num_shards: Optional[int] = None, lazy: bool = True) -> Iterator[object]:
+    """Split a pcap / pcapng file into shards at record boundaries and apply fn to each of them.
+
+    Args:
+        filename: file name of the pcap / pcapng file
+        fn: module-level function called with an iterator over the ApduCommand / CardReset of one
+            shard; its (picklable) return value is passed back
+        processes: number of worker processes to fan out to (0 = process all shards in this process)
+        num_shards: number of shards (default: one per process)
+        lazy: defer the decode of cmd_dict/rsp_dict until they are first accessed
+    Returns:
+        iterator of the return values of fn, in the order of the shards within the file
+    """
+    with PcapFile(filename) as pcap:
+        shards = pcap.shards(num_shards or max(processes, 1))
+    args = [(fn, filename, start, end, lazy) for start, end in shards]
+    if not processes:
+        yield from map(_shard_worker, args)
+        return
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        yield from executor.map(_shard_worker, args)
+
+
+class PcapGsmtapApduSource(ApduSource):
+    """ApduSource for reading GSMTAP-SIM messages (such as those generated by simtrace2-sniff) from a
+    pcap or pcapng file, without going through tshark."""
+    def __init__(self, pcap_filename: str, lazy: bool = False):
+        """
+        Args:
+            pcap_filename: File name of the pcap / pcapng file to be opened
+            lazy: defer the decode of cmd_dict/rsp_dict until they are first accessed
+        """
+        super().__init__()
+        self.pcap = PcapFile(pcap_filename)
+        self.lazy = lazy
+        self.msgs = self.pcap.gsmtap_sim()
+
+    def read_packet(self) -> PacketType:
+        sub_type, body = next(self.msgs)
+        return _parse_gsmtap_sim(sub_type, body, self.lazy)
+
+    def close(self):
+        """Release the memory mapping of the file."""
+        # release the views into the mapping before closing it
+        self.msgs.close()
+        self.pcap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
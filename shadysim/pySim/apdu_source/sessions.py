@@ -0,0 +1,227 @@
+# coding=utf-8
+"""Parallel analysis of APDU traces, one card session at a time.
+
+Processing the APDUs of a trace requires a RuntimeState (which file is selected on which logical
+channel, ...), so a single trace can only be processed sequentially.  However, a CardReset returns
+the RuntimeState to a well-defined state.  The trace is therefore split into card sessions at each
+CardReset, and the sessions are processed independently (possibly in several worker processes),
+each of them starting from a freshly reset RuntimeState.  The results are identical to those of
+processing the entire trace sequentially.
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import logging
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Union
+
+from osmocom.utils import b2h
+
+from pySim.commands import SimCardCommands
+from pySim.cards import UiccCardBase
+from pySim.runtime import RuntimeState
+from pySim.ts_102_221 import CardProfileUICC
+from pySim.ts_31_102 import CardApplicationUSIM
+from pySim.ts_31_103 import CardApplicationISIM
+from pySim.apdu import Apdu, ApduCommand, CardReset
+from pySim.apdu.ts_102_221 import ApduCommands as UiccApduCommands
+from pySim.apdu.ts_102_222 import ApduCommands as UiccAdmApduCommands
+from pySim.apdu.ts_31_102 import ApduCommands as UsimApduCommands
+from pySim.apdu.global_platform import ApduCommands as GpApduCommands
+
+from . import ApduSource, DummySimLink
+
+ApduCommands = UiccApduCommands + UiccAdmApduCommands + UsimApduCommands + GpApduCommands
+
+logger = logging.getLogger(__name__)
+
+
+def trace_runtime_state() -> RuntimeState:
+    """Create a RuntimeState for trace analysis.  We assume a generic UICC profile; as all APDUs
+    return 9000 in DummySimLink, all CardProfileAddon (including SIM) will probe successful."""
+    profile = CardProfileUICC()
+    profile.add_application(CardApplicationUSIM())
+    profile.add_application(CardApplicationISIM())
+    scc = SimCardCommands(transport=DummySimLink())
+    card = UiccCardBase(scc)
+    return RuntimeState(card, profile)
+
+
+class CardSession:
+    """The APDUs exchanged with a card between two resets."""
+    def __init__(self, index: int, atr: Optional[bytes] = None):
+        """
+        Args:
+            index : position of the session within the trace
+            atr : ATR of the CardReset starting the session (None for APDUs before the first reset)
+        """
+        self.index = index
+        self.atr = atr
+        self.apdus = []
+
+    def __str__(self) -> str:
+        return '%s(%u, %s, %u APDUs)' % (type(self).__name__, self.index,
+                                        b2h(self.atr) if self.atr else '-', len(self.apdus))
+
+
+class TraceRecord:
+    """Summary of one processed APDU.  Unlike the ApduCommand itself (which references the
+    RuntimeState and file system), this can be passed back from a worker process."""
+    def __init__(self, session: int, apdu: Apdu, cmd: Optional[ApduCommand] = None, error: Optional[str] = None):
+        self.session = session
+        self.cmd = apdu.cmd
+        self.rsp = apdu.rsp
+        self.error = error
+        self.name = None
+        self.lchan_nr = None
+        self.path = ''
+        self.col_id = '-'
+        self.processed = None
+        if cmd:
+            self.name = cmd._name
+            self.lchan_nr = cmd.lchan_nr
+            self.path = cmd.path_str
+            self.col_id = cmd.col_id
+            self.processed = cmd.processed
+
+    @property
+    def sw(self) -> Optional[str]:
+        return b2h(self.rsp[-2:]) if self.rsp else None
+
+    def __str__(self) -> str:
+        if self.error:
+            return '%u %s: %s' % (self.session, b2h(self.cmd), self.error)
+        return '%u %02u %-16s %-30s %s %s %s' % (self.session, self.lchan_nr, self.name, self.path,
+                                                 self.col_id, self.sw, self.processed)
+
+
+def iter_source(source: ApduSource) -> Iterator[Union[Apdu, CardReset]]:
+    """Iterate over the Apdu / CardReset read from an ApduSource until it is exhausted."""
+    while True:
+        try:
+            yield source.read()
+        except StopIteration:
+            return
+
+
+def split_sessions(packets: Iterable[Union[Apdu, CardReset]]) -> Iterator[CardSession]:
+    """Split a trace into card sessions at each CardReset.  Only the raw command and response of
+    each APDU is kept, so that sessions can be passed to worker processes cheaply."""
+    session = CardSession(0)
+    for p in packets:
+        if isinstance(p, CardReset):
+            if session.apdus or session.atr is not None:
+                yield session
+            session = CardSession(session.index + 1, p.atr)
+        else:
+            session.apdus.append(Apdu(p.cmd, p.rsp))
+    if session.apdus or session.atr is not None:
+        yield session
+
+
+def process_session(rs: RuntimeState, session: CardSession) -> List[TraceRecord]:
+    """Process all APDUs of a card session on a RuntimeState, starting with a card reset."""
+    rs.reset()
+    records = []
+    for apdu in session.apdus:
+        cmd = None
+        try:
+            cmd = ApduCommands.parse_cmd_apdu(apdu, lazy=True)
+            cmd.process(rs)
+            records.append(TraceRecord(session.index, apdu, cmd))
+        except Exception as e:
+            logger.warning('session %u: failed to process %s: %s', session.index, apdu, e)
+            records.append(TraceRecord(session.index, apdu, None, '%s: %s' % (type(e).__name__, e)))
+    return records
+
+
+class AnalysisStats:
+    """Statistics about the analysis of a trace."""
+    def __init__(self):
+        self.sessions = 0
+        self.apdus = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    @property
+    def apdus_per_sec(self) -> float:
+        return self.apdus / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return "Analyzed %u APDUs (%u errors) in %u card sessions in %.1f s, %.0f APDUs/s" % \
+            (self.apdus, self.errors, self.sessions, self.elapsed, self.apdus_per_sec)
+
+
+def analyze_trace(packets: Iterable[Union[Apdu, CardReset]], processes: int = 0,
+                  fn: Callable[[RuntimeState, CardSession], object] = process_session,
+                  stats: Optional[AnalysisStats] = None) -> Iterator[object]:
+    """Split a trace into card sessions and process each of them with its own RuntimeState.
+
+    Args:
+        packets: the Apdu / CardReset of the trace, e.g. iter_source(source)
+        processes: number of worker processes to fan out to (0 = process all sessions in this process)
+        fn: module-level function processing one session on a RuntimeState, returning a picklable
+            result (default: process_session, returning a list of TraceRecord)
+        stats: AnalysisStats instance to be updated
+    Returns:
+        iterator of the return values of fn, in the order of the sessions within the trace
+    """
+    stats = stats or AnalysisStats()
+    t_start = time.monotonic()
+    sessions = split_sessions(packets)
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=processes, initializer=_session_worker_init, initargs=(fn,))
+        results = _map_bounded(executor, sessions, processes * 4)
+    else:
+        executor = None
+        rs = trace_runtime_state()
+        results = (fn(rs, session) for session in sessions)
+    try:
+        for result in results:
+            stats.sessions += 1
+            if isinstance(result, list):
+                stats.apdus += len(result)
+                stats.errors += sum(1 for r in result if isinstance(r, TraceRecord) and r.error)
+            stats.elapsed = time.monotonic() - t_start
+            yield result
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+
+def _map_bounded(executor: ProcessPoolExecutor, sessions: Iterable[CardSession], window: int) -> Iterator[object]:
+    """Like executor.map(), but without reading ahead more than window sessions."""
+    pending = collections.deque()
+    for session in sessions:
+        pending.append(executor.submit(_session_worker, session))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+_session_rs = None
+_session_fn = None
+
+def _session_worker_init(fn: Callable[[RuntimeState, CardSession], object]):
+    """Helper for analyze_trace(): create the RuntimeState once per worker process."""
+    global _session_rs, _session_fn
+    _session_rs = trace_runtime_state()
+    _session_fn = fn
+
+def _session_worker(session: CardSession) -> object:
+    """Helper for analyze_trace() running in a worker process."""
+    return _session_fn(_session_rs, session)
@@ -105,6 +105,11 @@ def init_card(sl: LinkBase, skip_card_init: bool = False) -> Tuple[RuntimeState,
         if generic_card:
             card = UiccCardBase(scc)
 
+    # use extended length APDUs for large transfers, if both reader and card support them; EF.ATR
+    # is only read once such a transfer comes up
+    if isinstance(card, UiccCardBase):
+        scc.probe_extended_length(defer=True)
+
     # Create runtime state with card profile
     rs = RuntimeState(card, profile)
 
@@ -28,12 +28,17 @@ operation with pySim-shell.
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Iterable, Iterator, Tuple
 from Cryptodome.Cipher import AES
+from Cryptodome.Util.strxor import strxor
 from osmocom.utils import h2b, b2h
 
 import abc
 import csv
+import os
+import mmap
+import sqlite3
+import threading
 
 card_key_providers = []  # type: List['CardKeyProvider']
 
@@ -154,6 +159,183 @@ class CardKeyProviderCsv(CardKeyProvider):
                                            (self.filename, f))
         return rc
 
+    def iter_rows(self, fields: List[str]) -> Iterator[Dict[str, str]]:
+        """Iterate over all rows of the CSV file, e.g. for bulk processing.
+
+        Args:
+                fields : names of the fields (columns) to return for each row
+        Returns:
+                iterator of dicts with the (decrypted) values of the fields of each row
+        """
+        self.csv_file.seek(0)
+        cr = csv.DictReader(self.csv_file)
+        cr.fieldnames = [field.upper() for field in cr.fieldnames]
+        for f in fields:
+            if f not in cr.fieldnames:
+                raise RuntimeError("CSV-File '%s' lacks column '%s'" % (self.filename, f))
+        for row in cr:
+            yield {f: self._decrypt_field(f, row[f]) for f in fields}
+
+
+class CardKeyProviderCsvIndexed(CardKeyProviderCsv):
+    """Card key provider implementation for (very) large CSV files.  On first use, a persistent
+    SQLite index mapping the values of the look-up key columns (ICCID, EID, IMSI) to the byte offset
+    of the respective row is built next to the CSV file.  Look-ups then only parse the matching row(s)
+    from a memory-mapped view of the CSV file.  The index is rebuilt automatically whenever the size
+    or modification time of the CSV file changes.
+
+    The CSV file must contain one record per line (no quoted line breaks)."""
+
+    def __init__(self, filename: str, transport_keys: dict, index_filename: Optional[str] = None):
+        """
+        Args:
+                filename : file name (path) of CSV file containing card-individual key/data
+                transport_keys : a dict indexed by field name, whose values are hex-encoded AES keys for the
+                                 respective field (column) of the CSV (see CardKeyProviderCsv)
+                index_filename : file name (path) of the index database (default: filename + '.idx')
+        """
+        self.filename = filename
+        self.index_filename = index_filename or filename + '.idx'
+        self.transport_keys = self.process_transport_keys(transport_keys)
+        # AES (ECB) objects per field; CBC chaining is applied in _decrypt_field, so the
+        # key schedule is computed only once per column.
+        self._ciphers = {name: AES.new(h2b(key), AES.MODE_ECB) for name, key in self.transport_keys.items()}
+        self._fh = open(filename, 'rb')
+        # an empty file cannot be memory-mapped
+        if os.fstat(self._fh.fileno()).st_size == 0:
+            self._fh.close()
+            raise RuntimeError("CSV-File '%s' lacks a header" % filename)
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.fieldnames = self._parse_line(0)
+        if not self.fieldnames:
+            raise RuntimeError("CSV-File '%s' lacks a header" % filename)
+        self.fieldnames = [field.upper() for field in self.fieldnames]
+        # the provider may be shared between threads (e.g. one per card reader); the connection
+        # is used from all of them, serialized by the lock
+        self._db = sqlite3.connect(self.index_filename, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        if not self._index_valid():
+            self.build_index()
+
+    def __del__(self):
+        try:
+            self._db.close()
+            self._mm.close()
+            self._fh.close()
+        except Exception:
+            pass
+
+    def _file_signature(self) -> str:
+        st = os.stat(self.filename)
+        return '%d:%d' % (st.st_size, st.st_mtime_ns)
+
+    def _index_valid(self) -> bool:
+        try:
+            with self._db_lock:
+                row = self._db.execute("SELECT value FROM meta WHERE name='signature'").fetchone()
+        except sqlite3.OperationalError:
+            return False
+        return row is not None and row[0] == self._file_signature()
+
+    def _parse_line(self, offset: int) -> List[str]:
+        """Parse the CSV line starting at given byte offset of the file."""
+        end = self._mm.find(b'\n', offset)
+        if end < 0:
+            end = len(self._mm)
+        line = self._mm[offset:end].decode('utf-8').rstrip('\r')
+        return next(csv.reader([line]), [])
+
+    def _iter_lines(self) -> Iterator[Tuple[int, List[str]]]:
+        """Iterate over all (non-empty) data lines, yielding their byte offset and parsed fields."""
+        offset = self._mm.find(b'\n') + 1
+        while 0 < offset < len(self._mm):
+            end = self._mm.find(b'\n', offset)
+            if end < 0:
+                end = len(self._mm)
+            line = self._mm[offset:end].decode('utf-8').rstrip('\r')
+            if line:
+                yield offset, next(csv.reader([line]))
+            offset = end + 1
+
+    def build_index(self):
+        """(Re-)build the on-disk index of the look-up key columns."""
+        key_columns = [(i, name) for i, name in enumerate(self.fieldnames) if name in self.VALID_KEY_FIELD_NAMES]
+        db = self._db
+
+        def index_entries():
+            for offset, row in self._iter_lines():
+                for i, name in key_columns:
+                    if i < len(row):
+                        yield (name, row[i], offset)
+
+        with self._db_lock:
+            db.execute("DROP TABLE IF EXISTS rows")
+            db.execute("DROP TABLE IF EXISTS meta")
+            db.execute("CREATE TABLE rows (key TEXT, value TEXT, offset INTEGER, PRIMARY KEY (key, value))")
+            db.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)")
+            # like CardKeyProviderCsv, the last matching row wins in case of duplicates
+            db.executemany("INSERT OR REPLACE INTO rows VALUES (?, ?, ?)", index_entries())
+            db.execute("INSERT INTO meta VALUES ('signature', ?)", (self._file_signature(),))
+            db.commit()
+
+    def _decrypt_field(self, field_name: str, encrypted_val: str) -> str:
+        """decrypt a single field, if we have a transport key for the field of that name."""
+        cipher = self._ciphers.get(field_name)
+        if not cipher:
+            return encrypted_val
+        ciphertext = h2b(encrypted_val)
+        # AES-CBC decryption using the cached ECB key schedule
+        return b2h(strxor(cipher.decrypt(ciphertext), self.IV + ciphertext[:-16]))
+
+    def _get_row(self, fields: List[str], offset: int) -> Dict[str, str]:
+        row = dict(zip(self.fieldnames, self._parse_line(offset)))
+        rc = {}
+        for f in fields:
+            if f in row:
+                rc[f] = self._decrypt_field(f, row[f])
+            else:
+                raise RuntimeError("CSV-File '%s' lacks column '%s'" % (self.filename, f))
+        return rc
+
+    def iter_rows(self, fields: List[str]) -> Iterator[Dict[str, str]]:
+        for f in fields:
+            if f not in self.fieldnames:
+                raise RuntimeError("CSV-File '%s' lacks column '%s'" % (self.filename, f))
+        for _offset, row in self._iter_lines():
+            row = dict(zip(self.fieldnames, row))
+            yield {f: self._decrypt_field(f, row[f]) for f in fields}
+
+    def get(self, fields: List[str], key: str, value: str) -> Dict[str, str]:
+        super()._verify_get_data(fields, key, value)
+        with self._db_lock:
+            res = self._db.execute("SELECT offset FROM rows WHERE key=? AND value=?", (key, value)).fetchone()
+        if res is None:
+            return {}
+        return self._get_row(fields, res[0])
+
+    def get_many(self, fields: List[str], key: str, values: Iterable[str]) -> Dict[str, Dict[str, str]]:
+        """Get multiple card-individual fields for a batch of cards.
+
+        Args:
+                fields : list of valid field names such as 'ADM1', 'PIN1', ... which are to be obtained
+                key : look-up key to identify card data, such as 'ICCID'
+                values : values for look-up key to identify the cards
+        Returns:
+                dictionary of {value: {field: value}} for each card found
+        """
+        super()._verify_get_data(fields, key)
+        values = list(values)
+        found = []
+        # stay below the SQLite limit of host parameters per statement
+        with self._db_lock:
+            for i in range(0, len(values), 500):
+                chunk = values[i:i+500]
+                found += self._db.execute("SELECT value, offset FROM rows WHERE key=? AND value IN (%s)" %
+                                          ','.join('?' * len(chunk)), [key] + chunk).fetchall()
+        # read the rows in file order to make best use of the page cache
+        found.sort(key=lambda x: x[1])
+        return {value: self._get_row(fields, offset) for value, offset in found}
+
 
 def card_key_provider_register(provider: CardKeyProvider, provider_list=card_key_providers):
     """Register a new card key provider.
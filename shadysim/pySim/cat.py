@@ -18,15 +18,16 @@ as described in 3GPP TS 31.111."""
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from typing import List
+from typing import List, Optional
 from bidict import bidict
 from construct import Int8ub, Int16ub, Byte, Bytes, BitsInteger
 from construct import Struct, Enum, BitStruct, this
 from construct import GreedyBytes, Switch, GreedyRange, FlagsEnum
-from osmocom.tlv import TLV_IE, COMPR_TLV_IE, BER_TLV_IE, TLV_IE_Collection
+from osmocom.tlv import TLV_IE, COMPR_TLV_IE, BER_TLV_IE
 from osmocom.construct import PlmnAdapter, BcdAdapter, HexAdapter, GsmStringAdapter, TonNpi, GsmString
 from osmocom.utils import b2h
 from pySim.utils import dec_xplmn_w_act
+from pySim.compiled_tlv import CompiledTlvCollection, EncodeCacheMixin, compile_tlv_ies
 
 # Tag values as per TS 101 220 Table 7.23
 
@@ -67,13 +68,13 @@ TypeOfCommand = Enum(Int8ub, refresh=0x01, more_time=0x02, poll_interval=0x03, p
                      command_container=0x72, encapsulated_session_control=0x73)
 
 # TS 102 223 Section 8.6 + TS 31.111 Section 8.6
-class CommandDetails(COMPR_TLV_IE, tag=0x81):
+class CommandDetails(COMPR_TLV_IE, EncodeCacheMixin, tag=0x81):
     _construct = Struct('command_number'/Int8ub,
                         'type_of_command'/TypeOfCommand,
                         'command_qualifier'/Int8ub)
 
 # TS 102 223 Section 8.7
-class DeviceIdentities(COMPR_TLV_IE, tag=0x82):
+class DeviceIdentities(COMPR_TLV_IE, EncodeCacheMixin, tag=0x82):
     DEV_IDS = bidict({
         0x01: 'keypad',
         0x02: 'display',
@@ -141,7 +142,7 @@ class ResponseLength(COMPR_TLV_IE, tag=0x91):
                         'maximum_length'/Int8ub)
 
 # TS 102 223 Section 8.12
-class Result(COMPR_TLV_IE, tag=0x83):
+class Result(COMPR_TLV_IE, EncodeCacheMixin, tag=0x83):
     GeneralResult = Enum(Int8ub,
                          # '0X' and '1X' indicate that the command has been performed
                          performed_successfully=0,
@@ -949,7 +950,7 @@ class ProactiveCmd(BER_TLV_IE):
         return 0xD0
 
 
-class EventCollection(TLV_IE_Collection,
+class EventCollection(CompiledTlvCollection,
                       nested=[SMSPPDownload, SMSCBDownload,
                               EventDownload, CallControl, MoShortMessageControl,
                               USSDDownload, GeographicalLocation, ProSeReport]):
@@ -1218,7 +1219,7 @@ class ProactiveCommandBase(BER_TLV_IE, tag=0xD0, nested=[CommandDetails]):
             else:
                 return None
 
-class ProactiveCommand(TLV_IE_Collection,
+class ProactiveCommand(CompiledTlvCollection,
                        nested=[Refresh, MoreTime, PollInterval, PollingOff, SetUpEventList, SetUpCall,
                                SendSS, SendUSSD, SendShortMessage, SendDTMF, LaunchBrowser,
                                GeographicalLocationRequest, PlayTone, DisplayText, GetInkey, GetInput,
@@ -1234,7 +1235,26 @@ class ProactiveCommand(TLV_IE_Collection,
     more difficult than any normal TLV IE Collection, because the content of one of the IEs defines the
     definitions of all the other IEs.  So we first need to find the CommandDetails, and then parse according
     to the command type indicated in that IE data."""
+    @staticmethod
+    def _peek_type_of_command(binary: bytes) -> Optional[int]:
+        """Return the Type of Command from the CommandDetails, which normally are the first IE within
+        the proactive command (TS 102 223 Section 6.6), without decoding anything else."""
+        if len(binary) < 2 or binary[0] != 0xD0:
+            return None
+        # skip the BER-TLV length of the proactive command
+        i = 2 if binary[1] < 0x80 else 2 + (binary[1] & 0x7f)
+        if binary[i:i+2] not in [b'\x81\x03', b'\x01\x03'] or len(binary) < i + 5:
+            return None
+        return binary[i+3]
+
     def from_bytes(self, binary: bytes, context: dict = {}) -> List[TLV_IE]:
+        # fast path: dispatch on the CommandDetails at the start of the proactive command
+        cmd_type = self._peek_type_of_command(binary)
+        if cmd_type in self.members_by_tag:
+            inst = self.members_by_tag[cmd_type]()
+            _dec, remainder = inst.from_tlv(binary)
+            self.decoded = inst
+            return self.decoded
         # do a first parse step to get the CommandDetails
         pcmd = ProactiveCommandBase()
         pcmd.from_tlv(binary)
@@ -1260,7 +1280,7 @@ class ProactiveCommand(TLV_IE_Collection,
         return self.decoded.to_tlv()
 
 # TS 101 223 Section 6.8.0
-class TerminalResponse(TLV_IE_Collection,
+class TerminalResponse(CompiledTlvCollection,
                        nested=[CommandDetails, DeviceIdentities, Result,
                                Duration, TextString, ItemIdentifier,
                                #TODO: LocalInformation and other optional/conditional IEs
@@ -1269,6 +1289,9 @@ class TerminalResponse(TLV_IE_Collection,
                                ]):
     pass
 
+# use pre-compiled lookup tables for the nested IEs of all of the above
+compile_tlv_ies(globals())
+
 # reasonable default for playing with OTA
 # 010203040506070809101112131415161718192021222324252627282930313233
 # '7fe1e10e000000000000001f43000000ff00000000000000000000000000000000'
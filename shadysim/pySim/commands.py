@@ -21,15 +21,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from typing import List, Tuple
+from typing import List, Tuple, Optional, Dict, Iterable, Iterator
 import typing # construct also has a Union, so we do typing.Union below
 from construct import Construct, Struct, Const, Select
 from construct import Optional as COptional
 from osmocom.construct import LV, filter_dict
 from osmocom.utils import rpad, lpad, b2h, h2b, h2i, i2h, str_sanitize, Hexstr
-from osmocom.tlv import bertlv_encode_len
+from osmocom.tlv import bertlv_encode_len, bertlv_parse_len, bertlv_parse_tag_raw
 
-from pySim.utils import sw_match, expand_hex, SwHexstr, ResTuple, SwMatchstr
+from pySim.utils import sw_match, expand_hex, SwHexstr, ResTuple, ResTupleBin, SwMatchstr
+from pySim.utils import build_command_apdu, atr_supports_extended_length, ef_atr_extended_length
 from pySim.exceptions import SwMatchError
 from pySim.transport import LinkBase
 
@@ -59,6 +60,13 @@ def cla_with_lchan(cla_byte: Hexstr, lchan_nr: int) -> Hexstr:
     cla_int = h2i(cla_byte)[0]
     return i2h([lchan_nr_to_cla(cla_int, lchan_nr)])
 
+def apdu_with_lchan(apdu: bytes, lchan_nr: int) -> bytes:
+    """Embed a logical channel number into the CLA byte of a binary APDU."""
+    cla = lchan_nr_to_cla(apdu[0], lchan_nr)
+    if cla == apdu[0]:
+        return apdu
+    return bytes([cla]) + apdu[1:]
+
 class SimCardCommands:
     """Class providing methods for various card-specific commands such as SELECT, READ BINARY, etc.
     Historically one instance exists below CardBase, but with the introduction of multiple logical
@@ -71,12 +79,26 @@ class SimCardCommands:
         # invokes the setter below
         self.cla_byte = "a0"
         self.scp = None # Secure Channel Protocol
+        # (max. command data length, max. response data length) if extended length APDUs are used
+        self.ext_len = None
+        # EF.ATR is still to be read by probe_extended_length (see defer there)
+        self._ef_atr_pending = False
+        # parsed FCP templates, by their hex string
+        self._fcp_cache = {}
+        # select several levels of a path with one SELECT by path, if the card supports it
+        self.use_select_by_path = True
+        # address EFs by their SFI instead of selecting them, if possible (see sfi_usable)
+        self.use_sfi = True
 
     def fork_lchan(self, lchan_nr: int) -> 'SimCardCommands':
         """Fork a per-lchan specific SimCardCommands instance off the current instance."""
         ret = SimCardCommands(transport = self._tp, lchan_nr = lchan_nr)
         ret.cla_byte = self.cla_byte
         ret.sel_ctrl = self.sel_ctrl
+        ret.ext_len = self.ext_len
+        ret._ef_atr_pending = self._ef_atr_pending
+        ret.use_select_by_path = self.use_select_by_path
+        ret.use_sfi = self.use_sfi
         return ret
 
     @property
@@ -87,6 +109,63 @@ class SimCardCommands:
         else:
             return 255
 
+    @property
+    def max_cmd_data_len(self) -> int:
+        """Maximum length of the command apdu data section, using extended length APDUs if possible."""
+        # the secure channel protocols only support short APDUs
+        if self.ext_len and not self.scp:
+            return self.ext_len[0]
+        return self.max_cmd_len
+
+    @property
+    def max_rsp_data_len(self) -> int:
+        """Maximum length of the response apdu data section, using extended length APDUs if possible."""
+        if self.ext_len and not self.scp:
+            return self.ext_len[1]
+        return self.max_cmd_len
+
+    def probe_extended_length(self, read_ef_atr: bool = True,
+                              defer: bool = False) -> Optional[Tuple[int, int]]:
+        """Determine whether extended length APDUs can be used with the card, and if so, enable their
+        use (see also ext_len).  This requires a transport that supports them (like PC/SC with T=1)
+        and a card that indicates support in the card capabilities of its ATR or of EF.ATR.
+
+        Args:
+                read_ef_atr : read EF.ATR for the card capabilities and extended length information
+                defer : do not read EF.ATR now, but only once a READ/UPDATE BINARY exceeds the limits
+                        of a short APDU; until then, only short APDUs are used
+        Returns:
+                (max. command data length, max. response data length) if supported, None otherwise
+        """
+        self.ext_len = None
+        self._ef_atr_pending = False
+        if not self._tp.supports_extended_length:
+            return None
+        if read_ef_atr and defer:
+            self._ef_atr_pending = True
+            return None
+        ext_len = None
+        if read_ef_atr:
+            try:
+                data, _sw = self.read_binary(['3f00', '2f01'])
+                if data:
+                    ext_len = ef_atr_extended_length(h2b(data))
+            except SwMatchError:
+                pass
+        if ext_len is None and atr_supports_extended_length(h2b(self.get_atr())):
+            ext_len = (65535, 65536)
+        if ext_len and min(ext_len) > 255:
+            self.ext_len = ext_len
+        return self.ext_len
+
+    def __probe_deferred(self, length: Optional[int]) -> bool:
+        """Complete a deferred probe_extended_length() if a transfer of the given length needs more
+        than a short APDU.  Returns True if EF.ATR has been read, which changes the selected file."""
+        if not self._ef_atr_pending or length is None or length <= self.max_cmd_len:
+            return False
+        self.probe_extended_length()
+        return True
+
     def send_apdu(self, pdu: Hexstr, apply_lchan:bool = True) -> ResTuple:
         """Sends an APDU and auto fetch response data
 
@@ -98,12 +177,26 @@ class SimCardCommands:
                         data : string (in hex) of returned data (ex. "074F4EFFFF")
                         sw   : string (in hex) of status word (ex. "9000")
         """
+        (data, sw) = self.send_apdu_bin(h2b(pdu), apply_lchan = apply_lchan)
+        return b2h(data), sw
+
+    def send_apdu_bin(self, pdu: bytes, apply_lchan:bool = True) -> ResTupleBin:
+        """Sends an APDU and auto fetch response data (binary variant of send_apdu)
+
+        Args:
+           pdu : bytes/bytearray/memoryview of the APDU
+           apply_lchan : apply the currently selected lchan to the CLA byte before sending
+        Returns:
+           tuple(data, sw), where
+                        data : bytes of returned data
+                        sw   : string (in hex) of status word (ex. "9000")
+        """
         if apply_lchan:
-            pdu = cla_with_lchan(pdu[0:2], self.lchan_nr) + pdu[2:]
+            pdu = apdu_with_lchan(pdu, self.lchan_nr)
         if self.scp:
-            return self.scp.send_apdu_wrapper(self._tp.send_apdu, pdu)
+            return self.scp.send_apdu_wrapper_bin(self._tp.send_apdu_bin, pdu)
         else:
-            return self._tp.send_apdu(pdu)
+            return self._tp.send_apdu_bin(pdu)
 
     def send_apdu_checksw(self, pdu: Hexstr, sw: SwMatchstr = "9000", apply_lchan:bool = True) -> ResTuple:
         """Sends an APDU and check returned SW
@@ -118,12 +211,28 @@ class SimCardCommands:
                         data : string (in hex) of returned data (ex. "074F4EFFFF")
                         sw   : string (in hex) of status word (ex. "9000")
         """
+        (data, sw) = self.send_apdu_checksw_bin(h2b(pdu), sw, apply_lchan = apply_lchan)
+        return b2h(data), sw
+
+    def send_apdu_checksw_bin(self, pdu: bytes, sw: SwMatchstr = "9000", apply_lchan:bool = True) -> ResTupleBin:
+        """Sends an APDU and check returned SW (binary variant of send_apdu_checksw)
+
+        Args:
+           pdu : bytes/bytearray/memoryview of the APDU
+           sw : string of 4 hexadecimal characters (ex. "9000"). The user may mask out certain
+                digits using a '?' to add some ambiguity if needed.
+           apply_lchan : apply the currently selected lchan to the CLA byte before sending
+        Returns:
+                tuple(data, sw), where
+                        data : bytes of returned data
+                        sw   : string (in hex) of status word (ex. "9000")
+        """
         if apply_lchan:
-            pdu = cla_with_lchan(pdu[0:2], self.lchan_nr) + pdu[2:]
+            pdu = apdu_with_lchan(pdu, self.lchan_nr)
         if self.scp:
-            return self.scp.send_apdu_wrapper(self._tp.send_apdu_checksw, pdu, sw)
+            return self.scp.send_apdu_wrapper_bin(self._tp.send_apdu_checksw_bin, pdu, sw)
         else:
-            return self._tp.send_apdu_checksw(pdu, sw)
+            return self._tp.send_apdu_checksw_bin(pdu, sw)
 
     def send_apdu_constr(self, cla: Hexstr, ins: Hexstr, p1: Hexstr, p2: Hexstr, cmd_constr: Construct,
                          cmd_data: Hexstr, resp_constr: Construct, apply_lchan:bool = True) -> Tuple[dict, SwHexstr]:
@@ -178,37 +287,45 @@ class SimCardCommands:
 
     # Extract a single FCP item from TLV
     def __parse_fcp(self, fcp: Hexstr):
+        parsed = self._fcp_cache.get(fcp, None)
+        if parsed is None:
+            parsed = self.__parse_fcp_uncached(fcp)
+            if len(self._fcp_cache) >= 256:
+                self._fcp_cache.clear()
+            self._fcp_cache[fcp] = parsed
+        return parsed
+
+    def __parse_fcp_uncached(self, fcp: Hexstr):
         # see also: ETSI TS 102 221, chapter 11.1.1.3.1 Response for MF,
         # DF or ADF
-        from pytlv.TLV import TLV
-        tlvparser = TLV(['82', '83', '84', 'a5', '8a', '8b',
-                        '8c', '80', 'ab', 'c6', '81', '88'])
-
-        # pytlv is case sensitive!
-        fcp = fcp.lower()
-
-        if fcp[0:2] != '62':
+        fcp_bin = h2b(fcp)
+        if fcp_bin[0:1] != b'\x62':
             raise ValueError(
                 'Tag of the FCP template does not match, expected 62 but got %s' % fcp[0:2])
 
-        # Unfortunately the spec is not very clear if the FCP length is
-        # coded as one or two byte vale, so we have to try it out by
-        # checking if the length of the remaining TLV string matches
-        # what we get in the length field.
-        # See also ETSI TS 102 221, chapter 11.1.1.3.0 Base coding.
-        # TODO: this likely just is normal BER-TLV ("All data objects are BER-TLV except if otherwise # defined.")
-        exp_tlv_len = int(fcp[2:4], 16)
-        if len(fcp[4:]) // 2 == exp_tlv_len:
-            skip = 4
-        else:
-            exp_tlv_len = int(fcp[2:6], 16)
-            if len(fcp[4:]) // 2 == exp_tlv_len:
-                skip = 6
-            raise ValueError('Cannot determine length of TLV-length')
-
-        # Skip FCP tag and length
-        tlv = fcp[skip:]
-        return tlvparser.parse(tlv)
+        # The FCP template and the data objects in it are BER-TLV coded, so lengths above 127 bytes
+        # are coded as 81xx or 82xxxx.  See also ETSI TS 102 221, chapter 11.1.1.3.0 Base coding.
+        exp_tlv_len, tlv = bertlv_parse_len(fcp_bin[1:])
+        if len(tlv) != exp_tlv_len:
+            raise ValueError('Length of the FCP template does not match, expected %u but got %u'
+                             % (exp_tlv_len, len(tlv)))
+
+        parsed = {}
+        while tlv:
+            raw_tag, remainder = bertlv_parse_tag_raw(tlv)
+            if raw_tag is None:
+                # padding
+                break
+            tag = b2h(tlv[:len(tlv) - len(remainder)])
+            if not remainder:
+                raise ValueError('Parse error: tag %s lacks a length' % tag)
+            length, remainder = bertlv_parse_len(remainder)
+            if length > len(remainder):
+                raise ValueError('Parse error: tag %s declared data of length %u, but actual data length is %u'
+                                 % (tag, length, len(remainder)))
+            parsed[tag] = b2h(remainder[:length])
+            tlv = remainder[length:]
+        return parsed
 
     # Tell the length of a record by the card response
     # USIMs respond with an FCP template, which is different
@@ -257,19 +374,162 @@ class SimCardCommands:
     def select_path(self, dir_list: Path) -> List[Hexstr]:
         """Execute SELECT for an entire list/path of FIDs.
 
+        If the path starts at the MF and is already selected on this lchan, the SELECT commands are
+        skipped and the responses of the previous selection are returned.  The transport forgets the
+        selection on a reset/reconnect and on any command which may change the selected file (see
+        LinkBase._track_selection).
+
+        As an ADF can be selected from anywhere, the elements in front of the last ADF in the path
+        are not selected.  On a UICC, several FIDs in a row starting at the MF or at an ADF are
+        selected with a single SELECT by path; the responses for the files skipped in between are
+        None.
+
         Args:
-                dir_list: list of FIDs representing the path to select
+                dir_list: list of FIDs (or AIDs of ADFs) representing the path to select
 
         Returns:
                 list of return values (FCP in hex encoding) for each element of the path
         """
-        rv = []
         if not isinstance(dir_list, list):
             dir_list = [dir_list]
-        for i in dir_list:
-            data, _sw = self.select_file(i)
-            rv.append(data)
-        return rv
+        key = (tuple(fid.lower() for fid in dir_list), self.cla_byte, self.sel_ctrl)
+        selected = self._tp.selected_paths.get(self.lchan_nr, None)
+        # the FCP of a file which became the current one by SFI access (see sfi_usable) may be unknown
+        if selected and selected[0] == key and selected[1][-1] is not None:
+            return list(selected[1])
+        start = 0
+        for n, i in enumerate(key[0]):
+            if len(i) > 4:
+                start = n
+        rv = [None] * start
+        n = start
+        while n < len(dir_list):
+            if len(dir_list[n]) > 4:
+                data, _sw = self.select_adf(dir_list[n])
+                rv.append(data)
+                n += 1
+                continue
+            run = []
+            while n + len(run) < len(dir_list) and len(dir_list[n + len(run)]) <= 4:
+                run.append(dir_list[n + len(run)])
+            data = None
+            if self.supports_select_by_path and len(run) >= 2 and (n > 0 or key[0][0] == '3f00'):
+                try:
+                    if n == 0:
+                        data, _sw = self.select_by_path(run[1:])
+                    else:
+                        data, _sw = self.select_by_path(run, from_mf=False)
+                    rv += [None] * (len(run) - 1) + [data]
+                except SwMatchError as swm:
+                    if swm.sw_actual == '6a82':
+                        raise swm
+                    # not supported by the card (as we use it)
+                    self.use_select_by_path = False
+            if data is None:
+                for i in run:
+                    data, _sw = self.select_file(i)
+                    rv.append(data)
+            n += len(run)
+        if key[0] and key[0][0] == '3f00':
+            self._tp.selected_paths[self.lchan_nr] = (key, rv)
+            self.__remember_fcp(key, rv[-1])
+        return list(rv)
+
+    def set_selected_path(self, dir_list: List[Hexstr], fcp: Hexstr):
+        """Record that the file at the given MF-rooted path has been selected on this lchan by other
+        means than select_path (e.g. by the RuntimeLchan), so that select_path() can skip the SELECT
+        commands for it.
+
+        Args:
+                dir_list: list of FIDs (or AIDs of ADFs) representing the path of the selected file
+                fcp: SELECT response (FCP in hex encoding) of the selected file
+        """
+        key = (tuple(fid.lower() for fid in dir_list), self.cla_byte, self.sel_ctrl)
+        self._tp.selected_paths[self.lchan_nr] = (key, [None] * (len(dir_list) - 1) + [fcp])
+        self.__remember_fcp(key, fcp)
+
+    def __remember_fcp(self, key, fcp: Optional[Hexstr]):
+        if fcp:
+            if len(self._tp.known_fcps) >= 256:
+                self._tp.known_fcps.clear()
+            self._tp.known_fcps[key] = fcp
+
+    def get_selected_path(self) -> Optional[List[Hexstr]]:
+        """Return the MF-rooted path of the file known to be selected on this lchan (see select_path),
+        or None if it is unknown."""
+        selected = self._tp.selected_paths.get(self.lchan_nr, None)
+        if not selected or selected[0][1:] != (self.cla_byte, self.sel_ctrl):
+            return None
+        return list(selected[0][0])
+
+    def get_known_fcp(self, dir_list: List[Hexstr]) -> Optional[Hexstr]:
+        """Return the SELECT response (FCP in hex encoding) of the file at the given MF-rooted path
+        from when it was last selected on this lchan, or None if it was not selected yet."""
+        key = (tuple(fid.lower() for fid in dir_list), self.cla_byte, self.sel_ctrl)
+        return self._tp.known_fcps.get(key, None)
+
+    def sfi_usable(self, ef: Path, sfi: Optional[int]) -> bool:
+        """Can the EF at the given MF-rooted path be addressed by its SFI instead of selecting it?
+
+        An SFI refers to an EF of the current DF (ETSI TS 102 221, section 8.4.2), so this is the case
+        on a UICC if the parent DF of the EF or an EF next to it is known to be selected on this lchan.
+        The SFI must have been confirmed by the card in the FCP of the EF (tag 88) when it was selected
+        before, as the SFI of the file system model may not be the one of the card.  If the EF itself
+        is selected, it is accessed without SFI.  If the card refuses the SFI access, the read/update
+        methods fall back to selecting the EF."""
+        if not isinstance(sfi, int) or not 0 < sfi < 31:
+            return False
+        if not self.use_sfi or self.sel_ctrl != "0004" or not isinstance(ef, list):
+            return False
+        if len(ef) < 2 or ef[0].lower() != '3f00':
+            return False
+        selected = self._tp.selected_paths.get(self.lchan_nr, None)
+        if not selected or selected[0][1:] != (self.cla_byte, self.sel_ctrl):
+            return False
+        sel_path = selected[0][0]
+        ef_path = tuple(fid.lower() for fid in ef)
+        if sel_path == ef_path:
+            return False
+        # See also ETSI TS 102 221, chapter 11.1.1.4.8 Short File Identifier
+        ef_fcp = self._tp.known_fcps.get((ef_path, self.cla_byte, self.sel_ctrl), None)
+        try:
+            sfi_do = self.__parse_fcp(ef_fcp).get('88', None) if ef_fcp else None
+        except ValueError:
+            sfi_do = None
+        if not sfi_do or int(sfi_do[0:2], 16) >> 3 != sfi:
+            return False
+        parent = ef_path[:-1]
+        if sel_path == parent:
+            return True
+        if sel_path[:-1] != parent:
+            return False
+        # the selected file is in the same DF; it must not be a DF itself
+        fcp = selected[1][-1]
+        if fcp is None:
+            # it became the current file by SFI access
+            return True
+        # See also ETSI TS 102 221, chapter 11.1.1.4.3 File Descriptor
+        file_descriptor = self.__parse_fcp(fcp).get('82', None)
+        return file_descriptor is not None and int(file_descriptor[0:2], 16) & 0x38 != 0x38
+
+    def __set_selected_by_sfi(self, ef: List[Hexstr]):
+        """Record that an SFI-addressed command has made the given EF the current file."""
+        key = (tuple(fid.lower() for fid in ef), self.cla_byte, self.sel_ctrl)
+        fcp = self._tp.known_fcps.get(key, None)
+        self._tp.selected_paths[self.lchan_nr] = (key, [None] * (len(ef) - 1) + [fcp])
+
+    def __select_in_current_df(self, ef: List[Hexstr]) -> List[Hexstr]:
+        """Select an EF by its FID after an access by SFI was refused or not possible: the DF of the
+        EF is still the current one (see sfi_usable), so there is no need to select the entire path."""
+        data, _sw = self.select_file(ef[-1])
+        self.set_selected_path(ef, data)
+        return [None] * (len(ef) - 1) + [data]
+
+    def invalidate_selection(self):
+        """Forget the file selected on this lchan (see select_path) and the FCPs of the files selected
+        so far, e.g. after the card has been accessed by other means."""
+        self._tp.selected_paths.pop(self.lchan_nr, None)
+        self._tp.known_fcps.clear()
 
     def select_file(self, fid: Hexstr) -> ResTuple:
         """Execute SELECT a given file by FID.
@@ -280,6 +540,22 @@ class SimCardCommands:
 
         return self.send_apdu_checksw(self.cla_byte + "a4" + self.sel_ctrl + "02" + fid + "00")
 
+    @property
+    def supports_select_by_path(self) -> bool:
+        """Can files be selected by path?  Supported by UICCs, but not by classic SIM cards."""
+        return self.use_select_by_path and self.sel_ctrl == "0004"
+
+    def select_by_path(self, path: List[Hexstr], from_mf: bool = True) -> ResTuple:
+        """Execute SELECT by path (ETSI TS 102 221, section 11.1.1.2).
+
+        Args:
+                path : list of FIDs of the path, without the FID of the MF / current DF
+                from_mf : path starts at the MF (P1=08) or at the current DF (P1=09)
+        """
+        p1 = "08" if from_mf else "09"
+        data = ''.join(path)
+        return self.send_apdu_checksw(self.cla_byte + "a4" + p1 + self.sel_ctrl[2:] + "%02x" % (len(data) // 2) + data + "00")
+
     def select_parent_df(self) -> ResTuple:
         """Execute SELECT to switch to the parent DF """
         return self.send_apdu_checksw(self.cla_byte + "a40304")
@@ -294,52 +570,86 @@ class SimCardCommands:
         aidlen = ("0" + format(len(aid) // 2, 'x'))[-2:]
         return self.send_apdu_checksw(self.cla_byte + "a4" + "0404" + aidlen + aid + "00")
 
-    def read_binary(self, ef: Path, length: int = None, offset: int = 0) -> ResTuple:
+    def read_binary(self, ef: Path, length: int = None, offset: int = 0,
+                    sfi: Optional[int] = None) -> ResTuple:
         """Execute READD BINARY.
 
         Args:
                 ef : string or list of strings indicating name or path of transparent EF
                 length : number of bytes to read
                 offset : byte offset in file from which to start reading
+                sfi : SFI of the EF, to read it without SELECT if possible (see sfi_usable)
         """
-        r = self.select_path(ef)
+        self.__probe_deferred(length)
+        if self.sfi_usable(ef, sfi) and offset < 256:
+            res = self.__read_binary_sfi(ef, sfi, length, offset)
+            if res is not None:
+                return res
+            r = self.__select_in_current_df(ef)
+        else:
+            r = self.select_path(ef)
         if len(r[-1]) == 0:
             return (None, None)
         if length is None:
             length = self.__len(r) - offset
         if length < 0:
             return (None, None)
+        if self.__probe_deferred(length):
+            r = self.select_path(ef)
 
-        total_data = ''
+        cla = h2b(self.cla_byte)[0]
+        total_data = bytearray()
         chunk_offset = 0
         while chunk_offset < length:
-            chunk_len = min(self.max_cmd_len, length-chunk_offset)
-            pdu = self.cla_byte + \
-                'b0%04x%02x' % (offset + chunk_offset, chunk_len)
+            chunk_len = min(self.max_rsp_data_len, length-chunk_offset)
+            pdu = build_command_apdu(bytes([cla, 0xb0]) + (offset + chunk_offset).to_bytes(2, 'big'), le=chunk_len)
             try:
-                data, sw = self.send_apdu_checksw(pdu)
+                data, sw = self.send_apdu_checksw_bin(pdu)
             except Exception as e:
                 e.add_note('failed to read (offset %d)' % offset)
                 raise e
             total_data += data
             chunk_offset += chunk_len
-        return total_data, sw
-
-    def __verify_binary(self, ef, data: str, offset: int = 0):
+        return b2h(total_data), sw
+
+    def __read_binary_sfi(self, ef: List[Hexstr], sfi: int, length: Optional[int],
+                          offset: int) -> Optional[ResTuple]:
+        """READ BINARY with the SFI of the EF in P1 (ETSI TS 102 221, section 11.1.3).  Returns None if
+        the data does not fit into one response or the card refuses, so that the EF must be selected."""
+        fcp = self.get_known_fcp(ef)
+        if length is None and fcp is not None:
+            length = self.__len([fcp]) - offset
+        max_len = min(self.max_rsp_data_len, 256)
+        if length is not None and not 0 < length <= max_len:
+            return None
+        cla = h2b(self.cla_byte)[0]
+        pdu = build_command_apdu(bytes([cla, 0xb0, 0x80 | sfi, offset]), le=length or max_len)
+        try:
+            data, sw = self.send_apdu_checksw_bin(pdu)
+        except SwMatchError:
+            return None
+        self.__set_selected_by_sfi(ef)
+        if length is None and len(data) >= max_len:
+            # the EF may well be longer than what we got
+            return None
+        return b2h(data), sw
+
+    def __verify_binary(self, ef, data: str, offset: int = 0, sfi: Optional[int] = None):
         """Verify contents of transparent EF.
 
         Args:
                 ef : string or list of strings indicating name or path of transparent EF
                 data : hex string of expected data
                 offset : byte offset in file from which to start verifying
+                sfi : SFI of the EF (see read_binary)
         """
-        res = self.read_binary(ef, len(data) // 2, offset)
+        res = self.read_binary(ef, len(data) // 2, offset, sfi)
         if res[0].lower() != data.lower():
             raise ValueError('Binary verification failed (expected %s, got %s)' % (
                 data.lower(), res[0].lower()))
 
     def update_binary(self, ef: Path, data: Hexstr, offset: int = 0, verify: bool = False,
-                      conserve: bool = False) -> ResTuple:
+                      conserve: bool = False, sfi: Optional[int] = None) -> ResTuple:
         """Execute UPDATE BINARY.
 
         Args:
@@ -347,17 +657,19 @@ class SimCardCommands:
                 data : hex string of data to be written
                 offset : byte offset in file from which to start writing
                 verify : Whether or not to verify data after write
+                sfi : SFI of the EF, to update it without SELECT if possible (see sfi_usable)
         """
 
-        file_len = self.binary_size(ef)
-        data = expand_hex(data, file_len)
+        if '.' in data:
+            data = expand_hex(data, self.binary_size(ef))
 
         data_length = len(data) // 2
+        self.__probe_deferred(data_length)
 
         # Save write cycles by reading+comparing before write
         if conserve:
             try:
-                data_current, sw = self.read_binary(ef, data_length, offset)
+                data_current, sw = self.read_binary(ef, data_length, offset, sfi)
                 if data_current == data:
                     return None, sw
             except Exception:
@@ -367,53 +679,85 @@ class SimCardCommands:
                 # any such exception during READ.
                 pass
 
-        self.select_path(ef)
+        cla = h2b(self.cla_byte)[0]
+        data_bin = memoryview(h2b(data))
+        if self.sfi_usable(ef, sfi) and offset < 256 and 0 < data_length <= self.max_cmd_data_len:
+            # UPDATE BINARY with the SFI of the EF in P1 (ETSI TS 102 221, section 11.1.4)
+            pdu = build_command_apdu(bytes([cla, 0xd6, 0x80 | sfi, offset]), data_bin)
+            try:
+                _data, sw = self.send_apdu_checksw_bin(pdu)
+            except SwMatchError:
+                pass
+            else:
+                self.__set_selected_by_sfi(ef)
+                if verify:
+                    self.__verify_binary(ef, data, offset, sfi)
+                return data, sw
+            self.__select_in_current_df(ef)
+        else:
+            self.select_path(ef)
         total_data = ''
         chunk_offset = 0
         while chunk_offset < data_length:
-            chunk_len = min(self.max_cmd_len, data_length - chunk_offset)
-            # chunk_offset is bytes, but data slicing is hex chars, so we need to multiply by 2
-            pdu = self.cla_byte + \
-                'd6%04x%02x' % (offset + chunk_offset, chunk_len) + \
-                data[chunk_offset*2: (chunk_offset+chunk_len)*2]
+            chunk_len = min(self.max_cmd_data_len, data_length - chunk_offset)
+            pdu = build_command_apdu(bytes([cla, 0xd6]) + (offset + chunk_offset).to_bytes(2, 'big'),
+                                     data_bin[chunk_offset:chunk_offset+chunk_len])
             try:
-                chunk_data, chunk_sw = self.send_apdu_checksw(pdu)
+                chunk_data, chunk_sw = self.send_apdu_checksw_bin(pdu)
             except Exception as e:
                 e.add_note('failed to write chunk (chunk_offset %d, chunk_len %d)' % (chunk_offset, chunk_len))
                 raise e
             total_data += data
             chunk_offset += chunk_len
         if verify:
-            self.__verify_binary(ef, data, offset)
+            self.__verify_binary(ef, data, offset, sfi)
         return total_data, chunk_sw
 
-    def read_record(self, ef: Path, rec_no: int) -> ResTuple:
+    def read_record(self, ef: Path, rec_no: int, sfi: Optional[int] = None) -> ResTuple:
         """Execute READ RECORD.
 
         Args:
                 ef : string or list of strings indicating name or path of linear fixed EF
                 rec_no : record number to read
+                sfi : SFI of the EF, to read it without SELECT if possible (see sfi_usable)
         """
-        r = self.select_path(ef)
+        if self.sfi_usable(ef, sfi):
+            # READ RECORD with the SFI of the EF in P2 (ETSI TS 102 221, section 11.1.5); without
+            # knowing the record length, Le=00 asks for the entire record
+            fcp = self.get_known_fcp(ef)
+            rec_length = self.__record_len([fcp]) if fcp else 0
+            try:
+                data, sw = self.send_apdu_checksw(self.cla_byte + 'b2%02x%02x%02x' % (rec_no, sfi << 3 | 0x04,
+                                                                                    rec_length))
+            except SwMatchError:
+                pass
+            else:
+                self.__set_selected_by_sfi(ef)
+                return data, sw
+            r = self.__select_in_current_df(ef)
+        else:
+            r = self.select_path(ef)
         rec_length = self.__record_len(r)
         pdu = self.cla_byte + 'b2%02x04%02x' % (rec_no, rec_length)
         return self.send_apdu_checksw(pdu)
 
-    def __verify_record(self, ef: Path, rec_no: int, data: str):
+    def __verify_record(self, ef: Path, rec_no: int, data: str, sfi: Optional[int] = None):
         """Verify record against given data
 
         Args:
                 ef : string or list of strings indicating name or path of linear fixed EF
                 rec_no : record number to read
                 data : hex string of data to be verified
+                sfi : SFI of the EF (see read_record)
         """
-        res = self.read_record(ef, rec_no)
+        res = self.read_record(ef, rec_no, sfi)
         if res[0].lower() != data.lower():
             raise ValueError('Record verification failed (expected %s, got %s)' % (
                 data.lower(), res[0].lower()))
 
     def update_record(self, ef: Path, rec_no: int, data: Hexstr, force_len: bool = False,
-                      verify: bool = False, conserve: bool = False, leftpad: bool = False) -> ResTuple:
+                      verify: bool = False, conserve: bool = False, leftpad: bool = False,
+                      sfi: Optional[int] = None) -> ResTuple:
         """Execute UPDATE RECORD.
 
         Args:
@@ -424,10 +768,54 @@ class SimCardCommands:
                 verify : verify data by re-reading the record
                 conserve : read record and compare it with data, skip write on match
                 leftpad : apply 0xff padding from the left instead from the right side.
+                sfi : SFI of the EF, to update it without SELECT if possible (see sfi_usable)
         """
 
-        res = self.select_path(ef)
-        rec_length = self.__record_len(res)
+        # the record length is needed unless it is given by the data
+        fcp = self.get_known_fcp(ef) if isinstance(ef, list) else None
+        if not self.sfi_usable(ef, sfi) or (not fcp and (not force_len or '.' in data)):
+            sfi = None
+            fcp = self.select_path(ef)[-1]
+        data, rec_length = self.__expand_record(data, self.__record_len([fcp]) if fcp else 0,
+                                                force_len, leftpad)
+
+        # Save write cycles by reading+comparing before write
+        if conserve:
+            try:
+                data_current, sw = self.read_record(ef, rec_no, sfi)
+                data_current = data_current[0:rec_length*2]
+                if data_current == data:
+                    return None, sw
+            except Exception:
+                # cannot read data. This is not a fatal error, as reading is just done to
+                # conserve the amount of smart card writes.  The access conditions of the file
+                # may well permit us to UPDATE but not permit us to READ.  So let's ignore
+                # any such exception during READ.
+                pass
+
+        if sfi is not None:
+            # UPDATE RECORD with the SFI of the EF in P2 (ETSI TS 102 221, section 11.1.6)
+            pdu = (self.cla_byte + 'dc%02x%02x%02x' % (rec_no, sfi << 3 | 0x04, rec_length)) + data
+            try:
+                res = self.send_apdu_checksw(pdu)
+            except SwMatchError:
+                pass
+            else:
+                self.__set_selected_by_sfi(ef)
+                if verify:
+                    self.__verify_record(ef, rec_no, data, sfi)
+                return res
+            self.__select_in_current_df(ef)
+        pdu = (self.cla_byte + 'dc%02x04%02x' % (rec_no, rec_length)) + data
+        res = self.send_apdu_checksw(pdu)
+        if verify:
+            self.__verify_record(ef, rec_no, data, sfi)
+        return res
+
+    @staticmethod
+    def __expand_record(data: Hexstr, rec_length: int, force_len: bool = False,
+                        leftpad: bool = False) -> Tuple[Hexstr, int]:
+        """Expand/pad the data to be written to a record; returns the data and its length."""
         data = expand_hex(data, rec_length)
 
         if force_len:
@@ -444,26 +832,104 @@ class SimCardCommands:
                     data = lpad(data, rec_length * 2)
                 else:
                     data = rpad(data, rec_length * 2)
+        return data, rec_length
+
+    def __search_empty_records(self, rec_length: int, num_records: int) -> Optional[set]:
+        """Locate the records of the currently selected EF which consist of 0xFF only, using SEARCH
+        RECORD.  Returns None if the card does not support this."""
+        # SEARCH RECORD of TS 102 221 (GSM 11.11 SEEK has different semantics) can report at most
+        # 254 one-byte record numbers
+        if self.sel_ctrl != "0004" or num_records > 254 or rec_length > 255:
+            return None
+        # TS 102 221 Section 11.1.7: simple search forward from record 1 for a record full of 0xFF
+        pdu = self.cla_byte + 'a20104%02x' % rec_length + 'ff' * rec_length + '00'
+        data, sw = self.send_apdu(pdu)
+        # 6282: end of file reached before finding a match
+        if sw not in ['9000', '6282']:
+            return None
+        return set(h2b(data))
+
+    def __read_records(self, rec_nos: Iterable[int], rec_length: int,
+                       empty: Optional[set] = None) -> Iterator[Tuple[int, ResTuple]]:
+        """READ RECORD (absolute mode) of the given records of the currently selected EF."""
+        for rec_no in rec_nos:
+            if empty is not None and rec_no in empty:
+                continue
+            res = self.send_apdu_checksw(self.cla_byte + 'b2%02x04%02x' % (rec_no, rec_length))
+            yield rec_no, res
+
+    def read_records(self, ef: Path, rec_nos: Optional[Iterable[int]] = None,
+                     skip_empty: bool = False) -> Iterator[Tuple[int, ResTuple]]:
+        """Execute READ RECORD for several records of an EF, selecting it only once.
+
+        The records are read as the returned iterator is consumed; other commands must not be sent
+        on this lchan in between.
+
+        Args:
+                ef : string or list of strings indicating name or path of linear fixed EF
+                rec_nos : record numbers to read (default: all records of the EF)
+                skip_empty : skip records consisting of 0xFF only; where supported by the card, they
+                             are located using SEARCH RECORD and not read at all
+        Returns:
+                iterator of (record number, (data, sw)) tuples
+        """
+        r = self.select_path(ef)
+        rec_length = self.__record_len(r)
+        num_records = self.__len(r) // rec_length
+        if rec_nos is None:
+            rec_nos = range(1, num_records + 1)
+        empty = None
+        if skip_empty:
+            empty = self.__search_empty_records(rec_length, num_records)
+        for rec_no, res in self.__read_records(rec_nos, rec_length, empty):
+            if skip_empty and not res[0].lower().strip('f'):
+                continue
+            yield rec_no, res
+
+    def update_records(self, ef: Path, records: Dict[int, Hexstr], force_len: bool = False,
+                       verify: bool = False, conserve: bool = False,
+                       leftpad: bool = False) -> Dict[int, ResTuple]:
+        """Execute UPDATE RECORD for several records of an EF, selecting it only once.
+
+        Args:
+                ef : string or list of strings indicating name or path of linear fixed EF
+                records : dict of hex strings of data to be written, by record number
+                force_len : enforce record length by using the actual data length
+                verify : verify data by re-reading the records
+                conserve : read records and compare them with data, skip writes on match
+                leftpad : apply 0xff padding from the left instead from the right side.
+        Returns:
+                dict of the results of the UPDATE RECORD commands by record number; (None, sw) for
+                records which were not written as they already contained the data (see conserve)
+        """
+        r = self.select_path(ef)
+        rec_length = self.__record_len(r)
+        expanded = {rec_no: self.__expand_record(data, rec_length, force_len, leftpad)
+                    for rec_no, data in records.items()}
 
         # Save write cycles by reading+comparing before write
+        current = {}
         if conserve:
             try:
-                data_current, sw = self.read_record(ef, rec_no)
-                data_current = data_current[0:rec_length*2]
-                if data_current == data:
-                    return None, sw
+                for rec_no, res in self.__read_records(sorted(expanded), rec_length):
+                    current[rec_no] = res
             except Exception:
-                # cannot read data. This is not a fatal error, as reading is just done to
-                # conserve the amount of smart card writes.  The access conditions of the file
-                # may well permit us to UPDATE but not permit us to READ.  So let's ignore
-                # any such exception during READ.
+                # cannot read (all) data; see update_record() for why this is not fatal
                 pass
 
-        pdu = (self.cla_byte + 'dc%02x04%02x' % (rec_no, rec_length)) + data
-        res = self.send_apdu_checksw(pdu)
+        rv = {}
+        for rec_no, (data, length) in expanded.items():
+            if rec_no in current and current[rec_no][0][0:length*2] == data:
+                rv[rec_no] = (None, current[rec_no][1])
+                continue
+            pdu = (self.cla_byte + 'dc%02x04%02x' % (rec_no, length)) + data
+            rv[rec_no] = self.send_apdu_checksw(pdu)
         if verify:
-            self.__verify_record(ef, rec_no, data)
-        return res
+            for rec_no, (data, _sw) in self.__read_records(sorted(expanded), rec_length):
+                if data.lower() != expanded[rec_no][0].lower():
+                    raise ValueError('Record %u verification failed (expected %s, got %s)' % (
+                        rec_no, expanded[rec_no][0].lower(), data.lower()))
+        return rv
 
     def record_size(self, ef: Path) -> int:
         """Determine the record size of given file.
@@ -494,6 +960,14 @@ class SimCardCommands:
 
     # TS 102 221 Section 11.3.1 low-level helper
     def _retrieve_data(self, tag: int, first: bool = True) -> ResTuple:
+        if self.max_rsp_data_len > 256:
+            # request as much data as possible per command via extended Le
+            if first:
+                pdu = build_command_apdu(b'\x80\xcb\x00\x80', bytes([tag]), self.max_rsp_data_len)
+            else:
+                pdu = build_command_apdu(b'\x80\xcb\x00\x00', le=self.max_rsp_data_len)
+            data, sw = self.send_apdu_checksw_bin(pdu)
+            return b2h(data), sw
         if first:
             pdu = '80cb008001%02x00' % (tag)
         else:
@@ -0,0 +1,245 @@
+# coding=utf-8
+"""Fast path for the osmocom.tlv TLV_IE / TLV_IE_Collection classes used in CAT and GlobalPlatform.
+
+A TLV_IE_Collection builds its tag and name lookup tables (converting each member class name to
+snake case) whenever it is instantiated, and each constructed IE instantiates its nested collection.
+Decoding walks the input by slicing off the remainder after each IE.  The CompiledTlvCollection
+defined here computes the lookup tables once per class and decodes by moving an offset over a
+memoryview of the input, copying only the value part of each IE.  compile_tlv_ies() switches the
+nested collections of existing TLV_IE classes over to it.
+
+EncodeCacheMixin memoises the encoding of IEs whose value is frequently encoded with the same
+contents (like CommandDetails or DeviceIdentities of a TERMINAL RESPONSE).
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import inspect
+from typing import List
+
+from osmocom.tlv import TLV_IE, BER_TLV_IE, COMPR_TLV_IE, TLV_IE_Collection, camel_to_snake
+
+# formats of the collections we can decode ourselves
+_FMT_BER = 1
+_FMT_COMPR = 2
+
+# classes for unknown tags, by (base class, tag)
+_unknown_classes = {}
+
+def _unknown_class(base: type, tag: int) -> type:
+    """Return the class used to represent an IE with unknown tag; equivalent to the class which
+    TLV_IE_Collection.from_bytes() creates for each such IE."""
+    cls = _unknown_classes.get((base, tag), None)
+    if cls is None:
+        name = 'unknown_%s_%X' % (base.__name__, tag)
+        cls = type(name, (base,), {'tag': tag, 'possible_nested': [], 'nested_collection_cls': None})
+        cls._from_bytes = lambda s, a: {'raw': a.hex()}
+        cls._to_bytes = lambda s: bytes.fromhex(s.decoded['raw'])
+        _unknown_classes[(base, tag)] = cls
+    return cls
+
+
+class CompiledTlvCollection(TLV_IE_Collection):
+    """TLV_IE_Collection with per-class lookup tables and an offset-based BER/COMPREHENSION-TLV
+    decoder.  Behaves exactly like TLV_IE_Collection."""
+    # lookup tables of the class; built on first instantiation
+    _tables = None
+
+    def __init__(self, desc=None, **kwargs):
+        if 'nested' in kwargs:
+            # ad-hoc members, no per-class tables
+            super().__init__(desc, **kwargs)
+            return
+        tables = type(self).__dict__.get('_tables', None)
+        if tables is None:
+            tables = type(self)._compile_tables()
+        self.desc = desc
+        self.members = self.possible_nested
+        self.members_by_tag, self.members_by_name, self._fmt = tables
+        # if we are a constructed IE, [ordered] list of actual child-IE instances
+        self.children = kwargs.get('children', [])
+        self.encoded = None
+
+    @classmethod
+    def _compile_tables(cls):
+        members = cls.possible_nested or []
+        # all members must share the format, as we parse all tags like the first member would
+        fmt = None
+        if members and all(issubclass(m, COMPR_TLV_IE) for m in members):
+            fmt = _FMT_COMPR
+        elif members and all(issubclass(m, BER_TLV_IE) for m in members):
+            fmt = _FMT_BER
+        cls._tables = ({m.tag: m for m in members}, {camel_to_snake(m.__name__): m for m in members}, fmt)
+        return cls._tables
+
+    def from_bytes(self, binary: bytes, context: dict = {}) -> List[TLV_IE]:
+        """Create a list of TLV_IEs from the collection based on binary input data.
+        Args:
+            binary : binary bytes of encoded data
+        Returns:
+            list of instances of TLV_IE sub-classes containing parsed data
+        """
+        fmt = getattr(self, '_fmt', None)
+        if fmt is None:
+            return super().from_bytes(binary, context=context)
+        self.encoded = binary
+        # TLV_IE_Collection derives the classes for unknown tags from the base of the first member
+        # (which may be a mixin)
+        base = COMPR_TLV_IE if fmt == _FMT_COMPR else BER_TLV_IE
+        buf = memoryview(binary)
+        end = len(buf)
+        res = []
+        i = 0
+        while i < end:
+            context['siblings'] = res
+            # tag
+            tag = buf[i]
+            j = i + 1
+            if fmt == _FMT_COMPR:
+                # ETSI TS 101 220 Section 7.1.1
+                if tag in [0x00, 0x80, 0xff]:
+                    raise ValueError("Found illegal value 0x%02x in %s" % (tag, bytes(buf[i:])))
+                if tag == 0x7f:
+                    tag = tag << 16 | buf[j] << 8 | buf[j+1]
+                    j += 2
+                rawtag = tag
+                tag = tag | 0x80 # HACK: always assume comprehension (like TLV_IE_Collection)
+            else:
+                # ITU-T X.690 8.1.2; stop at FF padding
+                if tag == 0xff and (j == end or buf[j] == 0xff):
+                    break
+                if tag & 0x1f == 0x1f:
+                    while True:
+                        tag = tag << 8 | buf[j]
+                        j += 1
+                        if not buf[j-1] & 0x80:
+                            break
+                rawtag = tag
+            cls = self.members_by_tag.get(tag, None)
+            if cls is None:
+                cls = _unknown_class(base, tag)
+            inst = cls()
+            if rawtag:
+                if not inst.is_tag_compatible(rawtag):
+                    raise ValueError("%s: Encountered tag %s doesn't match our supported tag %s" %
+                                     (inst, rawtag, inst.tag))
+                # length: ITU-T X.690 8.1.3, definite form
+                length = buf[j]
+                j += 1
+                if length & 0x80:
+                    num_len_oct = length & 0x7f
+                    if end - j < num_len_oct:
+                        length = 0
+                        j = end
+                    else:
+                        length = int.from_bytes(buf[j:j+num_len_oct], 'big')
+                        j += num_len_oct
+                i = min(j + length, end)
+                inst.from_bytes(bytes(buf[j:i]), context=context)
+            else:
+                # like TLV_IE.from_tlv(): a zero tag consumes all of the remainder
+                inst.from_bytes(bytes(buf[i:]), context=context)
+                i = end
+            res.append(inst)
+        self.children = res
+        return res
+
+
+_compiled_collections = {}
+
+def compile_collection(cls: type) -> type:
+    """Return the CompiledTlvCollection equivalent of the given TLV_IE_Collection subclass."""
+    if issubclass(cls, CompiledTlvCollection):
+        return cls
+    compiled = _compiled_collections.get(cls, None)
+    if compiled is None:
+        compiled = type(cls.__name__, (CompiledTlvCollection, cls), {'nested': cls.possible_nested})
+        _compiled_collections[cls] = compiled
+    return compiled
+
+
+def compile_tlv_ies(namespace: dict) -> int:
+    """Make the TLV_IE classes defined in a module use a CompiledTlvCollection for their nested IEs.
+    To be called as compile_tlv_ies(globals()) at the end of a module defining TLV_IE classes.
+
+    Returns:
+        number of classes updated
+    """
+    count = 0
+    for cls in list(namespace.values()):
+        if not inspect.isclass(cls) or not issubclass(cls, TLV_IE):
+            continue
+        if cls.__module__ != namespace['__name__']:
+            continue
+        nested = cls.__dict__.get('nested_collection_cls', None)
+        if nested is None or issubclass(nested, CompiledTlvCollection):
+            continue
+        cls.nested_collection_cls = compile_collection(nested)
+        count += 1
+    return count
+
+
+def _freeze(value):
+    """Return a hashable equivalent of a decoded IE value (made of dicts, lists and scalars)."""
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    hash(value)
+    return value
+
+
+def _encode_cached(to_bytes):
+    """Wrap the to_bytes() method of a TLV_IE class, memoising the encoded value part by the
+    decoded value."""
+    def cached_to_bytes(self, context: dict = {}) -> bytes:
+        if self.children or self.decoded is None:
+            return to_bytes(self, context=context)
+        try:
+            key = _freeze(self.decoded)
+        except TypeError:
+            return to_bytes(self, context=context)
+        cache = type(self).__dict__.get('_encode_cache', None)
+        if cache is None:
+            cache = type(self)._encode_cache = {}
+        do = cache.get(key, None)
+        if do is None:
+            do = to_bytes(self, context=context)
+            if len(cache) >= self.ENCODE_CACHE_SIZE:
+                cache.clear()
+            cache[key] = do
+        self.encoded = do
+        return do
+    cached_to_bytes.encode_cached = True
+    return cached_to_bytes
+
+
+class EncodeCacheMixin:
+    """Mixin for (non-constructed) TLV_IE classes whose encoding only depends on the decoded
+    value, memoising the encoded value part by the decoded value.  Use after the TLV_IE base
+    class, which must remain the __base__ of the class (TLV_IE_Collection derives the classes for
+    unknown tags from it):
+
+        class CommandDetails(COMPR_TLV_IE, EncodeCacheMixin, tag=0x81):
+
+    As the TLV_IE base class then precedes the mixin in the MRO, the memoising to_bytes() is
+    installed into each class using the mixin rather than inherited from it.
+    """
+    # maximum number of cached encodings per class
+    ENCODE_CACHE_SIZE = 256
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not getattr(cls.to_bytes, 'encode_cached', False):
+            cls.to_bytes = _encode_cached(cls.to_bytes)
@@ -1,4 +1,8 @@
+import os
 import sys
+import stat
+import pickle
+import hashlib
 from typing import Optional, Tuple
 from importlib import resources
 
@@ -47,8 +51,40 @@ class PMO:
     def __str__(self):
         return self.op
 
-def compile_asn1_subdir(subdir_name:str, codec='der'):
-    """Helper function that compiles ASN.1 syntax from all files within given subdir"""
+def asn1_cache_dir() -> str:
+    """Directory in which compiled ASN.1 specifications are cached."""
+    if 'PYSIM_ASN1_CACHE_DIR' in os.environ:
+        return os.environ['PYSIM_ASN1_CACHE_DIR']
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(cache_home, 'pySim', 'asn1')
+
+def _owned_and_private(st: os.stat_result) -> bool:
+    """Is a file/directory owned by the current user and not writable by anyone else?"""
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def _load_asn1_cache(cache_path: str):
+    """Load a compiled specification from the cache.  Unpickling can execute arbitrary code, so only
+    files which nobody but the current user can have written are trusted."""
+    if not hasattr(os, 'getuid'):
+        # no POSIX file ownership to check
+        return None
+    try:
+        if not _owned_and_private(os.stat(os.path.dirname(cache_path))):
+            return None
+        fd = os.open(cache_path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+    except OSError:
+        return None
+    with os.fdopen(fd, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode) or not _owned_and_private(st):
+            return None
+        return pickle.load(f)
+
+def compile_asn1_subdir(subdir_name:str, codec='der', use_cache:bool = True):
+    """Helper function that compiles ASN.1 syntax from all files within given subdir.
+
+    Parsing the ASN.1 sources takes in the order of a second, so the compiled specification is
+    cached on disk, keyed by a hash of the sources, the codec and the asn1tools/python versions."""
     import asn1tools
     asn_txt = ''
     __ver = sys.version_info
@@ -58,7 +94,54 @@ def compile_asn1_subdir(subdir_name:str, codec='der'):
             asn_txt += "\n"
     #else:
         #print(resources.read_text(__name__, 'asn1/rsp.asn'))
-    return asn1tools.compile_string(asn_txt, codec=codec)
+    if not use_cache:
+        return asn1tools.compile_string(asn_txt, codec=codec)
+
+    h = hashlib.sha256()
+    h.update(('%s:%s:%u.%u:' % (asn1tools.__version__, codec, __ver.major, __ver.minor)).encode())
+    h.update(asn_txt.encode())
+    cache_path = os.path.join(asn1_cache_dir(), '%s-%s.pickle' % (subdir_name, h.hexdigest()[:32]))
+    try:
+        spec = _load_asn1_cache(cache_path)
+        if spec is not None:
+            return spec
+    except Exception: # pylint: disable=broad-except
+        # no usable cache file; fall back to compiling from the sources
+        pass
+
+    spec = asn1tools.compile_string(asn_txt, codec=codec)
+    try:
+        os.makedirs(os.path.dirname(cache_path), mode=0o700, exist_ok=True)
+        # write to a temporary file first, so concurrent processes never see a partial file
+        tmp_path = '%s.%u.tmp' % (cache_path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(spec, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except (OSError, pickle.PicklingError, RecursionError):
+        pass
+    return spec
+
+
+class LazyAsn1Spec:
+    """Stand-in for a compiled asn1tools specification, which is only compiled (or loaded from the
+    cache) once it is first used.  This avoids the cost at import time of modules which may not
+    need to encode/decode anything at all."""
+    def __init__(self, subdir_name:str, codec='der'):
+        self._subdir_name = subdir_name
+        self._codec = codec
+        self._spec = None
+
+    @property
+    def spec(self):
+        if self._spec is None:
+            self._spec = compile_asn1_subdir(self._subdir_name, self._codec)
+        return self._spec
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.spec, name)
 
 
 # SGP.22 section 4.1 Activation Code
@@ -26,9 +26,9 @@ from cryptography import x509
 from osmocom.utils import b2h
 from osmocom.tlv import bertlv_parse_one_rawtag, bertlv_return_one_rawtlv
 
-from pySim.esim import compile_asn1_subdir
+from pySim.esim import LazyAsn1Spec
 
-asn1 = compile_asn1_subdir('rsp')
+asn1 = LazyAsn1Spec('rsp')
 
 class RspSessionState:
     """Encapsulates the state of a RSP session.  It is created during the initiateAuthentication
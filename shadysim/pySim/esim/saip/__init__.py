@@ -19,7 +19,7 @@ import logging
 import abc
 import io
 import os
-from typing import Tuple, List, Optional, Dict, Union
+from typing import Tuple, List, Optional, Dict, Union, Iterable, Iterator, BinaryIO
 from collections import OrderedDict
 import asn1tools
 import zipfile
@@ -34,13 +34,13 @@ from pySim.ts_102_221 import FileDescriptor
 from pySim.filesystem import CardADF, Path
 from pySim.ts_31_102 import ADF_USIM
 from pySim.ts_31_103 import ADF_ISIM
-from pySim.esim import compile_asn1_subdir
+from pySim.esim import LazyAsn1Spec
 from pySim.esim.saip import templates
 from pySim.esim.saip import oid
 from pySim.global_platform import KeyType, KeyUsageQualifier
 from pySim.global_platform.uicc import UiccSdInstallParams
 
-asn1 = compile_asn1_subdir('saip')
+asn1 = LazyAsn1Spec('saip')
 
 logger = logging.getLogger(__name__)
 
@@ -1434,6 +1434,41 @@ def bertlv_first_segment(binary: bytes) -> Tuple[bytes, bytes]:
     tlv_length = tl_length + length
     return binary[:tlv_length], binary[tlv_length:]
 
+def bertlv_iter_segments(binary: Union[bytes, memoryview]) -> Iterator[Tuple[bytes, memoryview]]:
+    """iterate over a binary concatenation of BER-TLV objects without copying them.
+        Returns: iterator of (raw tag, TLV) tuples; the TLV is a memoryview slice of binary."""
+    mv = memoryview(binary)
+    offset = 0
+    while offset < len(mv):
+        cur = mv[offset:]
+        _tagdict, remainder = bertlv_parse_tag(cur)
+        tag_len = len(cur) - len(remainder)
+        length, remainder = bertlv_parse_len(remainder)
+        tlv_length = len(cur) - len(remainder) + length
+        yield bytes(cur[:tag_len]), cur[:tlv_length]
+        offset += tlv_length
+
+class RawProfileElement:
+    """A ProfileElement kept in its DER encoded form, as returned by ProfileElementSequence.iter_der()
+    for PE types which were not requested to be decoded.  It can be re-emitted without a decode/encode
+    cycle, or be decoded on demand."""
+    def __init__(self, pe_type: Optional[str], der: Union[bytes, memoryview],
+                 pe_sequence: Optional['ProfileElementSequence'] = None):
+        self.type = pe_type
+        self.der = der
+        self.pe_sequence = pe_sequence
+
+    def decode(self) -> ProfileElement:
+        """Decode into a (fully decoded) ProfileElement."""
+        return ProfileElement.from_der(bytes(self.der), pe_sequence=self.pe_sequence)
+
+    def to_der(self) -> Union[bytes, memoryview]:
+        """Return the unmodified DER encoded representation."""
+        return self.der
+
+    def __str__(self) -> str:
+        return '%s (raw)' % self.type
+
 class ProfileElementSequence:
     """A sequence of ProfileElement objects, which is the overall representation of an eSIM profile.
 
@@ -1516,12 +1551,66 @@ class ProfileElementSequence:
     def parse_der(self, der: bytes) -> None:
         """Parse a sequence of PE from SAIP DER format and store the result in self.pe_list."""
         self.pe_list = []
-        remainder = der
-        while len(remainder):
-            first_tlv, remainder = bertlv_first_segment(remainder)
-            self.pe_list.append(ProfileElement.from_der(first_tlv, pe_sequence=self))
+        for _tag, tlv in bertlv_iter_segments(der):
+            self.pe_list.append(ProfileElement.from_der(bytes(tlv), pe_sequence=self))
         self._process_pelist()
 
+    @staticmethod
+    def iter_der(der: Union[bytes, memoryview], pe_types: Optional[Iterable[str]] = None,
+                 pe_sequence: Optional['ProfileElementSequence'] = None
+                 ) -> Iterator[Union[ProfileElement, RawProfileElement]]:
+        """Iterate lazily over the PEs of a PE-Sequence in SAIP DER format, for example from a mmap of a
+        large profile package file.  Only PEs of the types in pe_types (all if None) are decoded; all
+        others are returned as RawProfileElement referencing the input data without copying it.  Such
+        a stream can be written back using write_der(), so that re-personalization only pays for
+        decoding and encoding the PEs it modifies:
+
+            def personalize(pes):
+                for pe in pes:
+                    if pe.type == 'akaParameter':
+                        pe.decoded['algoConfiguration'][1]['key'] = new_ki
+                    yield pe
+
+            with open(in_name, 'rb') as f_in, open(out_name, 'wb') as f_out:
+                with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    pes = ProfileElementSequence.iter_der(m, ['akaParameter'])
+                    ProfileElementSequence.write_der(f_out, personalize(pes))
+
+        Args:
+            der: DER encoded PE-Sequence (bytes, memoryview, mmap)
+            pe_types: names of the PE types to decode
+            pe_sequence: back-reference to put into the PEs
+        """
+        tag_to_member = asn1.types['ProfileElement'].type.tag_to_member
+        if pe_types is not None:
+            pe_types = set(pe_types)
+        for tag, tlv in bertlv_iter_segments(der):
+            member = tag_to_member.get(tag, None)
+            pe_type = member.name if member else None
+            if pe_types is None or pe_type in pe_types:
+                yield ProfileElement.from_der(bytes(tlv), pe_sequence=pe_sequence)
+            else:
+                yield RawProfileElement(pe_type, tlv, pe_sequence=pe_sequence)
+
+    @staticmethod
+    def write_der(f: BinaryIO, pes: Iterable[Union[ProfileElement, RawProfileElement]]) -> int:
+        """Write the DER encoding of the given PEs (e.g. as obtained from iter_der) to a binary file.
+        Unbuffered (raw) files are written through a buffered writer.
+
+        Returns:
+            number of bytes written
+        """
+        raw = isinstance(f, io.RawIOBase)
+        if raw:
+            f = io.BufferedWriter(f)
+        written = 0
+        for pe in pes:
+            written += f.write(pe.to_der())
+        if raw:
+            f.flush()
+            f.detach()
+        return written
+
     def _process_pelist(self) -> None:
         """Post-process the PE-list; update convenience accessor dicts."""
         self._rebuild_pe_by_type()
@@ -1651,10 +1740,7 @@ class ProfileElementSequence:
 
     def to_der(self) -> bytes:
         """Build an encoded DER representation of the instance."""
-        out = b''
-        for pe in self.pe_list:
-            out += pe.to_der()
-        return out
+        return b''.join(pe.to_der() for pe in self.pe_list)
 
     def renumber_identification(self):
         """Re-generate the 'identification' numbering of all PE headers."""
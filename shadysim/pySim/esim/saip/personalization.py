@@ -17,11 +17,14 @@
 
 import abc
 import io
-from typing import List, Tuple
+import copy
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Dict, Iterable, Iterator, Optional
 
 from osmocom.tlv import camel_to_snake
 from pySim.utils import enc_iccid, enc_imsi, h2b, rpad, sanitize_iccid
-from pySim.esim.saip import ProfileElement, ProfileElementSequence
+from pySim.esim.saip import ProfileElement, ProfileElementSequence, bertlv_iter_segments
 
 def remove_unwanted_tuples_from_list(l: List[Tuple], unwanted_keys: List[str]) -> List[Tuple]:
     """In a list of tuples, remove all tuples whose first part equals 'unwanted_key'."""
@@ -48,6 +51,9 @@ class ClassVarMeta(abc.ABCMeta):
 class ConfigurableParameter(abc.ABC, metaclass=ClassVarMeta):
     """Base class representing a part of the eSIM profile that is configurable during the
     personalization process (with dynamic data from elsewhere)."""
+    # types of the PEs which apply() may modify; None means any PE
+    pe_types = None
+
     def __init__(self, input_value):
         self.input_value = input_value # the raw input value as given by caller
         self.value = None # the processed input value (e.g. with check digit) as produced by validate()
@@ -58,6 +64,11 @@ class ConfigurableParameter(abc.ABC, metaclass=ClassVarMeta):
         # default implementation: simply copy input_value over to value
         self.value = self.input_value
 
+    @classmethod
+    def from_str(cls, input_str: str) -> 'ConfigurableParameter':
+        """Construct an instance from a string representation, as e.g. found in a CSV file."""
+        return cls(input_str)
+
     @abc.abstractmethod
     def apply(self, pes: ProfileElementSequence):
         pass
@@ -65,6 +76,7 @@ class ConfigurableParameter(abc.ABC, metaclass=ClassVarMeta):
 class Iccid(ConfigurableParameter):
     """Configurable ICCID.  Expects the value to be a string of decimal digits.
     If the string of digits is only 18 digits long, a Luhn check digit will be added."""
+    pe_types = ['header', 'mf']
 
     def validate(self):
         # convert to string as it might be an integer
@@ -84,6 +96,7 @@ class Iccid(ConfigurableParameter):
 class Imsi(ConfigurableParameter):
     """Configurable IMSI. Expects value to be a string of digits. Automatically sets the ACC to
     the last digit of the IMSI."""
+    pe_types = ['usim']
 
     def validate(self):
         # convert to string as it might be an integer
@@ -113,6 +126,11 @@ class SdKey(ConfigurableParameter, metaclass=ClassVarMeta):
     kvn = None
     key_usage_qual = None
     permitted_len = []
+    pe_types = ['securityDomain']
+
+    @classmethod
+    def from_str(cls, input_str: str) -> 'SdKey':
+        return cls(h2b(input_str))
 
     def validate(self):
         if not isinstance(self.input_value, (io.BytesIO, bytes, bytearray)):
@@ -211,6 +229,7 @@ def obtain_first_pe_from_pelist(l: List[ProfileElement], wanted_type: str) -> Pr
 class Puk(ConfigurableParameter, metaclass=ClassVarMeta):
     """Configurable PUK (Pin Unblock Code). String ASCII-encoded digits."""
     keyReference = None
+    pe_types = ['pukCodes']
     def validate(self):
         if isinstance(self.input_value, int):
             self.value = '%08d' % self.input_value
@@ -238,6 +257,7 @@ class Puk2(Puk, keyReference=0x81):
 class Pin(ConfigurableParameter, metaclass=ClassVarMeta):
     """Configurable PIN (Personal Identification Number).  String of digits."""
     keyReference = None
+    pe_types = ['pinCodes']
     def validate(self):
         if isinstance(self.input_value, int):
             self.value = '%04d' % self.input_value
@@ -262,6 +282,7 @@ class Pin(ConfigurableParameter, metaclass=ClassVarMeta):
 class AppPin(ConfigurableParameter, metaclass=ClassVarMeta):
     """Configurable PIN (Personal Identification Number).  String of digits."""
     keyReference = None
+    pe_types = ['pinCodes']
     def validate(self):
         if isinstance(self.input_value, int):
             self.value = '%04d' % self.input_value
@@ -302,6 +323,11 @@ class Adm2(Pin, keyReference=0x0B):
 class AlgoConfig(ConfigurableParameter, metaclass=ClassVarMeta):
     """Configurable Algorithm parameter."""
     key = None
+    pe_types = ['akaParameter']
+
+    @classmethod
+    def from_str(cls, input_str: str) -> 'AlgoConfig':
+        return cls(h2b(input_str))
     def validate(self):
         if not isinstance(self.input_value, (io.BytesIO, bytes, bytearray)):
             raise ValueError('Value must be of bytes-like type')
@@ -318,7 +344,134 @@ class K(AlgoConfig, key='key'):
 class Opc(AlgoConfig, key='opc'):
     pass
 class AlgorithmID(AlgoConfig, key='algorithmID'):
+    @classmethod
+    def from_str(cls, input_str: str) -> 'AlgorithmID':
+        return cls(int(input_str))
+
     def validate(self):
         if self.input_value not in [1, 2, 3]:
             raise ValueError('Invalid algorithmID %s' % (self.input_value))
         self.value = self.input_value
+
+
+class BatchStats:
+    """Statistics about a batch personalization run."""
+    def __init__(self):
+        self.profiles = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    @property
+    def profiles_per_sec(self) -> float:
+        return self.profiles / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return "Personalized %u profiles (%u bytes) in %.1f s, %.1f profiles/s" % \
+            (self.profiles, self.bytes, self.elapsed, self.profiles_per_sec)
+
+
+class BatchPersonalizer:
+    """Generate many personalized profiles from a single template ("golden") profile.
+
+    The template is parsed only once.  From the pe_types of the ConfigurableParameter classes we know
+    which PEs can be modified by the personalization; only those are copied, modified and re-encoded
+    for each profile.  All other PEs are emitted from the DER of the template as-is.
+    """
+    def __init__(self, template_der: bytes, params: Dict[str, type]):
+        """
+        Args:
+            template_der: DER encoded PE-Sequence of the template profile
+            params: dict of ConfigurableParameter classes, indexed by the name of the input field
+                    (e.g. CSV column) from which the parameter value is taken
+        """
+        self.template_der = bytes(template_der)
+        self.params = params
+        self.template = ProfileElementSequence.from_der(self.template_der)
+        spans = []
+        offset = 0
+        for _tag, tlv in bertlv_iter_segments(self.template_der):
+            spans.append((offset, offset + len(tlv)))
+            offset += len(tlv)
+
+        pe_types = set()
+        for param_cls in params.values():
+            if param_cls.pe_types is None:
+                pe_types = None
+                break
+            pe_types.update(param_cls.pe_types)
+        # indexes of all PEs which the parameters may modify
+        self.touched = [i for i, pe in enumerate(self.template.pe_list) if pe_types is None or pe.type in pe_types]
+        # the unmodified DER in front of each touched PE, plus the trailing one
+        self.chunks = []
+        offset = 0
+        for i in self.touched:
+            self.chunks.append(self.template_der[offset:spans[i][0]])
+            offset = spans[i][1]
+        self.chunks.append(self.template_der[offset:])
+
+    def personalize(self, values: Dict[str, str]) -> bytes:
+        """Generate the DER encoded personalized profile.
+
+        Args:
+            values: string representation of the value of each parameter, indexed like self.params
+        """
+        pes = ProfileElementSequence()
+        pes.pe_list = list(self.template.pe_list)
+        for i in self.touched:
+            pe = copy.copy(self.template.pe_list[i])
+            pe.decoded = copy.deepcopy(pe.decoded)
+            pe.pe_sequence = pes
+            pes.pe_list[i] = pe
+        pes._process_pelist()
+        for field, param_cls in self.params.items():
+            param = param_cls.from_str(values[field])
+            param.validate()
+            param.apply(pes)
+        out = [self.chunks[0]]
+        for n, i in enumerate(self.touched):
+            out.append(pes.pe_list[i].to_der())
+            out.append(self.chunks[n+1])
+        return b''.join(out)
+
+    def personalize_many(self, rows: Iterable[Dict[str, str]], processes: int = 0, chunksize: int = 64,
+                         stats: Optional[BatchStats] = None) -> Iterator[bytes]:
+        """Generate personalized profiles for each of the rows (e.g. from a CSV file).
+
+        Args:
+            rows: parameter values for each profile, see personalize()
+            processes: number of worker processes to fan out to (0 = personalize in this process)
+            chunksize: number of rows handed to a worker process at once
+            stats: BatchStats instance to be updated
+        Returns:
+            iterator of the DER encoded personalized profiles, in the order of rows
+        """
+        stats = stats or BatchStats()
+        t_start = time.monotonic()
+        if processes:
+            executor = ProcessPoolExecutor(max_workers=processes, initializer=_batch_worker_init,
+                                           initargs=(self.template_der, self.params))
+            results = executor.map(_batch_worker, rows, chunksize=chunksize)
+        else:
+            executor = None
+            results = map(self.personalize, rows)
+        try:
+            for der in results:
+                stats.profiles += 1
+                stats.bytes += len(der)
+                stats.elapsed = time.monotonic() - t_start
+                yield der
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+
+
+_batch_personalizer = None
+
+def _batch_worker_init(template_der: bytes, params: Dict[str, type]):
+    """Helper for BatchPersonalizer.personalize_many(): parse the template once per worker process."""
+    global _batch_personalizer
+    _batch_personalizer = BatchPersonalizer(template_der, params)
+
+def _batch_worker(values: Dict[str, str]) -> bytes:
+    """Helper for BatchPersonalizer.personalize_many() running in a worker process."""
+    return _batch_personalizer.personalize(values)
@@ -57,6 +57,9 @@ class CardFile:
     """
     RESERVED_NAMES = ['..', '.', '/', 'MF']
     RESERVED_FIDS = ['3f00']
+    # incremented whenever a file or application is added to any file system model; invalidates the
+    # memoised results of get_selectables() and build_select_path_to()
+    _fs_generation = 0
 
     def __init__(self, fid: str = None, sfid: str = None, name: str = None, desc: str = None,
                  parent: Optional['CardDF'] = None, profile: Optional['CardProfile'] = None,
@@ -85,6 +88,10 @@ class CardFile:
         self.profile = profile
         self.service = service
         self.shell_commands = []  # type: List[CommandSet]
+        # memoised get_selectables() / get_selectable_names() results by flags
+        self._selectables_cache = {}
+        # memoised build_select_path_to() results by target file
+        self._route_cache = {}
 
         # Note: the basic properties (fid, name, ect.) are verified when
         # the file is attached to a parent file. See method add_file() in
@@ -136,33 +143,40 @@ class CardFile:
         return ret
 
     def build_select_path_to(self, target: 'CardFile') -> Optional[List['CardFile']]:
-        """Build the relative sequence of files we need to traverse to get from us to 'target'."""
-
-        # special-case handling for applications. Applications may be selected
-        # any time from any location. If there is an ADF somewhere in the path,
-        # we may clip everything before that ADF.
-        def clip_path(inter_path):
-            for i in reversed(range(0, len(inter_path))):
-                if isinstance(inter_path[i], CardADF):
-                    return inter_path[i:]
-            return inter_path
-
-        # special-case handling for selecting MF while the MF is selected
-        if target == target.get_mf():
-            return [target]
-        cur_fqpath = self.fully_qualified_path_fobj()
+        """Build the relative sequence of files we need to traverse to get from us to 'target'.
+
+        The sequence starts with the deepest file on the path to 'target' which can be selected
+        directly from us (see _is_selectable_from), so each SELECT moves as far as possible.  The
+        result is memoised until a file is added to the file system; it must not be modified."""
+        cached = self._route_cache.get(target, None)
+        if cached is None or cached[0] != CardFile._fs_generation:
+            cached = (CardFile._fs_generation, self._build_select_path_to(target))
+            self._route_cache[target] = cached
+        return cached[1]
+
+    def _is_selectable_from(self, f: 'CardFile') -> bool:
+        """Can 'f' be selected directly (by FID, or by AID for an ADF) while we are selected?
+        See ETSI TS 102 221, section 8.4.1 and 3GPP TS 51.011, section 8.4.1."""
+        if f == f.get_mf() or isinstance(f, CardADF):
+            return True
+        # the current directory: an EF is located in the DF of its parent
+        cur = self if isinstance(self, CardDF) else self.parent
+        if cur is None:
+            return False
+        # the current directory itself and its children
+        if f == cur or f.parent == cur:
+            return True
+        if isinstance(cur, CardADF) or cur == cur.get_mf():
+            # the parent of an ADF is not selectable by FID, the MF has neither parent nor siblings
+            return False
+        # our parent DF, and the sibling DFs of the current directory
+        return f == cur.parent or (isinstance(f, CardDF) and f.parent == cur.parent)
+
+    def _build_select_path_to(self, target: 'CardFile') -> Optional[List['CardFile']]:
         target_fqpath = target.fully_qualified_path_fobj()
-        inter_path = []
-        cur_fqpath.reverse()
-        for ce in cur_fqpath:
-            inter_path.append(ce)
-            for i in range(0, len(target_fqpath)-1):
-                te = target_fqpath[i]
-                if te == ce:
-                    for te2 in target_fqpath[i+1:]:
-                        inter_path.append(te2)
-                    # we found our common ancestor
-                    return clip_path(inter_path[1:])
+        for i in reversed(range(0, len(target_fqpath))):
+            if self._is_selectable_from(target_fqpath[i]):
+                return target_fqpath[i:]
         return None
 
     def get_mf(self) -> Optional['CardMF']:
@@ -212,6 +226,8 @@ class CardFile:
     def get_selectables(self, flags=[]) -> Dict[str, 'CardFile']:
         """Return a dict of {'identifier': File} that is selectable from the current file.
 
+        The result is memoised until a file is added to the file system; it must not be modified.
+
         Args:
             flags : Specify which selectables to return 'FIDS' and/or 'NAMES';
                     If not specified, all selectables will be returned.
@@ -219,6 +235,18 @@ class CardFile:
             dict containing all selectable items. Key is identifier (string), value
             a reference to a CardFile (or derived class) instance.
         """
+        return self._get_memoised('sels', flags, lambda: self._build_selectables(flags))
+
+    def _get_memoised(self, kind: str, flags, build):
+        key = (kind, tuple(flags))
+        cached = self._selectables_cache.get(key, None)
+        if cached is None or cached[0] != CardFile._fs_generation:
+            cached = (CardFile._fs_generation, build())
+            self._selectables_cache[key] = cached
+        return cached[1]
+
+    def _build_selectables(self, flags=[]) -> Dict[str, 'CardFile']:
+        """Compute the dict returned by get_selectables(); to be extended by derived classes."""
         sels = {}
         # we can always select ourself
         if flags == [] or 'SELF' in flags:
@@ -241,12 +269,9 @@ class CardFile:
             flags : Specify which selectables to return 'FIDS' and/or 'NAMES';
                     If not specified, all selectables will be returned.
         Returns:
-            list containing all selectable names.
+            list containing all selectable names (memoised like get_selectables(), must not be modified).
         """
-        sels = self.get_selectables(flags)
-        sel_keys = list(sels.keys())
-        sel_keys.sort()
-        return sel_keys
+        return self._get_memoised('names', flags, lambda: sorted(self.get_selectables(flags).keys()))
 
     def decode_select_response(self, data_hex: str):
         """Decode the response to a SELECT command.
@@ -324,6 +349,9 @@ class CardDF(CardFile):
                 raise TypeError('fid is mandatory for all DF')
         super().__init__(**kwargs)
         self.children = {}
+        # indexes of the children by name and by SFID (as int)
+        self._children_by_name = {}
+        self._children_by_sfid = {}
         self.shell_commands = [self.ShellCommands()]
         # dict of CardFile affected by service(int), indexed by service
         self.files_by_service = {}
@@ -382,7 +410,12 @@ class CardDF(CardFile):
             raise ValueError(
                 "File with given name %s already exists in %s" % (child.name, self))
         self.children[child.fid] = child
+        if child.name:
+            self._children_by_name[child.name] = child
+        if child.sfid is not None:
+            self._children_by_sfid[int(str(child.sfid))] = child
         child.parent = self
+        CardFile._fs_generation += 1
         # update the service -> file relationship table
         self._add_file_services(child)
         if isinstance(child, CardDF):
@@ -404,18 +437,9 @@ class CardDF(CardFile):
         for child in children:
             self.add_file(child, ignore_existing)
 
-    def get_selectables(self, flags=[]) -> dict:
-        """Return a dict of {'identifier': File} that is selectable from the current DF.
-
-        Args:
-            flags : Specify which selectables to return 'FIDS' and/or 'NAMES';
-                    If not specified, all selectables will be returned.
-        Returns:
-            dict containing all selectable items. Key is identifier (string), value
-            a reference to a CardFile (or derived class) instance.
-        """
+    def _build_selectables(self, flags=[]) -> dict:
         # global selectables + our children
-        sels = super().get_selectables(flags)
+        sels = super()._build_selectables(flags)
         if flags == [] or 'FIDS' in flags:
             sels.update({x.fid: x for x in self.children.values() if x.fid})
         if flags == [] or 'FNAMES' in flags:
@@ -426,25 +450,17 @@ class CardDF(CardFile):
         """Find a file with given name within current DF."""
         if name is None:
             return None
-        for i in self.children.values():
-            if i.name and i.name == name:
-                return i
-        return None
+        return self._children_by_name.get(name, None)
 
     def lookup_file_by_sfid(self, sfid: Optional[str]) -> Optional[CardFile]:
         """Find a file with given short file ID within current DF."""
         if sfid is None:
             return None
-        for i in self.children.values():
-            if i.sfid == int(str(sfid)):
-                return i
-        return None
+        return self._children_by_sfid.get(int(str(sfid)), None)
 
     def lookup_file_by_fid(self, fid: str) -> Optional[CardFile]:
         """Find a file with given file ID within current DF."""
-        if fid in self.children:
-            return self.children[fid]
-        return None
+        return self.children.get(fid, None)
 
 
 class CardMF(CardDF):
@@ -471,22 +487,14 @@ class CardMF(CardDF):
             raise ValueError("AID %s already exists" % (app.aid))
         self.applications[app.aid] = app
         app.parent = self
+        CardFile._fs_generation += 1
 
     def get_app_names(self):
         """Get list of completions (AID names)"""
         return list(self.applications.values())
 
-    def get_selectables(self, flags=[]) -> dict:
-        """Return a dict of {'identifier': File} that is selectable from the current DF.
-
-        Args:
-            flags : Specify which selectables to return 'FIDS' and/or 'NAMES';
-                    If not specified, all selectables will be returned.
-        Returns:
-            dict containing all selectable items. Key is identifier (string), value
-            a reference to a CardFile (or derived class) instance.
-        """
-        sels = super().get_selectables(flags)
+    def _build_selectables(self, flags=[]) -> dict:
+        sels = super()._build_selectables(flags)
         sels.update(self.get_app_selectables(flags))
         return sels
 
@@ -562,18 +570,9 @@ class CardEF(CardFile):
     def __str__(self):
         return "EF(%s)" % (super().__str__())
 
-    def get_selectables(self, flags=[]) -> dict:
-        """Return a dict of {'identifier': File} that is selectable from the current DF.
-
-        Args:
-            flags : Specify which selectables to return 'FIDS' and/or 'NAMES';
-                    If not specified, all selectables will be returned.
-        Returns:
-            dict containing all selectable items. Key is identifier (string), value
-            a reference to a CardFile (or derived class) instance.
-        """
+    def _build_selectables(self, flags=[]) -> dict:
         # global selectable names + those of the parent DF
-        sels = super().get_selectables(flags)
+        sels = super()._build_selectables(flags)
         if flags == [] or 'FIDS' in flags:
             sels.update({x.fid: x for x in self.parent.children.values() if x.fid and x != self})
         if flags == [] or 'FNAMES' in flags:
@@ -868,9 +867,8 @@ class LinFixedEF(CardEF):
         @cmd2.with_argparser(read_rec_parser)
         def do_read_record(self, opts):
             """Read one or multiple records from a record-oriented EF"""
-            for r in range(opts.count):
-                recnr = opts.RECORD_NR + r
-                (data, _sw) = self._cmd.lchan.read_record(recnr)
+            recnrs = range(opts.RECORD_NR, opts.RECORD_NR + opts.count)
+            for recnr, (data, _sw) in self._cmd.lchan.read_records(recnrs):
                 if len(data) > 0:
                     recstr = str(data)
                 else:
@@ -890,13 +888,15 @@ class LinFixedEF(CardEF):
             self._cmd.poutput_json(data, opts.oneline)
 
         read_recs_parser = argparse.ArgumentParser()
+        read_recs_parser.add_argument('--skip-empty', action='store_true',
+                                      help='Skip records consisting of 0xFF only')
 
         @cmd2.with_argparser(read_recs_parser)
-        def do_read_records(self, _opts):
+        def do_read_records(self, opts):
             """Read all records from a record-oriented EF"""
             num_of_rec = self._cmd.lchan.selected_file_num_of_rec()
-            for recnr in range(1, 1 + num_of_rec):
-                (data, _sw) = self._cmd.lchan.read_record(recnr)
+            recnrs = range(1, 1 + num_of_rec)
+            for recnr, (data, _sw) in self._cmd.lchan.read_records(recnrs, opts.skip_empty):
                 if len(data) > 0:
                     recstr = str(data)
                 else:
@@ -913,9 +913,8 @@ class LinFixedEF(CardEF):
             num_of_rec = self._cmd.lchan.selected_file_num_of_rec()
             # collect all results in list so they are rendered as JSON list when printing
             data_list = []
-            for recnr in range(1, 1 + num_of_rec):
-                (data, _sw) = self._cmd.lchan.read_record_dec(recnr)
-                data_list.append(data)
+            for recnr, (data, _sw) in self._cmd.lchan.read_records(range(1, 1 + num_of_rec)):
+                data_list.append(self._cmd.lchan.selected_file.decode_record_hex(data, recnr))
             self._cmd.poutput_json(data_list, opts.oneline)
 
         upd_rec_parser = argparse.ArgumentParser()
@@ -28,9 +28,11 @@ from osmocom.utils import *
 from osmocom.tlv import *
 from osmocom.construct import *
 from pySim.utils import ResTuple
+from pySim.compiled_tlv import CompiledTlvCollection, compile_tlv_ies
 from pySim.card_key_provider import card_key_provider_get_field
 from pySim.global_platform.scp import SCP02, SCP03
 from pySim.global_platform.install_param import gen_install_parameters
+from pySim.global_platform.load import Loader
 from pySim.filesystem import *
 from pySim.profile import CardProfile
 from pySim.ota import SimFileAccessAndToolkitAppSpecParams
@@ -102,7 +104,7 @@ class CrtForDigitalSignature(BER_TLV_IE, tag=0xB6):
     pass
 
 
-class InstallParameters(TLV_IE_Collection, nested=[ApplicationSpecificParams,
+class InstallParameters(CompiledTlvCollection, nested=[ApplicationSpecificParams,
                                                    SystemSpecificParams,
                                                    Ts102226SpecificTemplate,
                                                    CrtForDigitalSignature]):
@@ -437,7 +439,7 @@ class ConfirmationCounter(BER_TLV_IE, tag=0xc2):
     _construct = GreedyInteger()
 
 # Collection of all the data objects we can get from GET DATA
-class DataCollection(TLV_IE_Collection, nested=[IssuerIdentificationNumber,
+class DataCollection(CompiledTlvCollection, nested=[IssuerIdentificationNumber,
                                                 CardImageNumber,
                                                 CardData,
                                                 KeyInformation,
@@ -512,6 +514,9 @@ class GpRegistryRelatedData(BER_TLV_IE, tag=0xe3, nested=[ApplicationAID, LifeCy
                                                           ExecutableModuleAID, AssociatedSecurityDomainAID]):
     pass
 
+# use pre-compiled lookup tables for the nested IEs of all of the above
+compile_tlv_ies(globals())
+
 # Application Dedicated File of a Security Domain
 class ADF_SD(CardADF):
     StoreData = BitStruct('last_block'/Flag,
@@ -826,38 +831,31 @@ class ADF_SD(CardADF):
         load_parser_from_grp.add_argument('--from-hex', type=is_hexstr, help='load from hex string')
         load_parser_from_grp.add_argument('--from-file', type=argparse.FileType('rb', 0), help='load from binary file')
         load_parser_from_grp.add_argument('--from-cap-file', type=argparse.FileType('rb', 0), help='load from JAVA-card CAP file')
+        load_parser.add_argument('--chunk-len', type=int, default=240,
+                                 help='maximum size of the blocks sent in each LOAD command')
 
         @cmd2.with_argparser(load_parser)
         def do_load(self, opts):
             """Perform a GlobalPlatform LOAD command. (We currently only support loading without DAP and
             without ciphering.)"""
             if opts.from_hex is not None:
-                self.load(h2b(opts.from_hex))
+                self.load(h2b(opts.from_hex), opts.chunk_len)
             elif opts.from_file is not None:
-                self.load(opts.from_file.read())
+                self.load(opts.from_file.read(), opts.chunk_len)
             elif opts.from_cap_file is not None:
                 cap = CapFile(opts.from_cap_file)
-                self.load(cap.get_loadfile())
+                self.load(cap.get_loadfile(), opts.chunk_len)
             else:
                 raise ValueError('load source not specified!')
 
         def load(self, contents:bytes, chunk_len:int = 240):
-            # TODO:tune chunk_len based on the overhead of the used SCP?
-            # build TLV according to GPC_SPE_034 section 11.6.2.3 / Table 11-58 for unencrypted case
-            remainder = b'\xC4' + bertlv_encode_len(len(contents)) + contents
-            # transfer this in vaious chunks to the card
-            total_size = len(remainder)
-            block_nr = 0
-            while len(remainder):
-                block = remainder[:chunk_len]
-                remainder = remainder[chunk_len:]
-                # build LOAD command APDU according to GPC_SPE_034 section 11.6.2 / Table 11-56
-                p1 = 0x00 if len(remainder) else 0x80
-                p2 = block_nr % 256
-                block_nr += 1
-                cmd_hex = "80E8%02x%02x%02x%s00" % (p1, p2, len(block), b2h(block))
-                _rsp_hex, _sw = self._cmd.lchan.scc.send_apdu_checksw(cmd_hex)
-            self._cmd.poutput("Loaded a total of %u bytes in %u blocks. Don't forget install_for_install (and make selectable) now!" % (total_size, block_nr))
+            scc = self._cmd.lchan.scc
+            # the block size is further limited by the transport (incl. extended length) and the SCP
+            # overhead, see Loader
+            loader = Loader(lambda apdus: scc.send_apdu_checksw(apdus[0]),
+                            min(chunk_len, scc.max_cmd_data_len), with_le=True)
+            stats = loader.load(contents)
+            self._cmd.poutput("%s. Don't forget install_for_install (and make selectable) now!" % stats)
 
         install_cap_parser = argparse.ArgumentParser()
         install_cap_parser.add_argument('cap_file', type=str, metavar='FILE',
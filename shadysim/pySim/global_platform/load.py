@@ -0,0 +1,153 @@
+# GlobalPlatform LOAD of Load Files (e.g. JavaCard CAP files)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+from typing import Callable, List, Optional, Tuple, Union
+
+from osmocom.utils import b2h, Hexstr
+from osmocom.tlv import bertlv_encode_len
+
+from pySim.utils import ResTuple, build_command_apdu
+from pySim.exceptions import SwMatchError, ProtocolError
+
+# CLA + INS + P1 + P2 + Lc of a LOAD command (GPC_SPE_034 section 11.6.2 / Table 11-56)
+LOAD_HDR_LEN = 5
+
+# status words upon which we retry with a smaller block size
+LOAD_RETRY_SW = ('6a86', '6700')
+
+class LoadStats:
+    """Statistics about a single load."""
+    def __init__(self):
+        self.bytes = 0
+        self.blocks = 0
+        self.commands = 0
+        self.retries = 0
+        self.block_len = 0
+        self.elapsed = 0.0
+
+    @property
+    def bytes_per_sec(self) -> float:
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return "Loaded %u bytes in %u blocks of up to %u bytes (%u round trips, %u retries) in %.1f s, %.0f bytes/s" % \
+            (self.bytes, self.blocks, self.block_len, self.commands, self.retries, self.elapsed, self.bytes_per_sec)
+
+
+# response of send_fn: (data, sw) of the last LOAD, or (data, sw, number of LOADs executed)
+SendResult = Union[ResTuple, Tuple[Hexstr, str, int]]
+
+class Loader:
+    """Transfer a Load File to the card as a sequence of LOAD commands.
+
+    The blocks have the given size, limited by the maximum length of the command data of a single
+    LOAD (which depends on transport and secure channel, see SimCardCommands.max_cmd_data_len).
+    Where several LOAD commands can be sent in one round trip (like in a RAM over SMS script), as
+    many blocks as fit into the budget of a round trip are sent together.  If the card rejects a
+    block with 6A86 or 6700, the block size is halved and the load continues with the rejected
+    block.  With several LOAD commands per round trip, this requires send_fn to report how many of
+    them the card executed (e.g. from the PoR), as the blocks in front of the rejected one have
+    been loaded already; without that, only one LOAD is sent per round trip if retries are enabled.
+    Blocks of more than 255 bytes are sent as extended length APDUs.
+    """
+
+    def __init__(self, send_fn: Callable[[List[Hexstr]], SendResult], max_block_len: int = 255,
+                 max_round_trip_len: Optional[int] = None, min_block_len: int = 16, with_le: bool = False,
+                 retry: bool = True, reports_executed: bool = False):
+        """
+        Args:
+            send_fn : function sending a list of LOAD command APDUs to the card, returning the
+                      response of the last one executed, optionally followed by the number of
+                      LOAD commands executed (including a rejected one); it may also raise
+                      SwMatchError for a rejected LOAD
+            max_block_len : maximum length of the command data of a single LOAD
+            max_round_trip_len : maximum total length of the LOAD command APDUs (including their
+                                 headers) sent in a single call of send_fn, None for one LOAD
+                                 per call
+            min_block_len : minimum block size to back off to
+            with_le : append an Le field to the LOAD command APDUs
+            retry : retry rejected blocks with a smaller block size
+            reports_executed : send_fn returns the number of LOAD commands executed
+        """
+        self.send_fn = send_fn
+        self.min_block_len = min_block_len
+        self.with_le = with_le
+        self.retry = retry
+        self.block_len = min(max_block_len, 65535)
+        self.blocks_per_call = 1
+        if max_round_trip_len is not None:
+            # as many blocks as fit into the round trip
+            self.block_len = min(self.block_len, max_round_trip_len - LOAD_HDR_LEN)
+            if reports_executed or not retry:
+                self.blocks_per_call = max(1, max_round_trip_len // (LOAD_HDR_LEN + self.block_len))
+        if self.block_len < min_block_len:
+            raise ValueError('Maximum LOAD block size %d below minimum of %d' % (self.block_len, min_block_len))
+
+    def load(self, contents: bytes) -> LoadStats:
+        """Load the given Load File (without DAP and unencrypted) to the card."""
+        # build TLV according to GPC_SPE_034 section 11.6.2.3 / Table 11-58 for unencrypted case
+        data = memoryview(b'\xC4' + bertlv_encode_len(len(contents)) + contents)
+        stats = LoadStats()
+        start = time.monotonic()
+        block_len = self.block_len
+        offset = 0
+        block_nr = 0
+        while offset < len(data):
+            apdus = []
+            block_lens = []
+            end = offset
+            while len(apdus) < self.blocks_per_call and end < len(data):
+                block = data[end:end+block_len]
+                block_lens.append(len(block))
+                end += len(block)
+                # build LOAD command APDU according to GPC_SPE_034 section 11.6.2 / Table 11-56
+                p1 = 0x00 if end < len(data) else 0x80
+                p2 = (block_nr + len(apdus)) % 256
+                apdus.append(b2h(build_command_apdu(bytes([0x80, 0xE8, p1, p2]), block,
+                                                    256 if self.with_le else None)))
+            try:
+                res = self.send_fn(apdus)
+            except SwMatchError as e:
+                if e.sw_actual.lower() not in LOAD_RETRY_SW or len(apdus) > 1:
+                    raise e
+                res = ('', e.sw_actual)
+            sw = res[1]
+            executed = res[2] if len(res) > 2 else None
+            stats.commands += 1
+            if sw == '9000' and executed in (None, len(apdus)):
+                accepted = len(apdus)
+            elif sw == '9000':
+                raise ProtocolError('Card executed only %u of %u LOAD commands, %u blocks were not loaded' %
+                                    (executed, len(apdus), len(apdus) - executed))
+            elif sw.lower() in LOAD_RETRY_SW and (len(apdus) == 1 or executed is not None):
+                # the blocks in front of the rejected one were loaded
+                accepted = executed - 1 if executed else 0
+                if not self.retry or block_len // 2 < self.min_block_len:
+                    raise SwMatchError(sw, '9000')
+            else:
+                raise SwMatchError(sw, '9000')
+            if accepted:
+                offset += sum(block_lens[:accepted])
+                stats.blocks += accepted
+                stats.block_len = max(stats.block_len, block_len)
+                block_nr += accepted
+            if accepted < len(apdus):
+                block_len //= 2
+                stats.retries += 1
+        stats.bytes = len(data)
+        stats.elapsed = time.monotonic() - start
+        return stats
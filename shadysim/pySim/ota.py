@@ -18,13 +18,15 @@
 import zlib
 import abc
 import struct
-from typing import Optional, Tuple
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple, Iterable, List
 from construct import Enum, Int8ub, Int16ub, Struct, Bytes, GreedyBytes, BitsInteger, BitStruct
 from construct import Flag, Padding, Switch, this, PrefixedArray, GreedyRange
 from osmocom.construct import *
 from osmocom.utils import b2h
 
-from pySim.sms import UserDataHeader
+from pySim.sms import UserDataHeader, ConcatSmsReassembler, concat_sms_segments
 
 # ETS TS 102 225 gives the general command structure and the dialects for CAT_TP, TCP/IP and HTTPS
 # 3GPP TS 31.115 gives the dialects for SMS-PP, SMS-CB, USSD and HTTP
@@ -74,6 +76,9 @@ SPI = BitStruct(  # first octet
                por_required=1, por_only_when_error=2)
 )
 
+# names of all SPI fields, in order
+SPI_FIELDS = ('counter', 'ciphering', 'rc_cc_ds', 'por_in_submit', 'por_shall_be_ciphered', 'por_rc_cc_ds', 'por')
+
 # TS 102 225 Section 5.1.2
 KIC = BitStruct('key'/BitsInteger(4),
                 'algo'/Enum(BitsInteger(4), implicit=0, single_des=1, triple_des_cbc2=5, triple_des_cbc3=9,
@@ -121,16 +126,23 @@ class OtaKeyset:
         self.kid = bytes(kid)
         self.kid_idx = kid_idx
         self.cntr = cntr
+        self._auth = None
+        self._crypt = None
 
     @property
     def auth(self):
         """Return an instance of the matching OtaAlgoAuth."""
-        return OtaAlgoAuth.from_keyset(self)
+        # the algorithm instance is cached, it only depends on the algorithm name
+        if self._auth is None or self._auth.enum_name != self.algo_auth:
+            self._auth = OtaAlgoAuth.from_keyset(self)
+        return self._auth
 
     @property
     def crypt(self):
         """Return an instance of the matching OtaAlgoCrypt."""
-        return OtaAlgoCrypt.from_keyset(self)
+        if self._crypt is None or self._crypt.enum_name != self.algo_crypt:
+            self._crypt = OtaAlgoCrypt.from_keyset(self)
+        return self._crypt
 
 class OtaCheckError(Exception):
     pass
@@ -152,6 +164,23 @@ class OtaDialect(abc.ABC):
     def encode_cmd(self, otak: OtaKeyset, tar: bytes, spi: dict, apdu: bytes) -> bytes:
         pass
 
+    def encode_cmds(self, cmds: Iterable[Tuple[OtaKeyset, bytes, dict, bytes]], processes: int = 0,
+                    chunksize: int = 256) -> List[bytes]:
+        """Encode a batch of commands, e.g. the same RFM/RAM script for many cards with
+        card-individual keysets and counters.
+
+        Args:
+            cmds : iterable of (otak, tar, spi, apdu) tuples, as accepted by encode_cmd()
+            processes : number of worker processes to fan out to (0 = encode in this process)
+            chunksize : number of commands handed to a worker process at once
+        Returns:
+            list of encoded commands, in the order of cmds
+        """
+        if processes:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                return list(executor.map(partial(_encode_cmd_worker, self), cmds, chunksize=chunksize))
+        return [self.encode_cmd(*cmd) for cmd in cmds]
+
     @abc.abstractmethod
     def decode_resp(self, otak: OtaKeyset, spi: dict, apdu: bytes) -> (object, Optional["CompactRemoteResp"]):
         """Decode a response into a response packet and, if indicted (by a
@@ -161,6 +190,11 @@ class OtaDialect(abc.ABC):
         and (so far) completely proprietary per dialect."""
 
 
+def _encode_cmd_worker(dialect: OtaDialect, cmd: Tuple[OtaKeyset, bytes, dict, bytes]) -> bytes:
+    """Helper for OtaDialect.encode_cmds() running in a worker process."""
+    return dialect.encode_cmd(*cmd)
+
+
 from Cryptodome.Cipher import DES, DES3, AES
 from Cryptodome.Hash import CMAC
 
@@ -334,28 +368,53 @@ class OtaDialectSms(OtaDialect):
                                'cc_rc'/Bytes(this.rhl-10),
                                'secured_data'/GreedyBytes)
     hdr_construct = Struct('chl'/Int8ub, 'spi'/SPI, 'kic'/KIC, 'kid'/KID_CC, 'tar'/Bytes(3))
+    # Command Packet Identifier; the only IE in the UDH of a (first) command SMS
+    cpi_ie = {'iei': 0x70, 'length': 0, 'value': b''}
+    # cache of CHL+SPI+KIc+KID header templates (i.e. everything but the TAR); building them via
+    # construct is the most expensive part of encode_cmd, and they only depend on few parameters.
+    _hdr_cache = {}
+
+    def _build_hdr(self, chl: int, spi: dict, otak: OtaKeyset, tar: bytes) -> bytes:
+        """Build the CHL + SPI + KIc + KID + TAR part of the command header."""
+        cache_key = (chl, tuple((k, spi[k]) for k in SPI_FIELDS), otak.kic_idx, otak.algo_crypt,
+                     otak.kid_idx, otak.algo_auth)
+        tmpl = self._hdr_cache.get(cache_key)
+        if tmpl is None:
+            kic = {'key': otak.kic_idx, 'algo': otak.algo_crypt}
+            kid = {'key': otak.kid_idx, 'algo': otak.algo_auth}
+            tmpl = self.hdr_construct.build({'chl': chl, 'spi':spi, 'kic':kic, 'kid':kid, 'tar':b'\x00' * 3})[:-3]
+            if len(self._hdr_cache) >= 256:
+                self._hdr_cache.clear()
+            self._hdr_cache[cache_key] = tmpl
+        return tmpl + bytes(tar)
 
     def encode_cmd(self, otak: OtaKeyset, tar: bytes, spi: dict, apdu: bytes) -> bytes:
+        envelope_data = self._encode_cmd_packet(otak, tar, spi, apdu)
+        if len(envelope_data) > 140:
+            raise ValueError('Cannot encode command in a single SMS; use encode_cmd_sms() to send it as '
+                             'concatenated SMS')
+        return envelope_data
+
+    def _encode_cmd_packet(self, otak: OtaKeyset, tar: bytes, spi: dict, apdu: bytes) -> bytes:
+        """Encode a command packet of any length, see encode_cmd()."""
         # length of signature in octets
         len_sig = self._compute_sig_len(spi)
         pad_cnt = 0
         if spi['ciphering']: # ciphering is requested
             # append padding bytes to end up with blocksize
             len_cipher = 6 + len_sig + len(apdu)
-            padding = otak.crypt._get_padding(len_cipher, otak.crypt.blocksize)
+            crypt = otak.crypt
+            padding = crypt._get_padding(len_cipher, crypt.blocksize)
             pad_cnt = len(padding)
             apdu = bytes(apdu) # make a copy so we don't modify the input data
             apdu += padding
 
-        kic = {'key': otak.kic_idx, 'algo': otak.algo_crypt}
-        kid = {'key': otak.kid_idx, 'algo': otak.algo_auth}
-
         # CHL = number of octets from (and including) SPI to the end of RC/CC/DS
         # 13 == SPI(2) + KIc(1) + KId(1) + TAR(3) + CNTR(5) + PCNTR(1)
         chl = 13 + len_sig
 
         # CHL + SPI (+ KIC + KID)
-        part_head = self.hdr_construct.build({'chl': chl, 'spi':spi, 'kic':kic, 'kid':kid, 'tar':tar})
+        part_head = self._build_hdr(chl, spi, otak, tar)
         #print("part_head: %s" % b2h(part_head))
 
         # CNTR + PCNTR (CNTR not used)
@@ -397,11 +456,22 @@ class OtaDialectSms(OtaDialect):
 
         #print("envelope_data: %s" % b2h(envelope_data))
 
-        if len(envelope_data) > 140:
-            raise ValueError('Cannot encode command in a single SMS; Fragmentation not implemented')
-
         return envelope_data
 
+    def encode_cmd_sms(self, otak: OtaKeyset, tar: bytes, spi: dict, apdu: bytes, ref: int = 0,
+                       ref16: bool = False) -> List[bytes]:
+        """Encode a command and split it into the TP-UD of one or more SMS.  Command packets which
+        do not fit into a single SMS are sent as concatenated SMS, see TS 31.115 Section 4.
+
+        Args:
+            ref : concatenated short message reference number
+            ref16 : use 16-bit concatenated short message reference numbers
+        Returns:
+            list of TP-UD (including UDH with the CPI) of each SMS
+        """
+        cmd = self._encode_cmd_packet(otak, tar, spi, apdu)
+        return concat_sms_segments(cmd, [self.cpi_ie], ref, ref16)
+
     def decode_cmd(self, otak: OtaKeyset, encoded: bytes) -> Tuple[bytes, dict, bytes]:
         """Decode an encoded (encrypted, signed) OTA SMS Command-APDU."""
         if True: # TODO: how to decide?
@@ -498,3 +568,17 @@ class OtaDialectSms(OtaDialect):
         else:
             dec = None
         return (res, dec)
+
+    def decode_resp_sms(self, otak: OtaKeyset, spi: dict, segments: Iterable[bytes]) -> ("OtaDialectSms.SmsResponsePacket", Optional["CompactRemoteResp"]):
+        """Decode a response which was received in one or more (concatenated) SMS.
+
+        Args:
+            segments : TP-UD (including UDH) of each received SMS, in any order
+        """
+        reasm = ConcatSmsReassembler()
+        for ud in segments:
+            res = reasm.feed(ud)
+            if res:
+                udh, data = res
+                return self.decode_resp(otak, spi, udh.to_bytes() + data)
+        raise ValueError('Incomplete concatenated SMS response')
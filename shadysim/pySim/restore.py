@@ -0,0 +1,382 @@
+# coding=utf-8
+"""Restoring a card to a desired state with a minimum of writes.
+
+Instead of writing each file of a desired file system image and relying on the 'conserve' mode of
+the UPDATE commands (which reads every file before writing it), a RestorePlan compares the desired
+image against a Snapshot of the card (see pySim.snapshot) and only contains the byte ranges, records
+and data objects which actually differ.  The writes are executed in depth-first order of the file
+system, so that each DF is selected once, and are applied to the snapshot as they succeed, so that
+it keeps representing the state of the card.
+
+The desired image is a Snapshot as well; it can be taken from a reference card, or built from
+(decoded or raw) file contents via image_from_dict() or from a SAIP profile via image_from_saip().
+Files, records and data objects which are absent from the desired image are left alone.
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from typing import List, Optional, Tuple
+
+from osmocom.utils import h2b, b2h
+from osmocom.tlv import bertlv_parse_one
+
+from pySim.exceptions import SwMatchError
+from pySim.filesystem import CardFile, CardDF, CardMF, CardEF, TransparentEF, LinFixedEF, BerTlvEF
+from pySim.runtime import RuntimeLchan
+from pySim.snapshot import Snapshot, FileSnapshot, lookup_path
+
+# Unchanged bytes between two differing byte ranges of a transparent EF up to which both ranges are
+# written by a single UPDATE BINARY; rewriting them costs less than the header and status word of
+# another command.
+MERGE_GAP = 6
+
+# maximum number of bytes per UPDATE BINARY (short APDU)
+MAX_UPDATE_LEN = 255
+
+
+def diff_ranges(current: Optional[bytes], desired: bytes, merge_gap: int = MERGE_GAP) -> List[Tuple[int, bytes]]:
+    """Determine the byte ranges in which the desired contents of a transparent EF differ from the
+    current ones.  Bytes beyond the end of the current contents are considered different.
+
+    Args:
+        current : current contents (None if unknown)
+        desired : desired contents, starting at offset 0
+        merge_gap : merge ranges which are separated by up to this number of unchanged bytes
+    Returns:
+        list of (offset, data) tuples
+    """
+    if current is None:
+        current = b''
+    if desired == current[:len(desired)]:
+        return []
+    ranges = []
+    start = None
+    last = None
+    for i, b in enumerate(desired):
+        if i < len(current) and current[i] == b:
+            continue
+        if start is not None and i - last - 1 > merge_gap:
+            ranges.append((start, desired[start:last+1]))
+            start = None
+        if start is None:
+            start = i
+        last = i
+    ranges.append((start, desired[start:last+1]))
+    return ranges
+
+
+class FileWrites:
+    """The writes required to bring one EF to its desired contents."""
+
+    def __init__(self, current: FileSnapshot, desired: FileSnapshot):
+        self.current = current
+        self.desired = desired
+        # (offset, data) of a transparent EF
+        self.ranges = [] # type: List[Tuple[int, bytes]]
+        # records of a linear fixed / cyclic EF, by record number
+        self.records = {} # type: dict[int, bytes]
+        # values of the data objects of a BER-TLV EF, by tag
+        self.dos = {} # type: dict[int, bytes]
+
+    @property
+    def path(self) -> List[str]:
+        return self.current.path
+
+    @property
+    def num_bytes(self) -> int:
+        """Number of bytes to be written."""
+        return sum([len(d) for _o, d in self.ranges]) + \
+               sum([len(d) for d in self.records.values()]) + sum([len(v) for v in self.dos.values()])
+
+    @property
+    def num_commands(self) -> int:
+        """Number of UPDATE BINARY / UPDATE RECORD / SET DATA commands to be sent."""
+        return sum([(len(d) + MAX_UPDATE_LEN - 1) // MAX_UPDATE_LEN for _o, d in self.ranges]) + \
+               len(self.records) + len(self.dos)
+
+    def __bool__(self) -> bool:
+        return bool(self.ranges or self.records or self.dos)
+
+    def __str__(self) -> str:
+        ops = ['%u bytes at %u' % (len(d), o) for o, d in self.ranges]
+        ops += ['record %u' % r for r in self.records]
+        ops += ['DO %02x' % t for t in self.dos]
+        return '%s: %s' % (self.current.name or self.current.path_str, ', '.join(ops))
+
+    def _expand_record(self, data: bytes) -> bytes:
+        rec_len = self.current.record_len
+        if rec_len is None or len(data) >= rec_len:
+            return data
+        if self.current.file is not None and getattr(self.current.file, 'leftpad', False):
+            return b'\xff' * (rec_len - len(data)) + data
+        return data + b'\xff' * (rec_len - len(data))
+
+    def compute(self, merge_gap: int = MERGE_GAP):
+        """Compare the desired contents against the current ones."""
+        cur = self.current
+        des = self.desired
+        if des.body is not None:
+            self.ranges = diff_ranges(cur.body, des.body, merge_gap)
+        if des.records is not None:
+            rec_len = cur.record_len
+            for rec_nr, data in des.records.items():
+                data = self._expand_record(data)
+                # records missing from the snapshot were empty (see dump_card(skip_empty=True))
+                current = cur.records.get(rec_nr, None) if cur.records is not None else None
+                if current is None and rec_len is not None:
+                    current = b'\xff' * rec_len
+                if data != current:
+                    self.records[rec_nr] = data
+        if des.dos is not None:
+            for tag, value in des.dos.items():
+                if cur.dos is None or cur.dos.get(tag, None) != value:
+                    self.dos[tag] = value
+
+    def execute(self, lchan: RuntimeLchan, ef: CardEF):
+        """Perform the writes, updating the snapshot of the current state.  The EF is addressed by
+        its SFI where possible, so that the EFs of a DF are written without selecting each of them."""
+        # the writes are already known to be required, so we bypass the 'conserve' mode of the
+        # RuntimeLchan methods
+        for offset, data in self.ranges:
+            lchan.update_ef_binary(ef, b2h(data), offset, conserve=False)
+            body = bytearray(self.current.body or b'')
+            if len(body) < offset:
+                body += b'\xff' * (offset - len(body))
+            body[offset:offset+len(data)] = data
+            self.current.body = bytes(body)
+        for rec_nr, data in self.records.items():
+            lchan.update_ef_record(ef, rec_nr, b2h(data), force_len=True, conserve=False)
+            if self.current.records is None:
+                self.current.records = {}
+            self.current.records[rec_nr] = data
+        if self.dos:
+            lchan.select_file(ef)
+        for tag, value in self.dos.items():
+            lchan.scc.set_data(lchan.selected_file_path(), tag, b2h(value))
+            if self.current.dos is None:
+                self.current.dos = {}
+            self.current.dos[tag] = value
+        self.current._decoded = None
+
+
+class RestorePlan:
+    """The writes required to bring a card from the state recorded in a snapshot to a desired
+    image, in the order in which they are to be executed."""
+
+    def __init__(self, current: Snapshot, desired: Snapshot, merge_gap: int = MERGE_GAP):
+        """
+        Args:
+            current : snapshot of the card
+            desired : desired image
+            merge_gap : see diff_ranges()
+        """
+        self.current = current
+        self.files = [] # type: List[FileWrites]
+        # desired files which do not exist (or could not be read) on the card
+        self.missing = [] # type: List[FileSnapshot]
+        self.unchanged = 0
+        for des in desired:
+            cur = current.files.get(des.path_str, None)
+            if cur is None or cur.sw is not None:
+                self.missing.append(des)
+                continue
+            fw = FileWrites(cur, des)
+            fw.compute(merge_gap)
+            if fw:
+                self.files.append(fw)
+            else:
+                self.unchanged += 1
+        # depth-first: all EFs of a DF are written before moving on to its sub-DFs
+        self.files.sort(key=lambda fw: (fw.path[:-1], fw.path[-1]))
+
+    @property
+    def num_bytes(self) -> int:
+        return sum([fw.num_bytes for fw in self.files])
+
+    @property
+    def num_commands(self) -> int:
+        return sum([fw.num_commands for fw in self.files])
+
+    def __str__(self) -> str:
+        return "%u files to write (%u bytes in %u commands), %u unchanged, %u not on card" % \
+            (len(self.files), self.num_bytes, self.num_commands, self.unchanged, len(self.missing))
+
+    def check_card(self, lchan: RuntimeLchan):
+        """Make sure that the card is the one the snapshot was taken of, as the plan only writes what
+        differs from the snapshot: compare the ATR and the ICCID (EF.ICCID) with those recorded in it.
+
+        Raises:
+            ValueError if the card does not match the snapshot, or the snapshot lacks the ICCID
+        """
+        atr = h2b(lchan.scc.get_atr())
+        if self.current.atr is not None and atr != self.current.atr:
+            raise ValueError('ATR of the card (%s) differs from the one in the snapshot (%s)' %
+                             (b2h(atr), b2h(self.current.atr)))
+        snap_iccid = self.current.files.get('3f00/2fe2', None)
+        if snap_iccid is None or snap_iccid.body is None:
+            raise ValueError('Snapshot does not contain the ICCID (EF.ICCID) of the card')
+        ef_iccid = lookup_path(lchan.rs.mf, ['3f00', '2fe2'])
+        try:
+            data, _sw = lchan.read_ef_binary(ef_iccid)
+        except SwMatchError as e:
+            raise ValueError('Cannot read the ICCID (EF.ICCID) of the card: %s' % e) from e
+        iccid = h2b(data or '')
+        if iccid != snap_iccid.body:
+            raise ValueError('ICCID of the card (%s) differs from the one in the snapshot (%s)' %
+                             (b2h(iccid), b2h(snap_iccid.body)))
+
+    def execute(self, lchan: RuntimeLchan, force: bool = False) -> int:
+        """Perform the writes of the plan; the snapshot of the card is updated accordingly.
+
+        Args:
+            lchan : logical channel to use
+            force : write even if the card does not match the snapshot (see check_card)
+        Returns:
+            number of files written
+        """
+        if not force:
+            self.check_card(lchan)
+        mf = lchan.rs.mf
+        for fw in self.files:
+            ef = fw.current.file or lookup_path(mf, fw.path)
+            if ef is None:
+                raise ValueError('%s is not part of the file system model' % fw.current.path_str)
+            fw.execute(lchan, ef)
+        return len(self.files)
+
+
+def _structure_of(ef: CardEF) -> str:
+    if isinstance(ef, BerTlvEF):
+        return 'ber_tlv'
+    if isinstance(ef, LinFixedEF):
+        return 'linear_fixed'
+    return 'transparent'
+
+def lookup_name_path(mf: CardMF, path: List[str]) -> Optional[CardFile]:
+    """Find the file with the given path (names or FIDs, optionally starting with the MF) in a file
+    system model."""
+    node = mf
+    for elem in path:
+        if elem in [mf.name, mf.fid]:
+            node = mf
+            continue
+        if not isinstance(node, CardDF):
+            return None
+        child = node.lookup_file_by_name(elem) or node.lookup_file_by_fid(elem.lower())
+        if child is None and node == mf:
+            child = mf.applications.get(elem.lower(), None)
+            if child is None:
+                child = next((adf for adf in mf.applications.values() if adf.name == elem), None)
+        if child is None:
+            return None
+        node = child
+    return node
+
+def image_from_dict(mf: CardMF, files: dict, current: Optional[Snapshot] = None) -> Snapshot:
+    """Build a desired image from a dict of file contents, like
+    {'MF/ADF.USIM/EF.IMSI': {'imsi': '001010123456789'}, 'MF/EF.DIR': {1: '61...'}}.
+
+    The contents of transparent EFs are given as decoded data or hex string, those of linear fixed /
+    cyclic EFs as dict of (decoded or hex) records by record number and those of BER-TLV EFs as dict
+    of hex values by tag.  The snapshot of the card is used to determine the file and record sizes
+    required for encoding.
+
+    Args:
+        mf : file system model
+        files : contents by path of names or FIDs
+        current : snapshot of the card
+    """
+    image = Snapshot()
+    for path_str, contents in files.items():
+        ef = lookup_name_path(mf, path_str.split('/'))
+        if not isinstance(ef, CardEF):
+            raise ValueError('%s: no such EF' % path_str)
+        path = ef.fully_qualified_path(prefer_name=False)
+        cur = current.files.get('/'.join(path), None) if current else None
+        fs = FileSnapshot(path, ef.fully_qualified_path_str(), _structure_of(ef))
+        fs.file = ef
+        if isinstance(ef, BerTlvEF):
+            fs.dos = {int(str(t), 16) if isinstance(t, str) else t: h2b(v) for t, v in contents.items()}
+        elif isinstance(ef, LinFixedEF):
+            rec_len = cur.record_len if cur else None
+            fs.records = {}
+            for rec_nr, data in contents.items():
+                rec_nr = int(rec_nr)
+                if isinstance(data, str):
+                    fs.records[rec_nr] = h2b(data)
+                else:
+                    fs.records[rec_nr] = bytes(ef.encode_record_bin(data, rec_nr, total_len=rec_len))
+        elif isinstance(ef, TransparentEF):
+            if isinstance(contents, str):
+                fs.body = h2b(contents)
+            else:
+                size = len(cur.body) if cur and cur.body is not None else None
+                fs.body = bytes(ef.encode_bin(contents, total_len=size))
+        image.files[fs.path_str] = fs
+    return image
+
+def image_from_saip(pes, mf: CardMF) -> Snapshot:
+    """Build a desired image from the file contents of a SAIP profile.
+
+    Args:
+        pes : pySim.esim.saip.ProfileElementSequence
+        mf : file system model, used to identify the ADFs
+    """
+    from pySim.esim.saip import FsNodeEF, FsNodeADF
+    image = Snapshot()
+
+    def node_path(node) -> Optional[List[str]]:
+        if node.parent is None or node.parent == node:
+            return [mf.fid]
+        ppath = node_path(node.parent)
+        if ppath is None:
+            return None
+        if isinstance(node, FsNodeADF):
+            aid = b2h(node.df_name)
+            adf = next((a for a in mf.applications.values() if aid.startswith(a.aid)), None)
+            return ppath + [adf.aid] if adf else None
+        return ppath + ['%04x' % node.fid]
+
+    def add_file(node):
+        if not isinstance(node, FsNodeEF) or node.file.body is None:
+            return
+        path = node_path(node)
+        if path is None:
+            return
+        file = node.file
+        fs = FileSnapshot(path, node.name_path_str)
+        fs.file = lookup_path(mf, path)
+        if fs.file is not None:
+            fs.name = fs.file.fully_qualified_path_str()
+        if file.file_type == 'TR':
+            fs.structure = 'transparent'
+            fs.body = bytes(file.body)
+        elif file.file_type in ['LF', 'CY'] and file.rec_len:
+            fs.structure = 'linear_fixed' if file.file_type == 'LF' else 'cyclic'
+            fs.records = {i // file.rec_len + 1: bytes(file.body[i:i+file.rec_len])
+                          for i in range(0, len(file.body), file.rec_len)}
+        elif file.file_type == 'BT':
+            fs.structure = 'ber_tlv'
+            fs.dos = {}
+            remainder = bytes(file.body)
+            while remainder and remainder[0] != 0xff:
+                tag = remainder[0]
+                _tagdict, _l, value, remainder = bertlv_parse_one(remainder)
+                fs.dos[tag] = value
+        else:
+            return
+        image.files[fs.path_str] = fs
+
+    pes.mf.walk(add_file)
+    return image
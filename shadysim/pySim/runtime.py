@@ -17,11 +17,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Iterable, List
 from osmocom.utils import h2b, i2h, is_hex, Hexstr
 from osmocom.tlv import bertlv_parse_one
 
 from pySim.exceptions import *
+from pySim.utils import ResTuple
 from pySim.filesystem import *
 
 def lchan_nr_from_cla(cla: int) -> int:
@@ -225,6 +226,17 @@ class RuntimeLchan:
     def selected_file_maximum_file_size(self) -> Optional[int]:
         return self.selected_file_fcp['proprietary_information'].get('maximum_file_size')
 
+    def selected_file_path(self) -> List[str]:
+        """Path of the selected file as used by SimCardCommands.select_path().  As long as nothing else
+        was selected on the lchan since select_file(), this is the path starting at the MF (with ADFs
+        identified by their AID), which SimCardCommands accesses without selecting it again.
+        Otherwise, it is just the FID of the file, which is selected relative to the current DF
+        instead of re-selecting the entire path (including the ADF, which resets it on some cards)."""
+        path = self.selected_file.fully_qualified_path(prefer_name=False)
+        if not self.selected_file.fid or self.scc.get_selected_path() == [fid.lower() for fid in path]:
+            return path
+        return [self.selected_file.fid]
+
     def get_cwd(self) -> CardDF:
         """Obtain the current working directory.
 
@@ -271,12 +283,7 @@ class RuntimeLchan:
 
         for p in pathlist:
             # Look for the next file in the path list
-            selectables = file.get_selectables()
-            file = None
-            for selectable in selectables:
-                if selectable == p:
-                    file = selectables[selectable]
-                    break
+            file = file.get_selectables().get(p, None)
 
             # When we hit none, then the given path must be invalid
             if file is None:
@@ -384,10 +391,9 @@ class RuntimeLchan:
             #
             # To automate this escape-route we will first select an arbitrary ADF that has file system support first
             # and then continue normally.
-            for selectable in self.rs.mf.get_selectables().items():
-                if isinstance(selectable[1], CardADF) and selectable[1].has_fs == True:
-                    self.select(selectable[1].name, cmd_app)
-                    break
+            escape_adf = next((adf for adf in self.rs.mf.applications.values() if adf.has_fs), None)
+            if escape_adf:
+                self.select_file(escape_adf, cmd_app)
 
         # we need to find a path from our self.selected_file to the destination
         inter_path = self.selected_file.build_select_path_to(file)
@@ -401,7 +407,8 @@ class RuntimeLchan:
         selected_file = self.selected_file
         data = self.selected_file_fcp_hex
 
-        for f in inter_path:
+        for from_mf, files in self._select_steps(inter_path):
+            f = files[-1]
             try:
                 # We now directly accessing the card to perform the selection. This
                 # will change the state of the card, so we must take care to update
@@ -412,6 +419,8 @@ class RuntimeLchan:
                 # card state and the state of the lchan.
                 if isinstance(f, CardADF):
                     (data, _sw) = self.rs.card.select_adf_by_aid(f.aid, scc=self.scc)
+                elif len(files) > 1 or from_mf:
+                    (data, _sw) = self._select_by_path(from_mf, files)
                 else:
                     (data, _sw) = self.scc.select_file(f.fid)
                 selected_file = f
@@ -419,8 +428,66 @@ class RuntimeLchan:
                 self._select_post(cmd_app, selected_file, data)
                 raise swm
 
+        if data:
+            self.scc.set_selected_path(f.fully_qualified_path(prefer_name=False), data)
         self._select_post(cmd_app, f, data)
 
+    def _select_steps(self, inter_path: List[CardFile]) -> List[Tuple[bool, List[CardFile]]]:
+        """Group the files of a path returned by build_select_path_to() into SELECT commands: on a
+        UICC, a descent from the MF (whether or not the MF itself is part of the path), or a descent
+        of two or more levels from the current directory, is selected with one SELECT by path.
+
+        Returns:
+            list of (from_mf, files) tuples; from_mf: SELECT by path from the MF (the MF itself is
+            not part of files), files: files to select (only the last one if not by path)
+        """
+        if not self.scc.supports_select_by_path:
+            return [(False, [f]) for f in inter_path]
+        cur = self.selected_file if isinstance(self.selected_file, CardDF) else self.selected_file.parent
+        steps = []
+        i = 0
+        while i < len(inter_path):
+            f = inter_path[i]
+            from_mf = f == self.rs.mf
+            if from_mf:
+                parent = f
+                i += 1
+            elif f.parent != cur and f.parent == self.rs.mf and i + 1 < len(inter_path):
+                # a descent from the MF which does not start in the current directory
+                from_mf = True
+                parent = f.parent
+            else:
+                parent = cur
+            run = []
+            while i < len(inter_path) and not isinstance(inter_path[i], CardADF) and inter_path[i].parent == parent:
+                run.append(inter_path[i])
+                parent = inter_path[i]
+                i += 1
+            if from_mf:
+                steps.append((True, run) if run else (False, [f]))
+            elif run:
+                steps.append((False, run))
+            else:
+                steps.append((False, [f]))
+                i += 1
+            last = steps[-1][1][-1]
+            cur = last if isinstance(last, CardDF) else last.parent
+        return steps
+
+    def _select_by_path(self, from_mf: bool, files: List[CardFile]) -> ResTuple:
+        try:
+            return self.scc.select_by_path([f.fid for f in files], from_mf)
+        except SwMatchError as swm:
+            if swm.sw_actual == '6a82':
+                raise swm
+        # the card does not support SELECT by path (as we use it), select one file after another
+        self.scc.use_select_by_path = False
+        if from_mf:
+            self.scc.select_file(self.rs.mf.fid)
+        for f in files:
+            (data, sw) = self.scc.select_file(f.fid)
+        return (data, sw)
+
     def select(self, name: str, cmd_app=None):
         """Select a file (EF, DF, ADF, MF, ...).
 
@@ -492,7 +559,7 @@ class RuntimeLchan:
         if not isinstance(self.selected_file, TransparentEF):
             raise TypeError("Only works with TransparentEF, but %s is %s" % (self.selected_file,
                                                                              self.selected_file.__class__.__mro__))
-        return self.scc.read_binary(self.selected_file.fid, length, offset)
+        return self.scc.read_binary(self.selected_file_path(), length, offset)
 
     def read_binary_dec(self) -> Tuple[dict, str]:
         """Read [part of] a transparent EF binary data and decode it.
@@ -517,7 +584,7 @@ class RuntimeLchan:
         if not isinstance(self.selected_file, TransparentEF):
             raise TypeError("Only works with TransparentEF, but %s is %s" % (self.selected_file,
                                                                              self.selected_file.__class__.__mro__))
-        return self.scc.update_binary(self.selected_file.fid, data_hex, offset, conserve=self.rs.conserve_write)
+        return self.scc.update_binary(self.selected_file_path(), data_hex, offset, conserve=self.rs.conserve_write)
 
     def update_binary_dec(self, data: dict):
         """Update transparent EF from abstract data. Encodes the data to binary and
@@ -541,7 +608,21 @@ class RuntimeLchan:
             raise TypeError("Only works with Linear Fixed EF, but %s is %s" % (self.selected_file,
                                                                                self.selected_file.__class__.__mro__))
         # returns a string of hex nibbles
-        return self.scc.read_record(self.selected_file.fid, rec_nr)
+        return self.scc.read_record(self.selected_file_path(), rec_nr)
+
+    def read_records(self, rec_nrs: Optional[Iterable[int]] = None, skip_empty: bool = False):
+        """Read several records as binary data, selecting the EF only once.
+
+        Args:
+            rec_nrs : Record numbers to read (default: all records)
+            skip_empty : Skip records consisting of 0xFF only
+        Returns:
+            iterator of (record number, (hex string of binary data contained in record, sw))
+        """
+        if not isinstance(self.selected_file, LinFixedEF):
+            raise TypeError("Only works with Linear Fixed EF, but %s is %s" % (self.selected_file,
+                                                                               self.selected_file.__class__.__mro__))
+        return self.scc.read_records(self.selected_file_path(), rec_nrs, skip_empty)
 
     def read_record_dec(self, rec_nr: int = 0) -> Tuple[dict, str]:
         """Read a record and decode it to abstract data.
@@ -564,7 +645,7 @@ class RuntimeLchan:
         if not isinstance(self.selected_file, LinFixedEF):
             raise TypeError("Only works with Linear Fixed EF, but %s is %s" % (self.selected_file,
                                                                                self.selected_file.__class__.__mro__))
-        return self.scc.update_record(self.selected_file.fid, rec_nr, data_hex,
+        return self.scc.update_record(self.selected_file_path(), rec_nr, data_hex,
 					       conserve=self.rs.conserve_write,
 					       leftpad=self.selected_file.leftpad)
 
@@ -579,6 +660,125 @@ class RuntimeLchan:
         data_hex = self.selected_file.encode_record_hex(data, rec_nr, self.selected_file_record_len())
         return self.update_record(rec_nr, data_hex)
 
+    def _ef_access_pre(self, ef: CardEF, ef_class: type, cmd_app=None) -> List[str]:
+        """Prepare accessing an EF without selecting it first; returns its path for SimCardCommands."""
+        if not isinstance(ef, ef_class):
+            raise TypeError("Only works with %s, but %s is %s" % (ef_class.__name__, ef,
+                                                                  ef.__class__.__mro__))
+        path = ef.fully_qualified_path(prefer_name=False)
+        if not self.scc.sfi_usable(path, ef.sfid) and \
+           self.scc.get_selected_path() != [fid.lower() for fid in path]:
+            # select it the usual way, which takes the shortest route from the selected file
+            self.select_file(ef, cmd_app)
+        self.unregister_cmds(cmd_app)
+        return path
+
+    def _ef_access_post(self, ef: CardEF, path: List[str], cmd_app=None, failed: bool = False):
+        """Update the local state after accessing an EF, which is now the selected file on the card.
+        After a failed access (failed=True), errors are not raised, so that the caller can report
+        the one of the access itself."""
+        if self.scc.get_selected_path() == [fid.lower() for fid in path]:
+            self._select_post(cmd_app, ef, self.scc.get_known_fcp(path))
+            return
+        # the access failed, leaving us somewhere on the way to the EF; start over at the MF
+        self._select_post(cmd_app)
+        try:
+            self.select_file(self.rs.mf, cmd_app)
+        except Exception:
+            if not failed:
+                raise
+            # what is selected on the card is unknown now
+            self.scc.invalidate_selection()
+
+    def read_ef_binary(self, ef: TransparentEF, length: int = None, offset: int = 0,
+                       cmd_app=None) -> ResTuple:
+        """Read [part of] the binary data of a transparent EF, which becomes the selected file.  Unlike
+        select_file() followed by read_binary(), this addresses the EF by its SFI if it has one and its
+        DF (or another EF of it) is selected, saving the SELECT command.
+
+        Args:
+            ef : TransparentEF instance of the EF to read
+            length : Amount of data to read (None: as much as possible)
+            offset : Offset into the file from which to read 'length' bytes
+            cmd_app : Command Application State (for unregistering old file commands)
+        Returns:
+            binary data read from the file
+        """
+        path = self._ef_access_pre(ef, TransparentEF, cmd_app)
+        try:
+            res = self.scc.read_binary(path, length, offset, sfi=ef.sfid)
+        except Exception:
+            self._ef_access_post(ef, path, cmd_app, failed=True)
+            raise
+        self._ef_access_post(ef, path, cmd_app)
+        return res
+
+    def update_ef_binary(self, ef: TransparentEF, data_hex: str, offset: int = 0,
+                         conserve: Optional[bool] = None, cmd_app=None) -> ResTuple:
+        """Update the binary data of a transparent EF, which becomes the selected file (see
+        read_ef_binary).
+
+        Args:
+            ef : TransparentEF instance of the EF to update
+            data_hex : hex string of data to be written
+            offset : Offset into the file from which to write 'data_hex'
+            conserve : skip the write if the data is already there (None: as configured)
+            cmd_app : Command Application State (for unregistering old file commands)
+        """
+        path = self._ef_access_pre(ef, TransparentEF, cmd_app)
+        if conserve is None:
+            conserve = self.rs.conserve_write
+        try:
+            res = self.scc.update_binary(path, data_hex, offset, conserve=conserve, sfi=ef.sfid)
+        except Exception:
+            self._ef_access_post(ef, path, cmd_app, failed=True)
+            raise
+        self._ef_access_post(ef, path, cmd_app)
+        return res
+
+    def read_ef_record(self, ef: LinFixedEF, rec_nr: int, cmd_app=None) -> ResTuple:
+        """Read a record of a linear fixed EF, which becomes the selected file (see read_ef_binary).
+
+        Args:
+            ef : LinFixedEF instance of the EF to read
+            rec_nr : Record number to read
+            cmd_app : Command Application State (for unregistering old file commands)
+        Returns:
+            hex string of binary data contained in record
+        """
+        path = self._ef_access_pre(ef, LinFixedEF, cmd_app)
+        try:
+            res = self.scc.read_record(path, rec_nr, sfi=ef.sfid)
+        except Exception:
+            self._ef_access_post(ef, path, cmd_app, failed=True)
+            raise
+        self._ef_access_post(ef, path, cmd_app)
+        return res
+
+    def update_ef_record(self, ef: LinFixedEF, rec_nr: int, data_hex: str, force_len: bool = False,
+                         conserve: Optional[bool] = None, cmd_app=None) -> ResTuple:
+        """Update a record of a linear fixed EF, which becomes the selected file (see read_ef_binary).
+
+        Args:
+            ef : LinFixedEF instance of the EF to update
+            rec_nr : Record number to update
+            data_hex : Hex string binary data to be written
+            force_len : enforce the record length by the length of 'data_hex'
+            conserve : skip the write if the data is already there (None: as configured)
+            cmd_app : Command Application State (for unregistering old file commands)
+        """
+        path = self._ef_access_pre(ef, LinFixedEF, cmd_app)
+        if conserve is None:
+            conserve = self.rs.conserve_write
+        try:
+            res = self.scc.update_record(path, rec_nr, data_hex, force_len=force_len,
+                                         conserve=conserve, leftpad=ef.leftpad, sfi=ef.sfid)
+        except Exception:
+            self._ef_access_post(ef, path, cmd_app, failed=True)
+            raise
+        self._ef_access_post(ef, path, cmd_app)
+        return res
+
     def retrieve_data(self, tag: int = 0):
         """Read a DO/TLV as binary data.
 
@@ -590,7 +790,7 @@ class RuntimeLchan:
         if not isinstance(self.selected_file, BerTlvEF):
             raise TypeError("Only works with BER-TLV EF")
         # returns a string of hex nibbles
-        return self.scc.retrieve_data(self.selected_file.fid, tag)
+        return self.scc.retrieve_data(self.selected_file_path(), tag)
 
     def retrieve_tags(self):
         """Retrieve tags available on BER-TLV EF.
@@ -601,7 +801,7 @@ class RuntimeLchan:
         if not isinstance(self.selected_file, BerTlvEF):
             raise TypeError("Only works with BER-TLV EF, but %s is %s" % (self.selected_file,
                                                                           self.selected_file.__class__.__mro__))
-        data, _sw = self.scc.retrieve_data(self.selected_file.fid, 0x5c)
+        data, _sw = self.scc.retrieve_data(self.selected_file_path(), 0x5c)
         _tag, _length, value, _remainder = bertlv_parse_one(h2b(data))
         return list(value)
 
@@ -615,7 +815,7 @@ class RuntimeLchan:
         if not isinstance(self.selected_file, BerTlvEF):
             raise TypeError("Only works with BER-TLV EF, but %s is %s" % (self.selected_file,
                                                                           self.selected_file.__class__.__mro__))
-        return self.scc.set_data(self.selected_file.fid, tag, data_hex, conserve=self.rs.conserve_write)
+        return self.scc.set_data(self.selected_file_path(), tag, data_hex, conserve=self.rs.conserve_write)
 
     def register_cmds(self, cmd_app=None):
         """Register command set that is associated with the currently selected file"""
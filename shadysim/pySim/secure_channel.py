@@ -18,7 +18,7 @@
 import abc
 from osmocom.utils import b2h, h2b, Hexstr
 
-from pySim.utils import ResTuple
+from pySim.utils import ResTuple, ResTupleBin
 
 class SecureChannel(abc.ABC):
     @abc.abstractmethod
@@ -37,3 +37,10 @@ class SecureChannel(abc.ABC):
         res, sw = send_fn(pdu_wrapped, *args, **kwargs)
         res_unwrapped = b2h(self.unwrap_rsp_apdu(h2b(sw), h2b(res)))
         return res_unwrapped, sw
+
+    def send_apdu_wrapper_bin(self, send_fn: callable, pdu: bytes, *args, **kwargs) -> ResTupleBin:
+        """Binary variant of send_apdu_wrapper(), to be used around send_apdu_bin style callables."""
+        pdu_wrapped = self.wrap_cmd_apdu(pdu)
+        res, sw = send_fn(pdu_wrapped, *args, **kwargs)
+        res_unwrapped = self.unwrap_rsp_apdu(bytes.fromhex(sw), res)
+        return res_unwrapped, sw
@@ -56,10 +56,115 @@ class UserDataHeader:
         res = cls._construct.parse(inb)
         return cls(res['ies']), res['data']
 
+    def get_ie(self, iei:int) -> typing.Optional[dict]:
+        for ie in self.ies:
+            if ie['iei'] == iei:
+                return ie
+        return None
+
+    def concat_info(self) -> typing.Optional[typing.Tuple[int, int, int]]:
+        """Return (reference, total, sequence) of a concatenated SMS, or None if the UDH
+        does not contain a concatenation IE (3GPP TS 23.040 Section 9.2.3.24.1 + 9.2.3.24.8)."""
+        ie = self.get_ie(IEI_CONCAT_8BIT)
+        if ie:
+            return ie['value'][0], ie['value'][1], ie['value'][2]
+        ie = self.get_ie(IEI_CONCAT_16BIT)
+        if ie:
+            return int.from_bytes(ie['value'][:2], 'big'), ie['value'][2], ie['value'][3]
+        return None
+
     def to_bytes(self) -> bytes:
         return self._construct.build({'ies':self.ies, 'data':b''})
 
 
+# Information Element Identifiers for concatenated short messages
+IEI_CONCAT_8BIT = 0x00
+IEI_CONCAT_16BIT = 0x08
+
+def concat_ie(ref: int, total: int, seq: int, ref16: bool = False) -> dict:
+    """Build a concatenated short message IE for use in a UserDataHeader."""
+    if ref16:
+        return {'iei': IEI_CONCAT_16BIT, 'length': 4, 'value': ref.to_bytes(2, 'big') + bytes([total, seq])}
+    return {'iei': IEI_CONCAT_8BIT, 'length': 3, 'value': bytes([ref & 0xff, total, seq])}
+
+def _udh_len(ies: list) -> int:
+    """Length of the encoded UDH (including the UDHL octet) for given IEs."""
+    return 1 + sum(2 + ie['length'] for ie in ies)
+
+def concat_sms_capacity(num_segments: int, ies: list = [], ref16: bool = False,
+                        max_ud_len: int = 140) -> int:
+    """Compute how many octets of payload fit into the given number of (concatenated) SMS,
+    if ies are sent in the UDH of the first segment."""
+    if num_segments <= 1:
+        return max_ud_len - _udh_len(ies)
+    concat_len = 2 + (4 if ref16 else 3)
+    first = max_ud_len - _udh_len(ies) - concat_len
+    other = max_ud_len - 1 - concat_len
+    return first + (num_segments - 1) * other
+
+def concat_sms_segments(data: bytes, ies: list = [], ref: int = 0, ref16: bool = False,
+                        max_ud_len: int = 140) -> typing.List[bytes]:
+    """Split data into the TP-UD of one or more short messages.  If the data does not fit into a
+    single SMS, a concatenated SMS is generated.  The ies (e.g. the CPI of a secured OTA command
+    packet) are only put into the UDH of the first segment, as required by 3GPP TS 31.115 Section 4.
+
+    Args:
+        data : payload to be sent
+        ies : list of UDH IEs for the first segment
+        ref : concatenated short message reference number
+        ref16 : use 16-bit reference numbers (IEI 0x08) instead of 8-bit ones (IEI 0x00)
+        max_ud_len : maximum length of the TP-UD in octets
+    Returns:
+        list of TP-UD (including UDH) for each segment
+    """
+    if len(data) <= concat_sms_capacity(1, ies, max_ud_len=max_ud_len):
+        return [UserDataHeader(ies).to_bytes() + data]
+
+    # determine payload size of first and subsequent segments
+    other_len = max_ud_len - _udh_len([concat_ie(0, 0, 0, ref16)])
+    first_len = max_ud_len - _udh_len(ies + [concat_ie(0, 0, 0, ref16)])
+    total = 1 + (len(data) - first_len + other_len - 1) // other_len
+    if total > 255:
+        raise ValueError('Cannot encode %u octets in at most 255 concatenated SMS' % len(data))
+
+    data = memoryview(data)
+    segments = [UserDataHeader(ies + [concat_ie(ref, total, 1, ref16)]).to_bytes() + data[:first_len]]
+    for seq, offset in enumerate(range(first_len, len(data), other_len), start=2):
+        udh = UserDataHeader([concat_ie(ref, total, seq, ref16)]).to_bytes()
+        segments.append(udh + data[offset:offset+other_len])
+    return segments
+
+
+class ConcatSmsReassembler:
+    """Reassemble concatenated short messages (e.g. a multi-part OTA PoR) from the TP-UD of
+    their segments, which may be received in any order."""
+
+    def __init__(self):
+        self.pending = {}
+
+    def feed(self, ud: BytesOrHex) -> typing.Optional[typing.Tuple[UserDataHeader, bytes]]:
+        """Feed the TP-UD (including UDH) of a received SMS into the reassembler.
+
+        Returns:
+            None if further segments are outstanding; else a tuple of the UDH of the first segment
+            (without the concatenation IE) and the reassembled payload.
+        """
+        udh, data = UserDataHeader.from_bytes(ud)
+        concat = udh.concat_info()
+        if concat is None:
+            return udh, data
+        ref, total, seq = concat
+        if seq < 1 or seq > total:
+            raise ValueError('Invalid concatenated SMS sequence number %u/%u' % (seq, total))
+        parts = self.pending.setdefault((ref, total), {})
+        parts[seq] = (udh, data)
+        if len(parts) < total:
+            return None
+        del self.pending[(ref, total)]
+        ies = [ie for ie in parts[1][0].ies if ie['iei'] not in (IEI_CONCAT_8BIT, IEI_CONCAT_16BIT)]
+        return UserDataHeader(ies), b''.join(parts[i][1] for i in range(1, total+1))
+
+
 def smpp_dcs_is_8bit(dcs: pdu_types.DataCoding) -> bool:
     """Determine if the given SMPP data coding scheme is 8-bit or not."""
     if dcs == pdu_types.DataCoding(pdu_types.DataCodingScheme.DEFAULT,
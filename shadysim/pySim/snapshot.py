@@ -0,0 +1,469 @@
+# coding=utf-8
+"""Snapshots of the file contents of a card.
+
+A snapshot holds the raw contents of all EFs of the file system model (MF and the file system of
+each ADF) that exist on a card.  dump_card() traverses the model depth-first, so that each SELECT
+only moves a short way from the previously selected file, and passes each file to a SnapshotWriter
+as soon as it is read.  The container written by the SnapshotWriter is a magic string followed by a
+sequence of BER-TLV entries:
+
+    E0 header: 80 ATR, 81 creation time (ISO 8601)
+    E1 file:   80 path (FIDs / AIDs, '/' separated), 81 path (names), 82 structure,
+               83 SELECT response, 84 SW (file not selectable/readable), 85 contents (transparent),
+               86 record number + record contents (repeated), 87 BER-TLV data object (repeated,
+               single-byte tags as returned by RETRIEVE DATA of the tag list)
+
+Only the raw data is stored; FileSnapshot.decoded decodes it (via the CardFile of the file system
+model) on first access.
+"""
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import datetime
+from typing import BinaryIO, Dict, Iterator, List, Optional
+
+from osmocom.utils import h2b, b2h, Hexstr
+from osmocom.tlv import bertlv_encode_len, bertlv_parse_one
+
+from pySim.exceptions import SwMatchError
+from pySim.filesystem import CardFile, CardDF, CardMF, CardEF, TransparentEF, LinFixedEF, CyclicEF, BerTlvEF
+from pySim.runtime import RuntimeLchan
+
+SNAPSHOT_MAGIC = b'pySIMsnp\x01'
+
+# tags of the container entries
+TAG_HEADER = 0xE0
+TAG_FILE = 0xE1
+# tags within the header
+TAG_ATR = 0x80
+TAG_CREATED = 0x81
+# tags within a file
+TAG_PATH = 0x80
+TAG_NAME = 0x81
+TAG_STRUCTURE = 0x82
+TAG_FCP = 0x83
+TAG_SW = 0x84
+TAG_BODY = 0x85
+TAG_RECORD = 0x86
+TAG_DO = 0x87
+# tags of the SELECT response (ETSI TS 102 221, section 11.1.1.3)
+TAG_FCP_TEMPLATE = 0x62
+TAG_FILE_DESCRIPTOR = 0x82
+
+
+def _tlv(tag: int, value: bytes) -> bytes:
+    return bytes([tag]) + bertlv_encode_len(len(value)) + value
+
+def _iter_tlvs(buf: bytes) -> Iterator[tuple]:
+    """Iterate over the (tag, value) of a sequence of TLVs with single-byte tags."""
+    buf = memoryview(buf)
+    i = 0
+    while i < len(buf):
+        tag = buf[i]
+        length = buf[i+1]
+        i += 2
+        if length & 0x80:
+            num_len_oct = length & 0x7f
+            length = int.from_bytes(buf[i:i+num_len_oct], 'big')
+            i += num_len_oct
+        yield tag, bytes(buf[i:i+length])
+        i += length
+
+def _read_tlv(f: BinaryIO) -> Optional[tuple]:
+    """Read a TLV with single-byte tag from a file; returns None at the end of the file."""
+    hdr = f.read(2)
+    if not hdr:
+        return None
+    if len(hdr) < 2:
+        raise ValueError('Truncated snapshot')
+    length = hdr[1]
+    if length & 0x80:
+        length = int.from_bytes(f.read(length & 0x7f), 'big')
+    value = f.read(length)
+    if len(value) < length:
+        raise ValueError('Truncated snapshot')
+    return hdr[0], value
+
+
+def lookup_path(mf: CardMF, path: List[str]) -> Optional[CardFile]:
+    """Find the file with the given path (FIDs starting with the MF, ADFs identified by their AID)
+    in a file system model."""
+    if not path or path[0] != mf.fid:
+        return None
+    node = mf
+    for elem in path[1:]:
+        if len(elem) > 4:
+            node = mf.applications.get(elem, None) if node == mf else None
+        elif isinstance(node, CardDF):
+            node = node.children.get(elem, None)
+        else:
+            node = None
+        if node is None:
+            return None
+    return node
+
+
+class FileSnapshot:
+    """Contents of one file of the card."""
+
+    def __init__(self, path: List[str], name: Optional[str] = None, structure: Optional[str] = None,
+                 fcp: Optional[bytes] = None, sw: Optional[Hexstr] = None, body: Optional[bytes] = None,
+                 records: Optional[Dict[int, bytes]] = None, dos: Optional[Dict[int, bytes]] = None):
+        """
+        Args:
+            path : path of the file (FIDs starting with the MF, ADFs identified by their AID)
+            name : path of the file as names (for display)
+            structure : file structure ('transparent', 'linear_fixed', 'cyclic' or 'ber_tlv')
+            fcp : SELECT response of the file
+            sw : status word, if the file could not be selected or read
+            body : contents of a transparent EF
+            records : contents of the records of a linear fixed / cyclic EF, by record number
+            dos : values of the data objects of a BER-TLV EF, by tag
+        """
+        self.path = path
+        self.name = name
+        self.structure = structure
+        self.fcp = fcp
+        self.sw = sw
+        self.body = body
+        self.records = records
+        self.dos = dos
+        # CardFile of the file system model (if known), used for decoding
+        self.file = None # type: Optional[CardFile]
+        self._decoded = None
+
+    @property
+    def path_str(self) -> str:
+        return '/'.join(self.path)
+
+    @property
+    def size(self) -> int:
+        """Number of bytes of contents."""
+        if self.body is not None:
+            return len(self.body)
+        if self.records is not None:
+            return sum([len(r) for r in self.records.values()])
+        if self.dos is not None:
+            return sum([len(v) for v in self.dos.values()])
+        return 0
+
+    def _file_descriptor(self) -> Optional[bytes]:
+        if not self.fcp or self.fcp[0] != TAG_FCP_TEMPLATE:
+            return None
+        for tag, fcp in _iter_tlvs(self.fcp):
+            for inner_tag, value in _iter_tlvs(fcp):
+                if inner_tag == TAG_FILE_DESCRIPTOR:
+                    return value
+        return None
+
+    @property
+    def record_len(self) -> Optional[int]:
+        """Record length of a linear fixed / cyclic EF, from its SELECT response."""
+        fd = self._file_descriptor()
+        if fd is None or len(fd) < 4:
+            return None
+        return int.from_bytes(fd[2:4], 'big')
+
+    @property
+    def num_records(self) -> Optional[int]:
+        """Number of records of a linear fixed / cyclic EF, from its SELECT response."""
+        fd = self._file_descriptor()
+        if fd is None or len(fd) < 5:
+            return None
+        return fd[4]
+
+    @property
+    def decoded(self):
+        """Contents decoded by the CardFile of the file system model (None if not available)."""
+        if self._decoded is None and self.file is not None and self.sw is None:
+            if self.body is not None and isinstance(self.file, TransparentEF):
+                self._decoded = self.file.decode_bin(self.body)
+            elif self.records is not None and isinstance(self.file, LinFixedEF):
+                self._decoded = {r: self.file.decode_record_bin(d, r) for r, d in self.records.items()}
+            elif self.dos is not None:
+                self._decoded = {t: b2h(v) for t, v in self.dos.items()}
+        return self._decoded
+
+    def to_bytes(self) -> bytes:
+        """Encode as container entry."""
+        val = _tlv(TAG_PATH, '/'.join(self.path).encode())
+        if self.name:
+            val += _tlv(TAG_NAME, self.name.encode())
+        if self.structure:
+            val += _tlv(TAG_STRUCTURE, self.structure.encode())
+        if self.fcp:
+            val += _tlv(TAG_FCP, self.fcp)
+        if self.sw:
+            val += _tlv(TAG_SW, h2b(self.sw))
+        if self.body is not None:
+            val += _tlv(TAG_BODY, self.body)
+        if self.records is not None:
+            val += b''.join([_tlv(TAG_RECORD, bytes([r]) + d) for r, d in self.records.items()])
+        if self.dos is not None:
+            val += b''.join([_tlv(TAG_DO, _tlv(t, v)) for t, v in self.dos.items()])
+        return _tlv(TAG_FILE, val)
+
+    @classmethod
+    def from_bytes(cls, val: bytes) -> 'FileSnapshot':
+        """Decode the value of a container entry."""
+        fs = cls([])
+        for tag, v in _iter_tlvs(val):
+            if tag == TAG_PATH:
+                fs.path = v.decode().split('/')
+            elif tag == TAG_NAME:
+                fs.name = v.decode()
+            elif tag == TAG_STRUCTURE:
+                fs.structure = v.decode()
+            elif tag == TAG_FCP:
+                fs.fcp = v
+            elif tag == TAG_SW:
+                fs.sw = b2h(v)
+            elif tag == TAG_BODY:
+                fs.body = v
+            elif tag == TAG_RECORD:
+                if fs.records is None:
+                    fs.records = {}
+                fs.records[v[0]] = v[1:]
+            elif tag == TAG_DO:
+                if fs.dos is None:
+                    fs.dos = {}
+                for do_tag, do_val in _iter_tlvs(v):
+                    fs.dos[do_tag] = do_val
+        # files without any (non-empty) records / data objects
+        if fs.sw is None:
+            if fs.structure in ['linear_fixed', 'cyclic'] and fs.records is None:
+                fs.records = {}
+            elif fs.structure == 'ber_tlv' and fs.dos is None:
+                fs.dos = {}
+        return fs
+
+    def __str__(self) -> str:
+        if self.sw:
+            return '%s: %s' % (self.name or self.path_str, self.sw)
+        return '%s: %s, %u bytes' % (self.name or self.path_str, self.structure, self.size)
+
+
+class SnapshotWriter:
+    """Write a snapshot container to a (binary) file, one file entry at a time."""
+
+    def __init__(self, f: BinaryIO, atr: Optional[bytes] = None, created: Optional[str] = None):
+        self.f = f
+        if created is None:
+            created = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+        hdr = _tlv(TAG_CREATED, created.encode())
+        if atr:
+            hdr = _tlv(TAG_ATR, atr) + hdr
+        f.write(SNAPSHOT_MAGIC + _tlv(TAG_HEADER, hdr))
+
+    def write(self, fs: FileSnapshot):
+        self.f.write(fs.to_bytes())
+
+
+class SnapshotReader:
+    """Read a snapshot container from a (binary) file.  Iterating over it yields the FileSnapshots
+    one after another, without keeping them in memory."""
+
+    def __init__(self, f: BinaryIO, mf: Optional[CardMF] = None):
+        """
+        Args:
+            f : file to read from
+            mf : MF of a file system model, used to decode the file contents
+        """
+        self.f = f
+        self.mf = mf
+        self.atr = None
+        self.created = None
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError('Not a snapshot (or unsupported version)')
+        tlv = _read_tlv(f)
+        if tlv is None or tlv[0] != TAG_HEADER:
+            raise ValueError('Snapshot lacks header')
+        for tag, v in _iter_tlvs(tlv[1]):
+            if tag == TAG_ATR:
+                self.atr = v
+            elif tag == TAG_CREATED:
+                self.created = v.decode()
+
+    def __iter__(self) -> Iterator[FileSnapshot]:
+        while True:
+            tlv = _read_tlv(self.f)
+            if tlv is None:
+                return
+            if tlv[0] != TAG_FILE:
+                continue
+            fs = FileSnapshot.from_bytes(tlv[1])
+            if self.mf:
+                fs.file = lookup_path(self.mf, fs.path)
+            yield fs
+
+
+class Snapshot:
+    """A snapshot held in memory, with its FileSnapshots by path (as string)."""
+
+    def __init__(self, atr: Optional[bytes] = None, created: Optional[str] = None):
+        self.atr = atr
+        self.created = created
+        self.files = {} # type: Dict[str, FileSnapshot]
+
+    @classmethod
+    def load(cls, filename: str, mf: Optional[CardMF] = None) -> 'Snapshot':
+        """Read a snapshot from a file (see SnapshotReader)."""
+        with open(filename, 'rb') as f:
+            reader = SnapshotReader(f, mf)
+            snap = cls(reader.atr, reader.created)
+            for fs in reader:
+                snap.files[fs.path_str] = fs
+        return snap
+
+    def save(self, filename: str):
+        with open(filename, 'wb') as f:
+            writer = SnapshotWriter(f, self.atr, self.created)
+            for fs in self.files.values():
+                writer.write(fs)
+
+    def __getitem__(self, path: str) -> FileSnapshot:
+        return self.files[path]
+
+    def __iter__(self) -> Iterator[FileSnapshot]:
+        return iter(self.files.values())
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+
+class SnapshotStats:
+    """Statistics about taking a snapshot."""
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.unreadable = 0
+        self.skipped_dfs = 0
+        self.elapsed = 0.0
+
+    @property
+    def files_per_sec(self) -> float:
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return "Dumped %u files (%u bytes, %u not selectable/readable, %u DFs/ADFs absent) in %.1f s, %.1f files/s" % \
+            (self.files, self.bytes, self.unreadable, self.skipped_dfs, self.elapsed, self.files_per_sec)
+
+
+def _file_structure(lchan: RuntimeLchan, ef: CardEF) -> str:
+    """Determine the structure of the selected EF from its SELECT response, or from the model."""
+    try:
+        return lchan.selected_file_structure()
+    except (TypeError, KeyError):
+        pass
+    if isinstance(ef, BerTlvEF):
+        return 'ber_tlv'
+    if isinstance(ef, CyclicEF):
+        return 'cyclic'
+    if isinstance(ef, LinFixedEF):
+        return 'linear_fixed'
+    return 'transparent'
+
+def snapshot_ef(lchan: RuntimeLchan, ef: CardEF, skip_empty: bool = False) -> FileSnapshot:
+    """Select an EF and read its contents.  The EF is read according to the structure stated by the
+    card, which may differ from the one of the model (e.g. for the files of DF.PHONEBOOK)."""
+    fs = FileSnapshot(ef.fully_qualified_path(prefer_name=False), ef.fully_qualified_path_str())
+    fs.file = ef
+    try:
+        lchan.select_file(ef)
+    except SwMatchError as e:
+        fs.sw = e.sw_actual
+        return fs
+    if lchan.selected_file_fcp_hex:
+        fs.fcp = h2b(lchan.selected_file_fcp_hex)
+    fs.structure = _file_structure(lchan, ef)
+    # the RuntimeLchan read methods insist on the structure of the model, so use the SimCardCommands
+    scc = lchan.scc
+    path = lchan.selected_file_path()
+    try:
+        if fs.structure == 'transparent':
+            size = None
+            try:
+                size = lchan.selected_file_size()
+            except (TypeError, KeyError, AttributeError):
+                pass
+            data = ''
+            if size != 0:
+                data, _sw = scc.read_binary(path)
+            fs.body = h2b(data or '')
+        elif fs.structure in ['linear_fixed', 'cyclic']:
+            fs.records = {r: h2b(res[0]) for r, res in scc.read_records(path, skip_empty=skip_empty)}
+        elif fs.structure == 'ber_tlv':
+            fs.dos = {}
+            data, _sw = scc.retrieve_data(path, 0x5c)
+            _tag, _length, tags, _remainder = bertlv_parse_one(h2b(data))
+            for tag in tags:
+                data, _sw = scc.retrieve_data(path, tag)
+                do_tag, _l, value, _remainder = bertlv_parse_one(h2b(data))
+                fs.dos[tag] = value
+    except SwMatchError as e:
+        fs.sw = e.sw_actual
+        fs.body = fs.records = fs.dos = None
+    return fs
+
+def dump_card(lchan: RuntimeLchan, writer: SnapshotWriter, skip_empty: bool = False,
+              stats: Optional[SnapshotStats] = None) -> SnapshotStats:
+    """Take a snapshot of all EFs of the file system model that exist on the card.
+
+    The MF and then the file system of each ADF is traversed depth-first (EFs of a DF before its
+    sub-DFs, each in order of their FID).  DFs and ADFs which cannot be selected are skipped
+    with all of their contents; files which are not part of the model are not found.
+
+    Args:
+        lchan : logical channel to use
+        writer : SnapshotWriter to pass each FileSnapshot to
+        skip_empty : skip records consisting of 0xFF only
+        stats : SnapshotStats instance to be updated
+    """
+    stats = stats or SnapshotStats()
+    t_start = time.monotonic()
+
+    def walk(df: CardDF):
+        children = sorted(df.children.values(), key=lambda f: f.fid)
+        for ef in children:
+            if isinstance(ef, CardEF):
+                fs = snapshot_ef(lchan, ef, skip_empty)
+                writer.write(fs)
+                stats.files += 1
+                stats.bytes += fs.size
+                if fs.sw:
+                    stats.unreadable += 1
+        for sub_df in children:
+            if isinstance(sub_df, CardDF):
+                try:
+                    lchan.select_file(sub_df)
+                except SwMatchError:
+                    stats.skipped_dfs += 1
+                    continue
+                walk(sub_df)
+
+    mf = lchan.rs.mf
+    lchan.select_file(mf)
+    walk(mf)
+    for adf in mf.applications.values():
+        if not adf.has_fs:
+            continue
+        try:
+            lchan.select_file(adf)
+        except SwMatchError:
+            stats.skipped_dfs += 1
+            continue
+        walk(adf)
+    stats.elapsed = time.monotonic() - t_start
+    return stats
@@ -5,13 +5,14 @@
 
 import os
 import abc
+import time
 import argparse
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Callable, List, Generator
 from construct import Construct
 from osmocom.utils import b2h, h2b, i2h, Hexstr
 
 from pySim.exceptions import *
-from pySim.utils import SwHexstr, SwMatchstr, ResTuple, sw_match, parse_command_apdu
+from pySim.utils import SwHexstr, SwMatchstr, ResTuple, ResTupleBin, sw_match, parse_command_apdu, is_extended_apdu
 from pySim.cat import ProactiveCommand, CommandDetails, DeviceIdentities, Result
 
 #
@@ -33,6 +34,21 @@ from pySim.cat import ProactiveCommand, CommandDetails, DeviceIdentities, Result
 #
 
 
+# INS of the commands which neither change the currently selected file (unless they reference an EF by
+# SFI) nor the file system structure.  Any other command invalidates the selected_paths of its lchan.
+SELECTION_NEUTRAL_INS = frozenset([
+    0xb0, 0xd6, 0xb2, 0xdc, 0xa2,   # READ/UPDATE BINARY, READ/UPDATE/SEARCH RECORD
+    0x20, 0x24, 0x26, 0x28, 0x2c,   # VERIFY/CHANGE/DISABLE/ENABLE/UNBLOCK PIN
+    0x88, 0x89, 0x84,               # AUTHENTICATE, GET CHALLENGE
+    0xf2, 0xc0, 0xca, 0xcb, 0xdb,   # STATUS, GET RESPONSE, GET DATA, RETRIEVE/SET DATA
+])
+
+# INS of the commands which change the file system structure (and thus the FCP of files); they invalidate
+# all known_fcps.
+FS_CHANGING_INS = frozenset([
+    0xe0, 0xe4, 0xd4,               # CREATE FILE, DELETE FILE, RESIZE FILE
+])
+
 class ApduTracer:
     def trace_command(self, cmd):
         pass
@@ -72,16 +88,140 @@ class ProactiveHandler(abc.ABC):
     def prepare_response(self, pcmd: ProactiveCommand, general_result: str = 'performed_successfully'):
         # The Command Details are echoed from the command that has been processed.
         (command_details,) = [c for c in pcmd.children if isinstance(c, CommandDetails)]
-        # invert the device identities
+        # The TERMINAL RESPONSE is always sent by the terminal to the originator (UICC) of the command,
+        # irrespective of the destination (display, network, ...) of the command, see TS 102 223 Section 6.8
         (command_dev_ids,) = [c for c in pcmd.children if isinstance(c, DeviceIdentities)]
         rsp_dev_ids = DeviceIdentities()
         rsp_dev_ids.from_dict({'device_identities': {
                                     'dest_dev_id': command_dev_ids.decoded['source_dev_id'],
-                                    'source_dev_id': command_dev_ids.decoded['dest_dev_id']}})
+                                    'source_dev_id': 'terminal'}})
         result = Result()
         result.from_dict({'result': {'general_result': general_result, 'additional_information': ''}})
         return [command_details, rsp_dev_ids, result]
 
+class ProactiveCommandStats:
+    """Timing statistics for one type of proactive command, as collected by ProactiveSession."""
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def add(self, duration: float):
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+    @property
+    def avg_time(self) -> float:
+        return self.total_time / self.count if self.count else 0.0
+
+    def __str__(self) -> str:
+        return "%s: %u commands, avg %.3f ms, max %.3f ms" % (self.name, self.count, self.avg_time * 1000,
+                                                              self.max_time * 1000)
+
+class ProactiveSession:
+    """Iterative engine for processing proactive UICC sessions (ETSI TS 102 221 Section 7.4.2 and
+    TS 102 223 Section 6). A 91xx status word announces a pending proactive command, which is fetched
+    once; every fetched proactive command is dispatched to the ProactiveHandler and answered with a
+    TERMINAL RESPONSE built from the TLV objects the handler returned. Further 91xx status words (as
+    response to the FETCH or TERMINAL RESPONSE) are processed in a loop instead of recursing, so
+    arbitrarily long chains of proactive commands use constant stack."""
+
+    def __init__(self, link: 'LinkBase', handler: Optional[ProactiveHandler] = None,
+                 dispatch: Optional[Callable] = None, cla: int = 0xa0):
+        """
+        Args:
+            link : transport link via which FETCH and TERMINAL RESPONSE are sent
+            handler : proactive handler; if None, the proactive_handler of the link is used
+            dispatch : optional callable(pcmd, parsed) -> list of TLV objects, replacing the handler dispatch
+            cla : class byte to use for FETCH and TERMINAL RESPONSE
+        """
+        self.link = link
+        self.handler = handler
+        self.dispatch = dispatch
+        self.cla = cla
+        # length of the proactive command pending on the card, as announced by the last 91xx
+        self.pending = None # type: Optional[int]
+        self.stats = {}
+
+    def _get_handler(self) -> Optional[ProactiveHandler]:
+        return self.handler if self.handler else self.link.proactive_handler
+
+    def queue_fetch(self, sw: SwHexstr):
+        """Queue a FETCH for the proactive command announced by the given 91xx status word.  The card
+        has at most one pending proactive command, so this replaces any earlier announcement which was
+        not fetched yet (e.g. a 91xx in response to a FETCH repeated in response to the TERMINAL
+        RESPONSE)."""
+        if not sw_match(sw, '91xx'):
+            raise ValueError('Status word %s does not announce a proactive command' % sw)
+        self.pending = int(sw[2:4], 16)
+
+    def _dispatch(self, pcmd: ProactiveCommand, parsed) -> List:
+        if self.dispatch:
+            ti_list = self.dispatch(pcmd, parsed)
+        else:
+            handler = self._get_handler()
+            if handler:
+                ti_list = handler.receive_fetch_raw(pcmd, parsed)
+            else:
+                handler = ProactiveHandler()
+                ti_list = handler.prepare_response(pcmd.decoded, 'command_beyond_terminal_capability')
+        if not ti_list:
+            ti_list = ProactiveHandler().prepare_response(pcmd.decoded, 'performed_successfully')
+        return ti_list
+
+    def process_one(self, length: int) -> SwHexstr:
+        """FETCH one proactive command of given length, dispatch it and send the TERMINAL RESPONSE.
+
+        Returns:
+            status word of the TERMINAL RESPONSE
+        """
+        t_start = time.monotonic()
+        data, sw = self.link.send_apdu_bin(bytes([self.cla, 0x12, 0x00, 0x00, length]))
+        if sw_match(sw, '91xx'):
+            # the card may already announce the next proactive command in the FETCH response
+            self.queue_fetch(sw)
+        elif not sw_match(sw, '9000'):
+            raise SwMatchError(sw, '9000', self.link.sw_interpreter)
+
+        # parse the proactive command
+        pcmd = ProactiveCommand()
+        parsed = pcmd.from_tlv(data)
+        cmd_name = type(parsed).__name__
+        print("FETCH: %s (%s)" % (b2h(data), cmd_name))
+        ti_list = self._dispatch(pcmd, parsed)
+
+        # Structure as per TS 102 223 V4.4.0 Section 6.8
+        tail = b''.join([x.to_tlv() for x in ti_list])
+        tr_sw = self.link.send_apdu_bin(bytes([self.cla, 0x14, 0x00, 0x00, len(tail)]) + tail)[1]
+
+        if cmd_name not in self.stats:
+            self.stats[cmd_name] = ProactiveCommandStats(cmd_name)
+        self.stats[cmd_name].add(time.monotonic() - t_start)
+        return tr_sw
+
+    def run(self, sw: Optional[SwHexstr] = None):
+        """Process proactive commands until the card has no more pending ones.
+
+        Args:
+            sw : status word that triggered the session (e.g. 91xx as response to an ENVELOPE)
+        """
+        if sw is not None:
+            self.queue_fetch(sw)
+        while self.pending is not None:
+            length = self.pending
+            self.pending = None
+            tr_sw = self.process_one(length)
+            # Sending the response immediately also flushes out any further proactive
+            # commands that the card already wants to send.
+            if sw_match(tr_sw, '91xx'):
+                self.queue_fetch(tr_sw)
+
+    def stats_str(self) -> str:
+        """Return a human readable summary of the per-command timing statistics."""
+        return '\n'.join([str(x) for x in self.stats.values()])
+
 class LinkBase(abc.ABC):
     """Base class for link/transport to card."""
 
@@ -90,22 +230,50 @@ class LinkBase(abc.ABC):
         self.sw_interpreter = sw_interpreter
         self.apdu_tracer = apdu_tracer
         self.proactive_handler = proactive_handler
+        self.proactive_session = ProactiveSession(self)
         self.apdu_strict = False
         self._debug_pdu=debug_pdu
+        # currently selected file per lchan, as tracked by SimCardCommands.select_path()
+        self.selected_paths = {}
+        # SELECT responses (FCP in hex encoding) of the files selected so far, by select_path() key;
+        # forgotten when the card is reset or may have been changed
+        self.known_fcps = {}
+        # the default implementations call each other, so at least one of them must be overridden
+        self._check_overridden(LinkBase, '_send_apdu', '_send_apdu_bin')
+
+    def _check_overridden(self, base: type, *names: str):
+        """Raise TypeError (like for an abstract method) if the class of this instance overrides none of
+        the given methods of the given base class."""
+        if all(getattr(type(self), name) is getattr(base, name) for name in names):
+            raise TypeError("Can't instantiate %s without an implementation of %s" % (
+                type(self).__name__, ' or '.join(['%s()' % name for name in names])))
 
     @abc.abstractmethod
     def __str__(self) -> str:
         """Implementation specific method for printing an information to identify the device."""
 
-    @abc.abstractmethod
     def _send_apdu(self, apdu: Hexstr) -> ResTuple:
         """Implementation specific method for sending the APDU. This method must accept APDUs as defined in
-        ISO/IEC 7816-3, section 12.1 """
+        ISO/IEC 7816-3, section 12.1. Concrete implementations must override either this method or its
+        binary counterpart _send_apdu_bin()."""
+        (data, sw) = self._send_apdu_bin(h2b(apdu))
+        return b2h(data), sw
+
+    def _send_apdu_bin(self, apdu: bytes) -> ResTupleBin:
+        """Binary counterpart of _send_apdu(). Implementations which natively operate on bytes should
+        override this method to avoid any hex-string conversion in the APDU path."""
+        (data, sw) = self._send_apdu(b2h(apdu))
+        return h2b(data), sw
 
     def set_sw_interpreter(self, interp):
         """Set an (optional) status word interpreter."""
         self.sw_interpreter = interp
 
+    @property
+    def supports_extended_length(self) -> bool:
+        """Can extended length APDUs (ISO/IEC 7816-3, section 12.1.3) be sent via this link?"""
+        return False
+
     @abc.abstractmethod
     def wait_for_card(self, timeout: Optional[int] = None, newcardonly: bool = False):
         """Wait for a card and connect to it
@@ -140,8 +308,38 @@ class LinkBase(abc.ABC):
         """
         if self.apdu_tracer:
             self.apdu_tracer.trace_reset()
+        self.selected_paths.clear()
+        self.known_fcps.clear()
         return self._reset_card()
 
+    def _track_selection(self, apdu: bytes):
+        """Invalidate the selected_paths entry of the lchan of an APDU which may change the selected file."""
+        ins = apdu[1]
+        if ins in FS_CHANGING_INS:
+            self.known_fcps.clear()
+        if ins in SELECTION_NEUTRAL_INS:
+            if ins in [0xb0, 0xd6]:
+                # READ/UPDATE BINARY: SFI in P1
+                if not apdu[2] & 0x80:
+                    return
+            elif ins in [0xb2, 0xdc, 0xa2]:
+                # READ/UPDATE/SEARCH RECORD: SFI in P2
+                if not apdu[3] >> 3:
+                    return
+            else:
+                return
+        # TS 102 221 10.1.1 Coding of Class Byte
+        cla = apdu[0]
+        if ins == 0x70:
+            # MANAGE CHANNEL opens/closes another lchan than the one it is sent on
+            self.selected_paths.clear()
+        elif cla >> 4 in [0x0, 0xA, 0x8]:
+            self.selected_paths.pop(cla & 0x03, None)
+        elif cla & 0xD0 in [0x40, 0xC0]:
+            self.selected_paths.pop(4 + (cla & 0x0F), None)
+        else:
+            self.selected_paths.clear()
+
     def send_apdu(self, apdu: Hexstr) -> ResTuple:
         """Sends an APDU with minimal processing
 
@@ -152,25 +350,44 @@ class LinkBase(abc.ABC):
                         data : string (in hex) of returned data (ex. "074F4EFFFF")
                         sw   : string (in hex) of status word (ex. "9000")
         """
+        (data, sw) = self.send_apdu_bin(h2b(apdu))
+        return b2h(data), sw
+
+    def send_apdu_bin(self, apdu: bytes) -> ResTupleBin:
+        """Sends an APDU with minimal processing (binary variant of send_apdu)
+
+        Args:
+           apdu : bytes/bytearray/memoryview of the APDU (must comply to ISO/IEC 7816-3, section 12.1)
+        Returns:
+           tuple(data, sw), where
+                        data : bytes of returned data
+                        sw   : string (in hex) of status word (ex. "9000")
+        """
+
+        # Only render the hex representation if somebody is going to look at it
+        apdu_hex = b2h(apdu) if self._debug_pdu or self.apdu_tracer else None
 
         if(self._debug_pdu):
-            print('TX PDU: '+apdu)
+            print('TX PDU: '+apdu_hex)
         # To make sure that no invalid APDUs can be passed further down into the transport layer, we parse the APDU.
-        (case, _lc, _le, _data) = parse_command_apdu(h2b(apdu))
+        (case, _lc, _le, _data) = parse_command_apdu(apdu)
+
+        if self.selected_paths or self.known_fcps:
+            self._track_selection(apdu)
 
         if self.apdu_tracer:
-            self.apdu_tracer.trace_command(apdu)
+            self.apdu_tracer.trace_command(apdu_hex)
 
         # Handover APDU to concrete transport layer implementation
-        (data, sw) = self._send_apdu(apdu)
+        (data, sw) = self._send_apdu_bin(apdu)
 
         if (self._debug_pdu):
             print('RX SW: ' + sw)
             if (len(data)):
-                print ('RX DATA: ' + data)
+                print ('RX DATA: ' + b2h(data))
 
         if self.apdu_tracer:
-            self.apdu_tracer.trace_response(apdu, sw, data)
+            self.apdu_tracer.trace_response(apdu_hex, sw, b2h(data))
 
         # The APDU case (See also ISO/IEC 7816-3, table 12) dictates if we should receive a response or not. If we
         # receive a response in an APDU case that does not allow the reception of a response we print a warning to
@@ -201,63 +418,95 @@ class LinkBase(abc.ABC):
                         data : string (in hex) of returned data (ex. "074F4EFFFF")
                         sw   : string (in hex) of status word (ex. "9000")
         """
-        rv = self.send_apdu(apdu)
-        last_sw = rv[1]
+        (data, sw) = self.send_apdu_checksw_bin(h2b(apdu), sw)
+        return b2h(data), sw
+
+    def send_apdu_checksw_bin(self, apdu: bytes, sw: SwMatchstr = "9000") -> ResTupleBin:
+        """Sends an APDU and check returned SW (binary variant of send_apdu_checksw)
+
+        Args:
+           apdu : bytes/bytearray/memoryview of the APDU (must comply to ISO/IEC 7816-3, section 12.1)
+           sw : string of 4 hexadecimal characters (ex. "9000"). The user may mask out certain
+                        digits using a '?' to add some ambiguity if needed.
+        Returns:
+                tuple(data, sw), where
+                        data : bytes of returned data
+                        sw   : string (in hex) of status word (ex. "9000")
+        """
+        rv = self.send_apdu_bin(apdu)
 
-        while sw == '9000' and sw_match(last_sw, '91xx'):
+        if sw == '9000' and sw_match(rv[1], '91xx'):
+            # proactive sim as per TS 102 221 Setion 7.4.2
+            self.proactive_session.run(rv[1])
             # It *was* successful after all -- the extra pieces FETCH handled
             # need not concern the caller.
             rv = (rv[0], '9000')
-            # proactive sim as per TS 102 221 Setion 7.4.2
-            # TODO: Check SW manually to avoid recursing on the stack (provided this piece of code stays in this place)
-            fetch_rv = self.send_apdu_checksw('A0120000' + last_sw[2:], sw)
-            # Setting this in case we later decide not to send a terminal
-            # response immediately unconditionally -- the card may still have
-            # something pending even though the last command was not processed
-            # yet.
-            last_sw = fetch_rv[1]
-            # parse the proactive command
-            pcmd = ProactiveCommand()
-            parsed = pcmd.from_tlv(h2b(fetch_rv[0]))
-            print("FETCH: %s (%s)" % (fetch_rv[0], type(parsed).__name__))
-            if self.proactive_handler:
-                # Extension point: If this does return a list of TLV objects,
-                # they could be appended after the Result; if the first is a
-                # Result, that cuold replace the one built here.
-                ti_list = self.proactive_handler.receive_fetch_raw(pcmd, parsed)
-                if not ti_list:
-                    ti_list = self.proactive_handler.prepare_response(pcmd, 'FIXME')
-            else:
-                ti_list = self.proactive_handler.prepare_response(pcmd, 'command_beyond_terminal_capability')
-
-            # Send response immediately, thus also flushing out any further
-            # proactive commands that the card already wants to send
-            #
-            # Structure as per TS 102 223 V4.4.0 Section 6.8
-
-            # Testing hint: The value of tail does not influence the behavior
-            # of an SJA2 that sent ans SMS, so this is implemented only
-            # following TS 102 223, and not fully tested.
-            ti_list_bin = [x.to_tlv() for x in ti_list]
-            tail = b''.join(ti_list_bin)
-            # Testing hint: In contrast to the above, this part is positively
-            # essential to get the SJA2 to provide the later parts of a
-            # multipart SMS in response to an OTA RFM command.
-            terminal_response = 'A0140000' + b2h(len(tail).to_bytes(1, 'big') + tail)
-
-            terminal_response_rv = self.send_apdu('A01400000C810301130002028281030100')
-            last_sw = terminal_response_rv[1]
 
         if not sw_match(rv[1], sw):
             raise SwMatchError(rv[1], sw.lower(), self.sw_interpreter)
         return rv
 
 
+def t0_transfer(apdu: bytes) -> Generator[bytes, ResTupleBin, ResTupleBin]:
+    """Transform the given APDU to the T=0 TPDU format and automatically fetch the response (case #4 APDUs),
+    see also ETSI TS 102 221, section 7.3.1.1.  This is a generator yielding the TPDUs to be sent; the
+    response to each of them (data, sw) must be passed back via send().  Once the transfer is complete,
+    the resulting (data, sw) of the APDU is returned via StopIteration, so the same transformation can
+    be driven by blocking and by asyncio based transports.
+
+    Args:
+       apdu : bytes of the APDU (must comply to ISO/IEC 7816-3, section 12)
+    """
+    # Transform APDU to T=0 TPDU (see also ETSI TS 102 221, section 7.3.1)
+    if is_extended_apdu(apdu):
+        raise ValueError('extended length APDUs are not supported with T=0')
+    (case, _lc, _le, _data) = parse_command_apdu(apdu)
+
+    if case == 1:
+        # Attach an Le field to all case #1 APDUs (see also ETSI TS 102 221, section 7.3.1.1.1)
+        tpdu = bytes(apdu) + b'\x00'
+    elif case == 4:
+        # Remove the Le field from all case #4 APDUs (see also ETSI TS 102 221, section 7.3.1.1.4)
+        tpdu = apdu[:-1]
+    else:
+        tpdu = apdu
+
+    prev_tpdu = tpdu
+    data, sw = yield tpdu
+
+    # When we have sent the first APDU, the SW may indicate that there are response bytes
+    # available. There are two SWs commonly used for this 9fxx (sim) and 61xx (usim), where
+    # xx is the number of response bytes available.
+    # See also:
+    if sw is not None:
+        if sw[0:2] in ['9f', '61', '62', '63']:
+            # accumulate in a mutable buffer to avoid re-copying the data for every GET RESPONSE
+            data = bytearray(data)
+        while (sw[0:2] in ['9f', '61', '62', '63']):
+            # SW1=9F: 3GPP TS 51.011 9.4.1, Responses to commands which are correctly executed
+            # SW1=61: ISO/IEC 7816-4, Table 5 — General meaning of the interindustry values of SW1-SW2
+            # SW1=62: ETSI TS 102 221 7.3.1.1.4 Clause 4b): 62xx, 63xx, 9xxx != 9000
+            tpdu_gr = bytes([tpdu[0], 0xc0, 0x00, 0x00, int(sw[2:4], 16)])
+            prev_tpdu = tpdu_gr
+            d, sw = yield tpdu_gr
+            data += d
+        if sw[0:2] == '6c':
+            # SW1=6C: ETSI TS 102 221 Table 7.1: Procedure byte coding
+            tpdu_gr = bytes(prev_tpdu[0:4]) + bytes([int(sw[2:4], 16)])
+            data, sw = yield tpdu_gr
+
+    return data, sw
+
+
 class LinkBaseTpdu(LinkBase):
 
     # Use the T=0 TPDU format by default as this is the most commonly used transport protocol.
     protocol = 0
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._check_overridden(LinkBaseTpdu, 'send_tpdu', 'send_tpdu_bin')
+
     def set_tpdu_format(self, protocol: int):
         """Set TPDU format. Each transport protocol has its specific TPDU format. This method allows the
         concrete transport layer implementation to set the TPDU format it expects. (This method must not be
@@ -269,19 +518,32 @@ class LinkBaseTpdu(LinkBase):
         """
         self.protocol = protocol
 
-    @abc.abstractmethod
+    @property
+    def supports_extended_length(self) -> bool:
+        # T=1 transports the APDU unmodified, T=0 would require an ENVELOPE based transport
+        return self.protocol == 1
+
     def send_tpdu(self, tpdu: Hexstr) -> ResTuple:
         """Implementation specific method for sending the resulting TPDU. This method must accept TPDUs as defined in
-        ETSI TS 102 221, section 7.3.1 and 7.3.2, depending on the protocol selected. """
-
-    def _send_apdu(self, apdu: Hexstr) -> ResTuple:
+        ETSI TS 102 221, section 7.3.1 and 7.3.2, depending on the protocol selected. Concrete implementations must
+        override either this method or its binary counterpart send_tpdu_bin()."""
+        (data, sw) = self.send_tpdu_bin(h2b(tpdu))
+        return b2h(data), sw
+
+    def send_tpdu_bin(self, tpdu: bytes) -> ResTupleBin:
+        """Binary counterpart of send_tpdu(). Implementations which natively operate on bytes should
+        override this method to avoid any hex-string conversion in the TPDU path."""
+        (data, sw) = self.send_tpdu(b2h(tpdu))
+        return h2b(data), sw
+
+    def _send_apdu_bin(self, apdu: bytes) -> ResTupleBin:
         """Transforms APDU into a TPDU and sends it. The response TPDU is returned as APDU back to the caller.
 
         Args:
-           apdu : string of hexadecimal characters (eg. "A0A40000023F00", must comply to ISO/IEC 7816-3, section 12)
+           apdu : bytes of the APDU (must comply to ISO/IEC 7816-3, section 12)
         Returns:
            tuple(data, sw), where
-                        data : string (in hex) of returned data (ex. "074F4EFFFF")
+                        data : bytes of returned data
                         sw   : string (in hex) of status word (ex. "9000")
         """
 
@@ -291,49 +553,20 @@ class LinkBaseTpdu(LinkBase):
             return self.__send_apdu_transparent(apdu)
         raise ValueError('unspported protocol selected (T=%d)' % self.protocol)
 
-    def __send_apdu_T0(self, apdu: Hexstr) -> ResTuple:
-        # Transform the given APDU to the T=0 TPDU format and send it. Automatically fetch the response (case #4 APDUs)
-        # (see also ETSI TS 102 221, section 7.3.1.1)
-
-        # Transform APDU to T=0 TPDU (see also ETSI TS 102 221, section 7.3.1)
-        (case, _lc, _le, _data) = parse_command_apdu(h2b(apdu))
-
-        if case == 1:
-            # Attach an Le field to all case #1 APDUs (see also ETSI TS 102 221, section 7.3.1.1.1)
-            tpdu = apdu + '00'
-        elif case == 4:
-            # Remove the Le field from all case #4 APDUs (see also ETSI TS 102 221, section 7.3.1.1.4)
-            tpdu = apdu[:-2]
-        else:
-            tpdu = apdu
-
-        prev_tpdu = tpdu
-        data, sw = self.send_tpdu(tpdu)
-
-        # When we have sent the first APDU, the SW may indicate that there are response bytes
-        # available. There are two SWs commonly used for this 9fxx (sim) and 61xx (usim), where
-        # xx is the number of response bytes available.
-        # See also:
-        if sw is not None:
-            while (sw[0:2] in ['9f', '61', '62', '63']):
-                # SW1=9F: 3GPP TS 51.011 9.4.1, Responses to commands which are correctly executed
-                # SW1=61: ISO/IEC 7816-4, Table 5 — General meaning of the interindustry values of SW1-SW2
-                # SW1=62: ETSI TS 102 221 7.3.1.1.4 Clause 4b): 62xx, 63xx, 9xxx != 9000
-                tpdu_gr = tpdu[0:2] + 'c00000' + sw[2:4]
-                prev_tpdu = tpdu_gr
-                d, sw = self.send_tpdu(tpdu_gr)
-                data += d
-            if sw[0:2] == '6c':
-                # SW1=6C: ETSI TS 102 221 Table 7.1: Procedure byte coding
-                tpdu_gr = prev_tpdu[0:8] + sw[2:4]
-                data, sw = self.send_tpdu(tpdu_gr)
-
-        return data, sw
-
-    def __send_apdu_transparent(self, apdu: Hexstr) -> ResTuple:
+    def __send_apdu_T0(self, apdu: bytes) -> ResTupleBin:
+        # Transform the given APDU to the T=0 TPDU format and send it, see t0_transfer()
+        transfer = t0_transfer(apdu)
+        try:
+            tpdu = next(transfer)
+            while True:
+                tpdu = transfer.send(self.send_tpdu_bin(tpdu))
+        except StopIteration as e:
+            return e.value
+
+    def __send_apdu_transparent(self, apdu: bytes) -> ResTupleBin:
         # In cases where the TPDU format is the same as the APDU format, we may pass the given APDU through without modification
         # (This is the case for T=1, see also  ETSI TS 102 221, section 7.3.2.0.)
-        return self.send_tpdu(apdu)
+        return self.send_tpdu_bin(apdu)
 
 def argparse_add_reader_args(arg_parser: argparse.ArgumentParser):
     """Add all reader related arguments to the given argparse.Argumentparser instance."""
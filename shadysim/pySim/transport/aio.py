@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+""" pySim: asyncio based transport links
+
+An AsyncLinkBase is the asyncio counterpart of LinkBase: its send_apdu() is a coroutine, so that a
+single event loop can drive many readers / modems concurrently.  Transports with a native asyncio
+implementation (AT command modems, OsmocomBB via its unix domain socket) only wait for I/O readiness
+in the event loop; blocking transports (PC/SC, the simple serial readers) are wrapped by
+AsyncExecutorLink, which runs them in a thread of their own.
+
+Existing synchronous code like SimCardCommands can be run on top of an AsyncLinkBase via the
+SyncLinkAdapter, from a thread other than the one running the event loop (e.g. via
+asyncio.to_thread()).
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import abc
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from osmocom.utils import b2h, h2b, Hexstr
+
+from pySim.exceptions import SwMatchError
+from pySim.utils import ResTuple, ResTupleBin, SwMatchstr, sw_match, parse_command_apdu
+from pySim.transport import LinkBase, ApduTracer, StdoutApduTracer, t0_transfer
+
+
+class AsyncLinkBase(abc.ABC):
+    """Base class for asyncio based link/transport to card."""
+
+    def __init__(self, sw_interpreter=None, apdu_tracer: Optional[ApduTracer] = None):
+        self.sw_interpreter = sw_interpreter
+        self.apdu_tracer = apdu_tracer
+        # see LinkBase.selected_paths and LinkBase.known_fcps
+        self.selected_paths = {}
+        self.known_fcps = {}
+
+    @abc.abstractmethod
+    def __str__(self) -> str:
+        """Implementation specific method for printing an information to identify the device."""
+
+    @abc.abstractmethod
+    async def _send_apdu_bin(self, apdu: bytes) -> ResTupleBin:
+        """Implementation specific method for sending the APDU (ISO/IEC 7816-3, section 12.1)."""
+
+    @abc.abstractmethod
+    async def connect(self):
+        """Connect to the reader/modem and to the card in it."""
+
+    @abc.abstractmethod
+    async def disconnect(self):
+        """Disconnect from card and reader/modem."""
+
+    @abc.abstractmethod
+    async def _reset_card(self):
+        """Resets the card (power down/up)"""
+
+    @abc.abstractmethod
+    def get_atr(self) -> Hexstr:
+        """Retrieve card ATR (as obtained during connect/reset)"""
+
+    @property
+    def supports_extended_length(self) -> bool:
+        """Can extended length APDUs (ISO/IEC 7816-3, section 12.1.3) be sent via this link?"""
+        return False
+
+    async def reset_card(self):
+        """Resets the card (power down/up)"""
+        if self.apdu_tracer:
+            self.apdu_tracer.trace_reset()
+        self.selected_paths.clear()
+        self.known_fcps.clear()
+        return await self._reset_card()
+
+    # same invalidation of the selected_paths as in the synchronous transports
+    _track_selection = LinkBase._track_selection
+
+    async def send_apdu_bin(self, apdu: bytes) -> ResTupleBin:
+        """Sends an APDU with minimal processing, see LinkBase.send_apdu_bin()"""
+        # To make sure that no invalid APDUs can be passed further down into the transport layer, we parse the APDU.
+        parse_command_apdu(apdu)
+        if self.selected_paths or self.known_fcps:
+            self._track_selection(apdu)
+        apdu_hex = b2h(apdu) if self.apdu_tracer else None
+        if self.apdu_tracer:
+            self.apdu_tracer.trace_command(apdu_hex)
+        (data, sw) = await self._send_apdu_bin(apdu)
+        if self.apdu_tracer:
+            self.apdu_tracer.trace_response(apdu_hex, sw, b2h(data))
+        return (data, sw)
+
+    async def send_apdu(self, apdu: Hexstr) -> ResTuple:
+        """Sends an APDU with minimal processing, see LinkBase.send_apdu()"""
+        (data, sw) = await self.send_apdu_bin(h2b(apdu))
+        return b2h(data), sw
+
+    async def send_apdu_checksw_bin(self, apdu: bytes, sw: SwMatchstr = "9000") -> ResTupleBin:
+        """Sends an APDU and check returned SW, see LinkBase.send_apdu_checksw_bin().  Proactive
+        commands (91xx) are not handled here; use SimCardCommands via a SyncLinkAdapter for that."""
+        rv = await self.send_apdu_bin(apdu)
+        if not sw_match(rv[1], sw):
+            raise SwMatchError(rv[1], sw.lower(), self.sw_interpreter)
+        return rv
+
+    async def send_apdu_checksw(self, apdu: Hexstr, sw: SwMatchstr = "9000") -> ResTuple:
+        """Sends an APDU and check returned SW, see LinkBase.send_apdu_checksw()"""
+        (data, sw) = await self.send_apdu_checksw_bin(h2b(apdu), sw)
+        return b2h(data), sw
+
+
+class AsyncLinkBaseTpdu(AsyncLinkBase):
+    """Base class for asyncio based transports which exchange TPDUs with the card."""
+
+    # Use the T=0 TPDU format by default as this is the most commonly used transport protocol.
+    protocol = 0
+
+    @property
+    def supports_extended_length(self) -> bool:
+        return self.protocol == 1
+
+    @abc.abstractmethod
+    async def send_tpdu_bin(self, tpdu: bytes) -> ResTupleBin:
+        """Implementation specific method for sending a TPDU, see LinkBaseTpdu.send_tpdu_bin()"""
+
+    async def _send_apdu_bin(self, apdu: bytes) -> ResTupleBin:
+        if self.protocol == 1:
+            return await self.send_tpdu_bin(apdu)
+        if self.protocol != 0:
+            raise ValueError('unspported protocol selected (T=%d)' % self.protocol)
+        transfer = t0_transfer(apdu)
+        try:
+            tpdu = next(transfer)
+            while True:
+                tpdu = transfer.send(await self.send_tpdu_bin(tpdu))
+        except StopIteration as e:
+            return e.value
+
+
+class AsyncExecutorLink(AsyncLinkBase):
+    """Run a blocking LinkBase (like PcscSimLink or SerialSimLink) in a thread of its own, so that it
+    does not block the event loop.  The commands for the link are executed one after another."""
+
+    def __init__(self, link: LinkBase, **kwargs):
+        super().__init__(**kwargs)
+        self.link = link
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=str(link))
+
+    def __str__(self) -> str:
+        return str(self.link)
+
+    @property
+    def supports_extended_length(self) -> bool:
+        return self.link.supports_extended_length
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _send_apdu_bin(self, apdu: bytes) -> ResTupleBin:
+        # bypass the APDU processing of the wrapped link, we do that ourselves
+        return await self._call(self.link._send_apdu_bin, apdu)
+
+    async def connect(self):
+        await self._call(self.link.connect)
+
+    async def disconnect(self):
+        await self._call(self.link.disconnect)
+
+    async def _reset_card(self):
+        return await self._call(self.link._reset_card)
+
+    def get_atr(self) -> Hexstr:
+        return self.link.get_atr()
+
+
+class SyncLinkAdapter(LinkBase):
+    """Present an AsyncLinkBase as a (blocking) LinkBase, so that existing code like SimCardCommands
+    can use it.  The coroutines of the AsyncLinkBase are executed in the given event loop, which must
+    be running in another thread than the one using the adapter:
+
+        async def personalize(alink):
+            await alink.connect()
+            scc = SimCardCommands(SyncLinkAdapter(alink, asyncio.get_running_loop()))
+            await asyncio.to_thread(do_personalize, scc)
+    """
+
+    def __init__(self, alink: AsyncLinkBase, loop: asyncio.AbstractEventLoop, timeout: Optional[float] = None,
+                 **kwargs):
+        """
+        Args:
+            alink : the asyncio based link to use
+            loop : event loop in which the coroutines of alink are executed
+            timeout : maximum time to wait for the result of each operation in seconds (None=no timeout)
+        """
+        super().__init__(**kwargs)
+        self.alink = alink
+        self.loop = loop
+        self.timeout = timeout
+
+    def __str__(self) -> str:
+        return str(self.alink)
+
+    def _run(self, coro):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            coro.close()
+            raise RuntimeError('%s: cannot block within the event loop thread' % self)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(self.timeout)
+
+    @property
+    def supports_extended_length(self) -> bool:
+        return self.alink.supports_extended_length
+
+    def _send_apdu_bin(self, apdu: bytes) -> ResTupleBin:
+        # the APDU processing (tracing, proactive commands, ...) is done by LinkBase
+        return self._run(self.alink._send_apdu_bin(apdu))
+
+    def wait_for_card(self, timeout: Optional[int] = None, newcardonly: bool = False):
+        pass  # Nothing to do, the async link is connected by its user
+
+    def connect(self):
+        self._run(self.alink.connect())
+
+    def disconnect(self):
+        self._run(self.alink.disconnect())
+
+    def _reset_card(self):
+        return self._run(self.alink._reset_card())
+
+    def get_atr(self) -> Hexstr:
+        return self.alink.get_atr()
+
+
+def init_async_reader(opts, **kwargs) -> AsyncLinkBase:
+    """
+    Init card reader driver for use with asyncio (see init_reader); the link still needs to be
+    connected via 'await link.connect()'.
+    """
+    if opts.apdu_trace and not 'apdu_tracer' in kwargs:
+        kwargs['apdu_tracer'] = StdoutApduTracer()
+
+    if opts.pcsc_dev is not None or opts.pcsc_regex is not None:
+        from pySim.transport.pcsc import PcscSimLink
+        sl = AsyncExecutorLink(PcscSimLink(opts), **kwargs)
+    elif opts.osmocon_sock is not None:
+        from pySim.transport.calypso import AsyncCalypsoSimLink
+        sl = AsyncCalypsoSimLink(opts, **kwargs)
+    elif opts.modem_dev is not None:
+        from pySim.transport.modem_atcmd import AsyncModemATCommandLink
+        sl = AsyncModemATCommandLink(opts, **kwargs)
+    else:  # Serial reader is default
+        print("No reader/driver specified; falling back to default (Serial reader)")
+        from pySim.transport.serial import SerialSimLink
+        sl = AsyncExecutorLink(SerialSimLink(opts), **kwargs)
+
+    print("Using reader %s" % sl)
+
+    return sl
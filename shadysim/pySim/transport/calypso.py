@@ -17,16 +17,18 @@
 #
 
 import select
+import asyncio
 import struct
 import socket
 import os
 import argparse
 from typing import Optional
-from osmocom.utils import h2b, b2h, Hexstr
+from osmocom.utils import b2h, Hexstr
 
 from pySim.transport import LinkBaseTpdu
+from pySim.transport.aio import AsyncLinkBaseTpdu
 from pySim.exceptions import ReaderError, ProtocolError
-from pySim.utils import ResTuple
+from pySim.utils import ResTupleBin
 
 
 class L1CTLMessage:
@@ -132,10 +134,10 @@ class CalypsoSimLink(LinkBaseTpdu):
     def wait_for_card(self, timeout: Optional[int] = None, newcardonly: bool = False):
         pass  # Nothing to do really ...
 
-    def send_tpdu(self, tpdu: Hexstr) -> ResTuple:
+    def send_tpdu_bin(self, tpdu: bytes) -> ResTupleBin:
 
         # Request sending of TPDU
-        req_msg = L1CTLMessageSIM(h2b(tpdu))
+        req_msg = L1CTLMessageSIM(bytes(tpdu))
         self.sock.send(req_msg.gen_msg())
 
         # Read message length first
@@ -164,7 +166,7 @@ class CalypsoSimLink(LinkBaseTpdu):
         data = rsp[:-2]
         sw = rsp[-2:]
 
-        return b2h(data), b2h(sw)
+        return bytes(data), b2h(sw)
 
     def __str__(self) -> str:
         return "osmocon:%s" % (self._sock_path)
@@ -177,3 +179,77 @@ the phone (can be ram-loaded).  It also requires that you run the ``osmocon`` pr
 domain socket to which this reader driver can attach.""")
         osmobb_group.add_argument('--osmocon', dest='osmocon_sock', metavar='PATH', default=None,
                                   help='Socket path for Calypso (e.g. Motorola C1XX) based reader (via OsmocomBB)')
+
+
+class AsyncCalypsoSimLink(AsyncLinkBaseTpdu):
+    """asyncio based Transport Link for Calypso based phones."""
+    name = 'Calypso-based (OsmocomBB) reader'
+
+    # maximum time to wait for a response from osmocon (seconds)
+    timeout = 3.0
+
+    def __init__(self, opts: argparse.Namespace = argparse.Namespace(osmocon_sock="/tmp/osmocom_l2"), **kwargs):
+        super().__init__(**kwargs)
+        self._sock_path = opts.osmocon_sock
+        self._reader = None
+        self._writer = None
+        # only one request at a time
+        self._lock = asyncio.Lock()
+
+    async def connect(self):
+        # Make sure that a given socket path exists
+        if not os.path.exists(self._sock_path):
+            raise ReaderError(
+                "There is no such ('%s') UNIX socket" % self._sock_path)
+        self._reader, self._writer = await asyncio.open_unix_connection(self._sock_path)
+        await self.reset_card()
+
+    async def disconnect(self):
+        if self._writer:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._reader = self._writer = None
+
+    async def _request(self, msg: L1CTLMessage) -> bytes:
+        """Send a L1CTL message to osmocon, return the (length-less) L1CTL message received in response."""
+        async with self._lock:
+            self._writer.write(msg.gen_msg())
+            await self._writer.drain()
+            try:
+                rsp = await asyncio.wait_for(self._reader.readexactly(struct.calcsize("!H")), self.timeout)
+                msg_len = struct.unpack_from("!H", rsp)[0]
+                if msg_len < struct.calcsize("BBxx"):
+                    raise ReaderError("Missing L1CTL header")
+                return await asyncio.wait_for(self._reader.readexactly(msg_len), self.timeout)
+            except asyncio.TimeoutError as exc:
+                raise ReaderError("Timeout waiting for card response") from exc
+
+    async def _reset_card(self):
+        # Request FULL reset
+        rsp = await self._request(L1CTLMessageReset())
+        if rsp[0] != L1CTLMessageReset.L1CTL_RESET_CONF:
+            raise ReaderError("Failed to reset Calypso PHY")
+
+    def get_atr(self) -> Hexstr:
+        return "3b00" # Dummy ATR
+
+    async def send_tpdu_bin(self, tpdu: bytes) -> ResTupleBin:
+        # Request sending of TPDU
+        rsp = await self._request(L1CTLMessageSIM(bytes(tpdu)))
+
+        # Verify L1CTL header
+        hdr = struct.unpack_from("BBxx", rsp)
+        if hdr[0] != L1CTLMessageSIM.L1CTL_SIM_CONF:
+            raise ReaderError("Unexpected L1CTL message received")
+
+        # Verify the payload length
+        offset = struct.calcsize("BBxx")
+        if len(rsp) <= offset:
+            raise ProtocolError("Empty response from SIM?!?")
+
+        # Omit L1CTL header, unpack data and SW
+        rsp = rsp[offset:]
+        return bytes(rsp[:-2]), b2h(rsp[-2:])
+
+    def __str__(self) -> str:
+        return "osmocon:%s" % (self._sock_path)
@@ -18,22 +18,267 @@
 
 import logging as log
 import time
+import asyncio
+import select
+import bisect
+import collections
 import re
 import argparse
-from typing import Optional
+from typing import Callable, Iterable, Optional, List
 import serial
-from osmocom.utils import Hexstr
+from osmocom.utils import b2h, h2b, Hexstr
 
-from pySim.utils import ResTuple
+from pySim.utils import ResTuple, ResTupleBin
 from pySim.transport import LinkBaseTpdu
+from pySim.transport.aio import AsyncLinkBaseTpdu
 from pySim.exceptions import ReaderError, ProtocolError
 
 # HACK: if somebody needs to debug this thing
 # log.root.setLevel(log.DEBUG)
 
+# default time to wait for the final result code of an AT command in seconds
+AT_CMD_TIMEOUT = 5.0
+
+# final result codes indicating an error (ITU-T V.250 Section 5.7.1, 3GPP TS 27.007 Section 9.2)
+AT_ERROR_RESULTS = (b'ERROR', b'+CME ERROR:', b'+CMS ERROR:', b'NO CARRIER', b'NO DIALTONE', b'BUSY',
+                    b'NO ANSWER')
+
+# prefixes of unsolicited result codes (URCs), which the modem may emit at any time
+AT_URC_PREFIXES = (b'RING', b'+CRING:', b'+CLIP:', b'+CREG:', b'+CGREG:', b'+CEREG:', b'+C5GREG:',
+                   b'+CMTI:', b'+CMT:', b'+CDSI:', b'+CBM:', b'+CPIN:', b'+CUSATP:', b'+CUSATEND',
+                   b'+STIN:', b'^SIMST:', b'+QIND:', b'+QUSIM:')
+
+# lines are terminated by <CR><LF>, the echo of a command by <CR> only (ITU-T V.250 Section 5.7.1)
+_EOL_RE = re.compile(rb'[\r\n]+')
+_AT_NAME_RE = re.compile(rb'AT([+^%$#&]?[A-Z0-9]*)(=\?|\?)?', re.IGNORECASE)
+_CSIM_RSP_RE = re.compile(rb'\+CSIM: (\d+),"([0-9A-F]+)"')
+
+
+class AtLatencyHistogram:
+    """Histogram of the latencies (from sending the command until receiving its final result code) of
+    one kind of AT command."""
+    # upper bounds of the buckets in seconds; the last bucket is unbounded
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+    def __init__(self, name: str):
+        self.name = name
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.commands = 0
+        self.timeouts = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, latency: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, latency)] += 1
+        self.commands += 1
+        self.total += latency
+        self.min = latency if self.min is None else min(self.min, latency)
+        self.max = max(self.max, latency)
+
+    @property
+    def avg(self) -> float:
+        return self.total / self.commands if self.commands else 0.0
+
+    def __str__(self) -> str:
+        res = "%s: %u commands (%u timeouts), avg %.1f ms, min %.1f ms, max %.1f ms" % \
+            (self.name, self.commands, self.timeouts, self.avg * 1000, (self.min or 0.0) * 1000, self.max * 1000)
+        for bound, count in zip(self.BUCKETS + (None,), self.counts):
+            if count:
+                bucket = '<= %g ms' % (bound * 1000) if bound is not None else '>  %g ms' % (self.BUCKETS[-1] * 1000)
+                res += "\n  %-12s %u" % (bucket, count)
+        return res
+
+
+class AtCommand:
+    """An AT command queued in an AtEngine, and its response as received so far."""
+
+    def __init__(self, cmd: bytes, timeout: float):
+        self.cmd = cmd
+        self.timeout = timeout
+        m = _AT_NAME_RE.match(cmd)
+        # name of the command for the statistics, e.g. 'AT+CSIM' or 'AT+CSIM=?'
+        self.name = m.group(0).upper().decode() if m else cmd.decode(errors='replace')
+        # information text of extended commands starts with the command name (3GPP TS 27.007 Section 4.1)
+        self.prefix = None
+        if m and len(m.group(1)) > 1 and m.group(1)[:1] in b'+^%$#':
+            self.prefix = m.group(1).upper() + b':'
+        self.echo = False
+        self.lines = []
+        self.result = None
+        self.timed_out = False
+        self.error = None
+        self.t_sent = None
+        self.latency = None
+
+    @property
+    def done(self) -> bool:
+        return self.result is not None or self.timed_out or self.error is not None
+
+    @property
+    def response(self) -> List[bytes]:
+        """The lines of information text, followed by the final result code (if received)."""
+        if self.result is None:
+            return list(self.lines)
+        return self.lines + [self.result]
+
+    def __str__(self) -> str:
+        return "%s: %s" % (self.cmd, self.response)
+
+
+class AtEngine:
+    """Line-oriented AT command engine.  It does not perform any I/O itself: the bytes received from
+    the modem are passed to feed(), which splits them into lines as they arrive and assigns each line
+    to the command in progress (or to the URC handler).  Commands are queued by submit() and each one
+    is written (using the write function) as soon as the final result code of the previous one has
+    been received.  Modems process one command at a time, so this is as far as they can be pipelined.
+
+    The latency of each command is recorded in a per-command AtLatencyHistogram (see stats).
+    """
+
+    def __init__(self, write: Callable[[bytes], int], urc_prefixes: Iterable[bytes] = AT_URC_PREFIXES,
+                 urc_handler: Optional[Callable[[bytes], None]] = None):
+        """
+        Args:
+            write : function writing bytes to the modem, returning the number of bytes written
+            urc_prefixes : prefixes of the lines which are unsolicited result codes
+            urc_handler : function called for each URC (default: keep the most recent ones in urcs)
+        """
+        self._write = write
+        self.urc_prefixes = tuple(urc_prefixes)
+        self.urc_handler = urc_handler
+        self.urcs = collections.deque(maxlen=64)
+        self.stats = {} # type: dict[str, AtLatencyHistogram]
+        self._queue = collections.deque()
+        self._current = None
+        self._partial = b''
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """time.monotonic() at which the command in progress times out (None if idle)."""
+        if self._current is None:
+            return None
+        return self._current.t_sent + self._current.timeout
+
+    def submit(self, cmd, timeout: float = AT_CMD_TIMEOUT) -> AtCommand:
+        """Queue an AT command (without the terminating <CR>); it is sent right away if the engine is
+        idle."""
+        # Convert from string to bytes, if needed
+        atc = AtCommand(cmd if isinstance(cmd, bytes) else cmd.encode(), timeout)
+        self._queue.append(atc)
+        if self._current is None:
+            self._send_next()
+        return atc
+
+    def _send_next(self):
+        while self._queue and self._current is None:
+            atc = self._queue.popleft()
+            log.debug('Sending AT command: %s', atc.cmd)
+            atc.t_sent = time.monotonic()
+            try:
+                wlen = self._write(atc.cmd + b'\r')
+                assert wlen == len(atc.cmd) + 1
+            except Exception as exc:
+                atc.error = ReaderError('Failed to send AT command: %s' % atc.cmd)
+                atc.error.__cause__ = exc
+                continue
+            self._current = atc
+
+    def feed(self, data: bytes):
+        """Process bytes received from the modem."""
+        *lines, self._partial = _EOL_RE.split(self._partial + data)
+        for line in lines:
+            if line:
+                self._dispatch(line)
+
+    def _dispatch(self, line: bytes):
+        atc = self._current
+        if atc is not None:
+            if atc.prefix and line.startswith(atc.prefix):
+                atc.lines.append(line)
+                return
+            if line == atc.cmd and not atc.echo and not atc.lines:
+                atc.echo = True
+                return
+            if not line.startswith(self.urc_prefixes):
+                if line == b'OK' or line.startswith(AT_ERROR_RESULTS):
+                    atc.result = line
+                    self._complete(atc)
+                else:
+                    atc.lines.append(line)
+                return
+        log.debug('Unsolicited result code: %s', line)
+        if self.urc_handler:
+            self.urc_handler(line)
+        else:
+            self.urcs.append(line)
+
+    def _complete(self, atc: AtCommand):
+        atc.latency = time.monotonic() - atc.t_sent
+        hist = self.stats.get(atc.name, None)
+        if hist is None:
+            hist = self.stats[atc.name] = AtLatencyHistogram(atc.name)
+        if atc.timed_out:
+            hist.timeouts += 1
+            log.info('Command finished with timeout >= %ss', atc.timeout)
+        else:
+            hist.add(atc.latency)
+            if atc.result == b'OK':
+                log.debug('Command finished with result: %s', atc.result)
+            else:
+                log.error('Command failed with result: %s', atc.result)
+        log.debug('Command took %0.6fs', atc.latency)
+        self._current = None
+        self._send_next()
+
+    def check_timeout(self) -> bool:
+        """Abort the command in progress if its timeout has expired (continuing with the next queued
+        command); returns True in that case.  The caller should discard any input still pending, so
+        that a late response is not taken for the one of the next command."""
+        deadline = self.deadline
+        if deadline is None or time.monotonic() < deadline:
+            return False
+        self._current.timed_out = True
+        self._partial = b''
+        self._complete(self._current)
+        return True
+
+    def stats_str(self) -> str:
+        """Return the latency histograms of all commands sent so far."""
+        return '\n'.join([str(hist) for hist in self.stats.values()])
+
+
+def csim_cmd(tpdu: Hexstr) -> str:
+    """Build the AT+CSIM command (3GPP TS 27.007 Section 8.17) for a TPDU."""
+    # Make sure pdu has upper case hex digits [A-F]
+    tpdu = tpdu.upper()
+    return 'AT+CSIM=%d,\"%s\"' % (len(tpdu), tpdu)
+
+def csim_parse_rsp(rsp: List[bytes]) -> ResTuple:
+    """Parse the response to an AT+CSIM command (see AtCommand.response)."""
+    if rsp and rsp[-1].startswith(b'+CME ERROR:'):
+        raise ProtocolError('AT+CSIM failed with: %s' % str(rsp))
+    if len(rsp) != 2 or rsp[-1] != b'OK':
+        raise ReaderError('APDU transfer failed: %s' % str(rsp))
+    rsp = rsp[0]  # Get rid of b'OK'
+
+    # Make sure that the response has format: b'+CSIM: %d,\"%s\"'
+    try:
+        result = _CSIM_RSP_RE.match(rsp)
+        (_rsp_tpdu_len, rsp_tpdu) = result.groups()
+    except Exception as exc:
+        raise ReaderError('Failed to parse response from modem: %s' % rsp) from exc
+
+    # TODO: make sure we have at least SW
+    data = rsp_tpdu[:-4].decode().lower()
+    sw = rsp_tpdu[-4:].decode().lower()
+    log.debug('Command response: %s, %s', data, sw)
+    return data, sw
+
 
 class ModemATCommandLink(LinkBaseTpdu):
-    """Transport Link for 3GPP TS 27.007 compliant modems."""
+    """Transport Link for 3GPP TS 27.007 compliant modems.  The AtEngine is fed with the input of
+    the modem whenever poll() reports the serial port to be readable."""
     name = "modem for Generic SIM Access (3GPP TS 27.007)"
 
     def __init__(self, opts: argparse.Namespace = argparse.Namespace(modem_dev='/dev/ttyUSB0',
@@ -42,9 +287,14 @@ class ModemATCommandLink(LinkBaseTpdu):
         baudrate = opts.modem_baud
         super().__init__(**kwargs)
         self._sl = serial.Serial(device, baudrate, timeout=5)
-        self._echo = False		# this will be auto-detected by _check_echo()
         self._device = device
         self._atr = None
+        self.engine = AtEngine(self._sl.write)
+        self._poll = select.poll()
+        self._poll.register(self._sl.fileno(), select.POLLIN)
+
+        # Clean input buffer from previous/unexpected data
+        self._sl.reset_input_buffer()
 
         # Check the AT interface
         self._check_echo()
@@ -56,74 +306,48 @@ class ModemATCommandLink(LinkBaseTpdu):
         if hasattr(self, '_sl'):
             self._sl.close()
 
-    def send_at_cmd(self, cmd, timeout=0.2, patience=0.002):
-        # Convert from string to bytes, if needed
-        bcmd = cmd if isinstance(cmd, bytes) else cmd.encode()
-        bcmd += b'\r'
+    def _wait(self, atc: AtCommand) -> AtCommand:
+        """Process the input from the modem until the given (queued) command is done."""
+        while not atc.done:
+            remaining = self.engine.deadline - time.monotonic()
+            if remaining > 0 and self._poll.poll(int(remaining * 1000) + 1):
+                self.engine.feed(self._sl.read(max(1, self._sl.in_waiting)))
+            elif self.engine.check_timeout():
+                # Clean input buffer from the late response
+                self._sl.reset_input_buffer()
+        if atc.error:
+            raise atc.error
+        log.debug('Got response from modem: %s', atc.response)
+        return atc
+
+    def send_at_cmd(self, cmd, timeout: float = AT_CMD_TIMEOUT) -> List[bytes]:
+        """Send an AT command and wait (at most timeout seconds) for its final result code.
+
+        Returns:
+            lines of information text followed by the final result code (if received in time)
+        """
+        return self._wait(self.engine.submit(cmd, timeout)).response
 
-        # Clean input buffer from previous/unexpected data
-        self._sl.reset_input_buffer()
+    def send_at_cmds(self, cmds: List, timeout: float = AT_CMD_TIMEOUT) -> List[List[bytes]]:
+        """Send a sequence of AT commands, each one as soon as the previous one has finished.
 
-        # Send command to the modem
-        log.debug('Sending AT command: %s', cmd)
-        try:
-            wlen = self._sl.write(bcmd)
-            assert wlen == len(bcmd)
-        except Exception as exc:
-            raise ReaderError('Failed to send AT command: %s' % cmd) from exc
-
-        rsp = b''
-        its = 1
-        t_start = time.time()
-        while True:
-            rsp = rsp + self._sl.read(self._sl.in_waiting)
-            lines = rsp.split(b'\r\n')
-            if len(lines) >= 2:
-                res = lines[-2]
-                if res == b'OK':
-                    log.debug('Command finished with result: %s', res)
-                    break
-                if res == b'ERROR' or res.startswith(b'+CME ERROR:'):
-                    log.error('Command failed with result: %s', res)
-                    break
-
-            if time.time() - t_start >= timeout:
-                log.info('Command finished with timeout >= %ss', timeout)
-                break
-            time.sleep(patience)
-            its += 1
-        log.debug('Command took %0.6fs (%d cycles a %fs)', time.time() - t_start, its, patience)
-
-        if self._echo:
-            # Skip echo chars
-            rsp = rsp[wlen:]
-        rsp = rsp.strip()
-        rsp = rsp.split(b'\r\n\r\n')
-
-        log.debug('Got response from modem: %s', rsp)
-        return rsp
+        Returns:
+            list of the responses (see send_at_cmd) of the commands
+        """
+        atcs = [self.engine.submit(cmd, timeout) for cmd in cmds]
+        return [self._wait(atc).response for atc in atcs]
 
     def _check_echo(self):
         """Verify the correct response to 'AT' command
-        and detect if inputs are echoed by the device
 
         Although echo of inputs can be enabled/disabled via
-        ATE1/ATE0, respectively, we rather detect the current
-        configuration of the modem without any change.
+        ATE1/ATE0, respectively, we rather leave the current
+        configuration of the modem unchanged: the AtEngine
+        detects and strips the echo of each command.
         """
-        # Next command shall not strip the echo from the response
-        self._echo = False
-        result = self.send_at_cmd('AT')
-
-        # Verify the response
-        if len(result) > 0:
-            if result[-1] == b'OK':
-                self._echo = False
-                return
-            if result[-1] == b'AT\r\r\nOK':
-                self._echo = True
-                return
-        raise ReaderError('Interface \'%s\' does not respond to \'AT\' command' % self._device)
+        atc = self._wait(self.engine.submit('AT', timeout=1.0))
+        if atc.result != b'OK':
+            raise ReaderError('Interface \'%s\' does not respond to \'AT\' command' % self._device)
 
     def _reset_card(self):
         # Reset the modem, just to be sure
@@ -149,33 +373,12 @@ class ModemATCommandLink(LinkBaseTpdu):
         pass  # Nothing to do really ...
 
     def send_tpdu(self, tpdu: Hexstr) -> ResTuple:
-        # Make sure pdu has upper case hex digits [A-F]
-        tpdu = tpdu.upper()
-
         # Prepare the command as described in 8.17
-        cmd = 'AT+CSIM=%d,\"%s\"' % (len(tpdu), tpdu)
+        cmd = csim_cmd(tpdu)
         log.debug('Sending command: %s',  cmd)
 
         # Send AT+CSIM command to the modem
-        rsp = self.send_at_cmd(cmd)
-        if rsp[-1].startswith(b'+CME ERROR:'):
-            raise ProtocolError('AT+CSIM failed with: %s' % str(rsp))
-        if len(rsp) != 2 or rsp[-1] != b'OK':
-            raise ReaderError('APDU transfer failed: %s' % str(rsp))
-        rsp = rsp[0]  # Get rid of b'OK'
-
-        # Make sure that the response has format: b'+CSIM: %d,\"%s\"'
-        try:
-            result = re.match(b'\+CSIM: (\d+),\"([0-9A-F]+)\"', rsp)
-            (_rsp_tpdu_len, rsp_tpdu) = result.groups()
-        except Exception as exc:
-            raise ReaderError('Failed to parse response from modem: %s' % rsp) from exc
-
-        # TODO: make sure we have at least SW
-        data = rsp_tpdu[:-4].decode().lower()
-        sw = rsp_tpdu[-4:].decode().lower()
-        log.debug('Command response: %s, %s', data, sw)
-        return data, sw
+        return csim_parse_rsp(self.send_at_cmd(cmd))
 
     def __str__(self) -> str:
         return "modem:%s" % self._device
@@ -189,3 +392,92 @@ the AT+CSIM interface for Generic SIM access as specified in 3GPP TS 27.007.""")
                                  help='Serial port of modem for Generic SIM Access (3GPP TS 27.007)')
         modem_group.add_argument('--modem-baud', type=int, metavar='BAUD', default=115200,
                                  help='Baud rate used for modem port')
+
+
+class AsyncModemATCommandLink(AsyncLinkBaseTpdu):
+    """asyncio based Transport Link for 3GPP TS 27.007 compliant modems.  Instead of polling the serial
+    port, the responses are fed to the AtEngine by a reader callback of the event loop."""
+    name = "modem for Generic SIM Access (3GPP TS 27.007)"
+
+    def __init__(self, opts: argparse.Namespace = argparse.Namespace(modem_dev='/dev/ttyUSB0',
+                                                                     modem_baud=115200), **kwargs):
+        super().__init__(**kwargs)
+        self._device = opts.modem_dev
+        self._baudrate = opts.modem_baud
+        self._sl = None
+        self.engine = AtEngine(lambda data: self._sl.write(data))
+        self._rx_event = asyncio.Event()
+
+    def _on_readable(self):
+        # called by the event loop; timeout=0 makes read() return whatever is available
+        self.engine.feed(self._sl.read(max(1, self._sl.in_waiting)))
+        self._rx_event.set()
+
+    async def connect(self):
+        self._sl = serial.Serial(self._device, self._baudrate, timeout=0)
+        # Clean input buffer from previous/unexpected data
+        self._sl.reset_input_buffer()
+        asyncio.get_running_loop().add_reader(self._sl.fileno(), self._on_readable)
+        # Check the AT interface
+        await self._check_echo()
+        # Trigger initial reset
+        await self.reset_card()
+
+    async def disconnect(self):
+        if self._sl:
+            asyncio.get_running_loop().remove_reader(self._sl.fileno())
+            self._sl.close()
+            self._sl = None
+
+    async def _wait(self, atc: AtCommand) -> AtCommand:
+        """Wait until the given (queued) command is done, see ModemATCommandLink._wait()"""
+        while not atc.done:
+            remaining = self.engine.deadline - time.monotonic()
+            self._rx_event.clear()
+            try:
+                await asyncio.wait_for(self._rx_event.wait(), max(remaining, 0))
+            except asyncio.TimeoutError:
+                if self.engine.check_timeout():
+                    # Clean input buffer from the late response
+                    self._sl.reset_input_buffer()
+        if atc.error:
+            raise atc.error
+        log.debug('Got response from modem: %s', atc.response)
+        return atc
+
+    async def send_at_cmd(self, cmd, timeout: float = AT_CMD_TIMEOUT) -> List[bytes]:
+        """Send an AT command and wait (at most timeout seconds) for its final result code.  Commands
+        of concurrent tasks are queued and sent one after another."""
+        return (await self._wait(self.engine.submit(cmd, timeout))).response
+
+    async def _check_echo(self):
+        """Verify the correct response to 'AT' command, see ModemATCommandLink._check_echo()"""
+        atc = await self._wait(self.engine.submit('AT', timeout=1.0))
+        if atc.result != b'OK':
+            raise ReaderError('Interface \'%s\' does not respond to \'AT\' command' % self._device)
+
+    async def _reset_card(self):
+        # Reset the modem, just to be sure
+        if await self.send_at_cmd('ATZ') != [b'OK']:
+            raise ReaderError('Failed to reset the modem')
+
+        # Make sure that generic SIM access is supported
+        if await self.send_at_cmd('AT+CSIM=?') != [b'OK']:
+            raise ReaderError('The modem does not seem to support SIM access')
+
+        log.info('Modem at \'%s\' is ready!', self._device)
+
+    def get_atr(self) -> Hexstr:
+        return "3b00" # Dummy ATR
+
+    async def send_tpdu_bin(self, tpdu: bytes) -> ResTupleBin:
+        # Prepare the command as described in 8.17
+        cmd = csim_cmd(b2h(tpdu))
+        log.debug('Sending command: %s',  cmd)
+
+        # Send AT+CSIM command to the modem
+        data, sw = csim_parse_rsp(await self.send_at_cmd(cmd))
+        return h2b(data), sw
+
+    def __str__(self) -> str:
+        return "modem:%s" % self._device
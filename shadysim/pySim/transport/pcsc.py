@@ -19,7 +19,7 @@
 
 import argparse
 import re
-from typing import Optional
+from typing import Optional, List
 
 from smartcard.CardConnection import CardConnection
 from smartcard.CardRequest import CardRequest
@@ -27,11 +27,11 @@ from smartcard.Exceptions import NoCardException, CardRequestTimeoutException, C
 from smartcard.System import readers
 from smartcard.ExclusiveConnectCardConnection import ExclusiveConnectCardConnection
 
-from osmocom.utils import h2i, i2h, Hexstr
+from osmocom.utils import i2h, Hexstr
 
 from pySim.exceptions import NoCardError, ProtocolError, ReaderError
 from pySim.transport import LinkBaseTpdu
-from pySim.utils import ResTuple
+from pySim.utils import ResTupleBin
 
 
 class PcscSimLink(LinkBaseTpdu):
@@ -50,13 +50,10 @@ class PcscSimLink(LinkBaseTpdu):
             self._reader = r[reader_number]
         else:
             # reader regex string
-            cre = re.compile(opts.pcsc_regex)
-            for reader in r:
-                if cre.search(reader.name):
-                    self._reader = reader
-                    break
-            if not self._reader:
+            reader_numbers = self.match_readers(opts.pcsc_regex, r)
+            if not reader_numbers:
                 raise ReaderError('No matching reader found for regex %s' % opts.pcsc_regex)
+            self._reader = r[reader_numbers[0]]
 
         self._con = self._reader.createConnection()
         self._con.setProtocol(1)
@@ -64,6 +61,19 @@ class PcscSimLink(LinkBaseTpdu):
         if not getattr(opts, "pcsc_shared", False):
             self._con = ExclusiveConnectCardConnection(self._con)
 
+    @staticmethod
+    def match_readers(pcsc_regex: str, reader_list: Optional[list] = None) -> List[int]:
+        """Return the numbers of all PC/SC readers whose name matches the given regex.
+
+        Args:
+            pcsc_regex : regular expression to search for in the reader name
+            reader_list : list of readers to search (default: all readers of the system)
+        """
+        if reader_list is None:
+            reader_list = readers()
+        cre = re.compile(pcsc_regex)
+        return [i for i, reader in enumerate(reader_list) if cre.search(reader.name)]
+
     def __del__(self):
         try:
             # FIXME: this causes multiple warnings in Python 3.5.3
@@ -85,6 +95,9 @@ class PcscSimLink(LinkBaseTpdu):
             # To avoid leakage of resources, make sure the reader
             # is disconnected
             self.disconnect()
+            # this may well be a different card
+            self.selected_paths.clear()
+            self.known_fcps.clear()
 
             # Make card connection and select a suitable communication protocol
             self._con.connect()
@@ -115,12 +128,11 @@ class PcscSimLink(LinkBaseTpdu):
         self.connect()
         return 1
 
-    def send_tpdu(self, tpdu: Hexstr) -> ResTuple:
-        data, sw1, sw2 = self._con.transmit(h2i(tpdu))
-        sw = [sw1, sw2]
+    def send_tpdu_bin(self, tpdu: bytes) -> ResTupleBin:
+        data, sw1, sw2 = self._con.transmit(list(tpdu))
 
         # Return value
-        return i2h(data), i2h(sw)
+        return bytes(data), '%02x%02x' % (sw1, sw2)
 
     def __str__(self) -> str:
         return "PCSC[%s]" % (self._reader)
@@ -21,19 +21,27 @@ import os
 import argparse
 from typing import Optional
 import serial
-from osmocom.utils import h2b, b2h, i2h, Hexstr
+from osmocom.utils import b2h, i2h, Hexstr
 
 from pySim.exceptions import NoCardError, ProtocolError
 from pySim.transport import LinkBaseTpdu
-from pySim.utils import ResTuple
+from pySim.utils import ResTupleBin
+
+# clock rate conversion integer Fi and baud rate adjustment integer Di, indexed by the FI / DI
+# nibbles of TA1 (ISO/IEC 7816-3 Section 8.3, Tables 7 and 8)
+FI_TABLE = [372, 372, 558, 744, 1116, 1488, 1860, None, None, 512, 768, 1024, 1536, 2048, None, None]
+DI_TABLE = [None, 1, 2, 4, 8, 16, 32, 64, 12, 20, None, None, None, None, None, None]
+
+# procedure byte NULL (ISO/IEC 7816-3 Section 10.3.3)
+NULL_BYTE = 0x60
 
 
 class SerialSimLink(LinkBaseTpdu):
     """ pySim: Transport Link for serial (RS232) based readers included with simcard"""
     name = 'Serial'
 
-    def __init__(self, opts = argparse.Namespace(device='/dev/ttyUSB0', baudrate=9600), rst: str = '-rts',
-                 debug: bool = True, **kwargs):
+    def __init__(self, opts = argparse.Namespace(device='/dev/ttyUSB0', baudrate=9600, pps=False),
+                 rst: str = '-rts', debug: bool = True, **kwargs):
         super().__init__(**kwargs)
         if not os.path.exists(opts.device):
             raise ValueError("device file %s does not exist -- abort" % opts.device)
@@ -50,6 +58,9 @@ class SerialSimLink(LinkBaseTpdu):
         self._rst_pin = rst
         self._debug = debug
         self._atr = None
+        # baud rate of the default transmission parameters (F=372, D=1), used after each reset
+        self._baudrate = opts.baudrate
+        self._pps = getattr(opts, 'pps', False)
 
     def __del__(self):
         if hasattr(self, "_sl"):
@@ -107,8 +118,62 @@ class SerialSimLink(LinkBaseTpdu):
             raise NoCardError()
         if rv < 0:
             raise ProtocolError()
+        if self._pps:
+            self._negotiate_pps()
         return rv
 
+    def _atr_ta1(self) -> Optional[int]:
+        """Return TA1 of the ATR, if the card offers to negotiate its value.  In specific mode
+        (indicated by TA2) the card is already using the transmission parameters of TA1."""
+        t0 = self._atr[1]
+        if not t0 & 0x10:
+            return None
+        ta1 = self._atr[2]
+        if t0 & 0x80:
+            # TD1 follows TA1, TB1, TC1 (whichever are present)
+            td1 = self._atr[2 + bin(t0 & 0x70).count('1')]
+            if td1 & 0x10:
+                return None
+        return ta1
+
+    def _negotiate_pps(self):
+        """Negotiate the transmission parameters offered in TA1 of the ATR (ISO/IEC 7816-3 Section 9)
+        and switch the serial port to the according baud rate."""
+        ta1 = self._atr_ta1()
+        if ta1 is None or (ta1 & 0x0f == 0x01 and FI_TABLE[ta1 >> 4] == 372):
+            return
+        fi = FI_TABLE[ta1 >> 4]
+        di = DI_TABLE[ta1 & 0x0f]
+        if fi is None or di is None:
+            self._dbg_print("PPS: TA1 0x%02x uses RFU values, keeping default rate" % ta1)
+            return
+        baudrate = round(self._baudrate * 372 * di / fi)
+        # make sure the serial port supports the baud rate before committing the card to it
+        try:
+            self._sl.baudrate = baudrate
+        except (ValueError, serial.SerialException):
+            self._dbg_print("PPS: serial port does not support %u baud, keeping default rate" % baudrate)
+            return
+        finally:
+            self._sl.baudrate = self._baudrate
+
+        # PPSS, PPS0 (PPS1 present, T=0), PPS1, PCK
+        req = bytes([0xff, 0x10, ta1])
+        req += bytes([req[0] ^ req[1] ^ req[2]])
+        self._sl.write(req)
+        r = self._sl.read(2 * len(req))
+        if r[:len(req)] != req:  # TX and RX are tied, so we must clear the echo
+            raise ProtocolError("Bad echo value (Expected: %s, got %s)" % (b2h(req), b2h(r[:len(req)])))
+        rsp = r[len(req):]
+        if rsp == req:
+            self._sl.baudrate = baudrate
+            self._dbg_print("PPS: Fi=%u Di=%u, switched to %u baud" % (fi, di, baudrate))
+        elif rsp == b'\xff\x00\xff':
+            # the card did not accept PPS1 and stays at the default values
+            self._dbg_print("PPS: card keeps default rate")
+        else:
+            raise ProtocolError("PPS exchange failed (request: %s, response: %s)" % (b2h(req), b2h(rsp)))
+
     def __reset_card(self):
         self._atr = None
         rst_meth_map = {
@@ -124,6 +189,9 @@ class SerialSimLink(LinkBaseTpdu):
             raise ValueError('Invalid reset pin %s' % self._rst_pin) from exc
 
         rst_meth(rst_val)
+        # the card answers with the default transmission parameters after each reset
+        if self._sl.baudrate != self._baudrate:
+            self._sl.baudrate = self._baudrate
         time.sleep(0.1)  # 100 ms
         self._sl.flushInput()
         rst_meth(rst_val ^ 1)
@@ -187,48 +255,68 @@ class SerialSimLink(LinkBaseTpdu):
     def _rx_byte(self):
         return self._sl.read()
 
-    def send_tpdu(self, tpdu: Hexstr) -> ResTuple:
+    def _tx_string_rx(self, s: bytes, rx_len: int) -> bytearray:
+        """Transmit a string and receive up to rx_len bytes sent by the card in response, both in a
+        single read (the echo of the string followed by the response of the card)."""
+        self._sl.write(s)
+        r = self._sl.read(len(s) + rx_len)
+        if r[:len(s)] != s:  # TX and RX are tied, so we must clear the echo
+            raise ProtocolError(
+                "Bad echo value (Expected: %s, got %s)" % (b2h(s), b2h(r[:len(s)])))
+        return bytearray(r[len(s):])
+
+    def _rx_bytes(self, data: bytearray, to_recv: int, skip_null: bool = False):
+        """Receive data from the card into the given bytearray, until it contains to_recv bytes (or
+        the timeout expires).  If skip_null, NULL procedure bytes are dropped while data is empty."""
+        while True:
+            if skip_null:
+                while data and data[0] == NULL_BYTE:
+                    del data[0]
+            if len(data) >= to_recv:
+                return
+            r = self._sl.read(to_recv - len(data))
+            if not r:
+                return
+            data += r
+
+    def send_tpdu_bin(self, tpdu: bytes) -> ResTupleBin:
 
-        tpdu = h2b(tpdu)
+        tpdu = bytes(tpdu)
         data_len = tpdu[4]  # P3
 
-        # Send first CLASS,INS,P1,P2,P3
-        self._tx_string(tpdu[0:5])
+        # Send first CLASS,INS,P1,P2,P3 and receive the first procedure byte
+        rx = self._tx_string_rx(tpdu[0:5], 1)
 
         # Wait ack which can be
         #  - INS: Command acked -> go ahead
         #  - 0x60: NULL, just wait some more
         #  - SW1: The card can apparently proceed ...
         while True:
-            b = self._rx_byte()
-            if ord(b) == tpdu[1]:
-                break
-            if b != '\x60':
-                # Ok, it 'could' be SW1
-                sw1 = b
-                sw2 = self._rx_byte()
-                nil = self._rx_byte()
-                if (sw2 and not nil):
-                    return '', b2h(sw1+sw2)
-
+            self._rx_bytes(rx, 1, skip_null=True)
+            if not rx:
                 raise ProtocolError()
+            if rx[0] == tpdu[1]:
+                del rx[0]
+                break
+            # Ok, it 'could' be SW1
+            self._rx_bytes(rx, 2)
+            nil = self._rx_byte()
+            if len(rx) == 2 and not nil:
+                return b'', b2h(rx)
 
-        # Send data (if any)
-        if len(tpdu) > 5:
-            self._tx_string(tpdu[5:])
+            raise ProtocolError()
 
         # Receive data (including SW !)
         #  length = [P3 - tx_data (=len(tpdu)-len(hdr)) + 2 (SW1//2) ]
         to_recv = data_len - len(tpdu) + 5 + 2
 
-        data = bytes(0)
-        while len(data) < to_recv:
-            b = self._rx_byte()
-            if (to_recv == 2) and (b == '\x60'):  # Ignore NIL if we have no RX data (hack ?)
-                continue
-            if not b:
-                break
-            data += b
+        # Send data (if any), receiving the response right after its echo
+        if len(tpdu) > 5:
+            rx += self._tx_string_rx(tpdu[5:], to_recv)
+
+        # Ignore NIL if we have no RX data (hack ?)
+        data = rx
+        self._rx_bytes(data, to_recv, skip_null=(to_recv == 2))
 
         # Split datafield from SW
         if len(data) < 2:
@@ -237,7 +325,7 @@ class SerialSimLink(LinkBaseTpdu):
         data = data[0:-2]
 
         # Return value
-        return b2h(data), b2h(sw)
+        return bytes(data), b2h(sw)
 
     def __str__(self) -> str:
         return "serial:%s" % (self._sl.name)
@@ -251,3 +339,5 @@ readers, only with the very primitive readers following the ancient `Phoenix` or
                                   help='Serial Device for SIM access')
         serial_group.add_argument('-b', '--baud', dest='baudrate', type=int, metavar='BAUD', default=9600,
                                   help='Baud rate used for SIM access')
+        serial_group.add_argument('--pps', action='store_true', default=False,
+                                  help='Negotiate the higher transmission rate offered in TA1 of the ATR (PPS)')
@@ -11,7 +11,7 @@ import argparse
 from io import BytesIO
 from typing import Optional, List, Dict, Any, Tuple, NewType, Union
 from osmocom.utils import *
-from osmocom.tlv import bertlv_encode_tag, bertlv_encode_len
+from osmocom.tlv import bertlv_encode_tag, bertlv_encode_len, bertlv_parse_tag_raw, bertlv_parse_len
 
 # Copyright (C) 2009-2010  Sylvain Munaut <tnt@246tNt.com>
 # Copyright (C) 2021 Harald Welte <laforge@osmocom.org>
@@ -48,6 +48,8 @@ from osmocom.tlv import bertlv_encode_tag, bertlv_encode_len
 SwHexstr = NewType('SwHexstr', str)
 SwMatchstr = NewType('SwMatchstr', str)
 ResTuple = Tuple[Hexstr, SwHexstr]
+# binary counterpart of ResTuple: response data as bytes, status word still as hex string
+ResTupleBin = Tuple[bytes, SwHexstr]
 
 def enc_imsi(imsi: str):
     """Converts a string IMSI into the encoded value of the EF"""
@@ -539,22 +541,16 @@ def boxed_heading_str(heading, width=80):
     return res
 
 
-def parse_command_apdu(apdu: bytes) -> int:
-    """Parse a given command APDU and return case (see also ISO/IEC 7816-3, Table 12 and Figure 26),
-    lc, le and the data field.
-
-    Args:
-            apdu : hexstring that contains the command APDU
-    Returns:
-            tuple containing case, lc and le values of the APDU (case, lc, le, data)
-    """
+def _parse_command_apdu(apdu: bytes) -> Tuple[int, int, int, bytes, bool]:
+    """Back-end of parse_command_apdu(), additionally returning whether the APDU uses the
+    extended length encoding (see also ISO/IEC 7816-3, section 12.1.3)."""
 
     if len(apdu) == 4:
         # Case #1, No command data field, no response data field
         lc = 0
         le = 0
         data = b''
-        return (1, lc, le, data)
+        return (1, lc, le, data, False)
     elif len(apdu) == 5:
         # Case #2, No command data field, response data field present
         lc = 0
@@ -562,8 +558,23 @@ def parse_command_apdu(apdu: bytes) -> int:
         if le == 0:
             le = 256
         data = b''
-        return (2, lc, le, data)
+        return (2, lc, le, data, False)
     elif len(apdu) > 5:
+        if apdu[4] == 0 and len(apdu) >= 7:
+            # extended length: Lc / Le are encoded in two bytes behind a 00 byte
+            if len(apdu) == 7:
+                # Case #2E, No command data field, response data field present
+                le = apdu[5] << 8 | apdu[6]
+                return (2, 0, le or 65536, b'', True)
+            lc = apdu[5] << 8 | apdu[6]
+            if lc and len(apdu) in [7 + lc, 7 + lc + 2]:
+                data = apdu[7:7+lc]
+                if len(apdu) == 7 + lc:
+                    # Case #3E, Command data field present, no response data field
+                    return (3, lc, 0, data, True)
+                # Case #4E, Command data field present, response data field present
+                le = apdu[7+lc] << 8 | apdu[8+lc]
+                return (4, lc, le or 65536, data, True)
         lc = apdu[4];
         if lc == 0:
             lc = 256
@@ -571,13 +582,13 @@ def parse_command_apdu(apdu: bytes) -> int:
         if len(apdu) == 5 + lc:
             # Case #3, Command data field present, no response data field
             le = 0
-            return (3, lc, le, data)
+            return (3, lc, le, data, False)
         elif len(apdu) == 5 + lc + 1:
             # Case #4, Command data field present, no response data field
             le = apdu[5 + lc]
             if le == 0:
                 le = 256
-            return (4, lc, le, data)
+            return (4, lc, le, data, False)
         else:
             raise ValueError('invalid APDU (%s), Lc=0x%02x (%d) does not match the length (%d) of the data field'
                              % (b2h(apdu), lc, lc, len(apdu[5:])))
@@ -585,6 +596,127 @@ def parse_command_apdu(apdu: bytes) -> int:
         raise ValueError('invalid APDU (%s), too short!' % b2h(apdu))
 
 
+def parse_command_apdu(apdu: bytes) -> int:
+    """Parse a given command APDU and return case (see also ISO/IEC 7816-3, Table 12 and Figure 26),
+    lc, le and the data field.  Both short and extended length APDUs are supported.
+
+    Args:
+            apdu : bytes, bytearray or memoryview that contains the command APDU
+    Returns:
+            tuple containing case, lc and le values of the APDU (case, lc, le, data)
+    """
+    return _parse_command_apdu(apdu)[:4]
+
+
+def is_extended_apdu(apdu: bytes) -> bool:
+    """Does the given command APDU use the extended length encoding of Lc / Le?"""
+    return _parse_command_apdu(apdu)[4]
+
+
+def build_command_apdu(hdr: bytes, data: bytes = b'', le: Optional[int] = None) -> bytes:
+    """Build a command APDU, using the extended length encoding (ISO/IEC 7816-3, section 12.1.3)
+    only if the command data or the expected response data don't fit into a short APDU.
+
+    Args:
+            hdr : CLA, INS, P1 and P2 of the APDU
+            data : command data (may be empty)
+            le : maximum number of response data bytes expected (1..65536), None for no Le field
+    Returns:
+            the encoded command APDU
+    """
+    if len(data) > 65535 or (le is not None and not 1 <= le <= 65536):
+        raise ValueError('Lc (%d) or Le (%s) out of range' % (len(data), le))
+    if len(data) > 255 or (le is not None and le > 256):
+        lc_field = b'\x00' + len(data).to_bytes(2, 'big') if data else b''
+        if le is None:
+            le_field = b''
+        else:
+            le_field = (b'' if data else b'\x00') + (le & 0xffff).to_bytes(2, 'big')
+    else:
+        lc_field = bytes([len(data)]) if data else b''
+        le_field = b'' if le is None else bytes([le & 0xff])
+    return bytes(hdr) + lc_field + data + le_field
+
+
+def atr_historical_bytes(atr: bytes) -> bytes:
+    """Return the historical bytes of an ATR (see also ISO/IEC 7816-3, section 8.2)."""
+    # T0: Y1 + number of historical bytes
+    y = atr[1] >> 4
+    num_hist = atr[1] & 0x0f
+    i = 2
+    while y:
+        # TAi, TBi, TCi are present depending on the bits of Yi; TDi carries Yi+1
+        i += bin(y & 0x7).count('1')
+        if y & 0x8:
+            y = atr[i] >> 4
+            i += 1
+        else:
+            y = 0
+    return atr[i:i+num_hist]
+
+
+def _card_capabilities_ext_len(card_caps: bytes) -> bool:
+    # ISO/IEC 7816-4, Table 118: third software function table, b7 = extended Lc and Le fields
+    return len(card_caps) >= 3 and bool(card_caps[2] & 0x40)
+
+
+def atr_supports_extended_length(atr: bytes) -> bool:
+    """Does the card indicate support for extended Lc and Le fields in the card capabilities
+    (compact-TLV tag 7) of the historical bytes of its ATR (ISO/IEC 7816-4, section 12.1.1.9)?"""
+    hist = atr_historical_bytes(atr)
+    if not hist:
+        return False
+    if hist[0] == 0x80:
+        objs = hist[1:]
+    elif hist[0] == 0x00:
+        # the last three bytes are a status indicator outside of the compact-TLV objects
+        objs = hist[1:-3]
+    else:
+        return False
+    i = 0
+    while i < len(objs):
+        tag = objs[i] >> 4
+        length = objs[i] & 0x0f
+        if tag == 0x7:
+            return _card_capabilities_ext_len(objs[i+1:i+1+length])
+        i += 1 + length
+    return False
+
+
+def ef_atr_extended_length(ef_atr: bytes) -> Optional[Tuple[int, int]]:
+    """Parse the content of EF.ATR/INFO for extended length support.
+
+    Returns:
+            (max. command data length, max. response data length) derived from the extended
+            length information DO '7F66' (ISO/IEC 7816-4, section 12.7.1); (65535, 65536) if only the card
+            capabilities DO '47' indicates support for extended Lc and Le fields; None otherwise.
+    """
+    ext_len = None
+    try:
+        remainder = ef_atr
+        while remainder and remainder[0] not in [0x00, 0xff]:
+            tag, remainder = bertlv_parse_tag_raw(remainder)
+            length, remainder = bertlv_parse_len(remainder)
+            value = remainder[:length]
+            remainder = remainder[length:]
+            if tag == 0x7f66:
+                # two INTEGER DOs: max. number of bytes in command / response APDU
+                values = []
+                while value:
+                    _tag, value = bertlv_parse_tag_raw(value)
+                    int_len, value = bertlv_parse_len(value)
+                    values.append(int.from_bytes(value[:int_len], 'big'))
+                    value = value[int_len:]
+                if len(values) >= 2:
+                    # strip header, Lc and Le (command) / SW (response) from the APDU sizes
+                    return values[0] - 9, values[1] - 2
+            elif tag == 0x47 and _card_capabilities_ext_len(value):
+                ext_len = (65535, 65536)
+    except IndexError:
+        pass
+    return ext_len
+
+
 class DataObject(abc.ABC):
     """A DataObject (DO) in the sense of ISO 7816-4.  Contrary to 'normal' TLVs where one
     simply has any number of different TLVs that may occur in any order at any point, ISO 7816
@@ -26,6 +26,9 @@
 
 from pySim.commands import SimCardCommands
 from pySim.utils import swap_nibbles, rpad, b2h, i2h
+from pySim.sms import concat_sms_segments, concat_sms_capacity
+from pySim.ota import OtaDialectSms
+from pySim.global_platform.load import Loader
 from FetchProactiveHandler import FetchProactiveHandler
 
 try:
@@ -34,6 +37,7 @@ except Exception as err:
 	print ("Missing argparse -- try apt-get install python-argparse")
 import zipfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 import struct
 import binascii
 
@@ -42,7 +46,9 @@ import binascii
 from Crypto.Cipher import DES3
 
 #------
-my_handler = FetchProactiveHandler()
+
+# Size of the LOAD blocks sent via OTA, which is known to work with the supported cards
+LOAD_BLOCK_LEN = 0x5e
 
 def hex_ber_length(data):
 	dataLen = len(data) // 2
@@ -56,9 +62,15 @@ def hex_ber_length(data):
 	return ('%02x' % (0x80 + (lenDataLen // 2))) + dataLen
 
 class AppLoaderCommands(object):
-	def __init__(self, transport):
+	def __init__(self, transport, opts, handler):
 		self._tp = transport
+		self._opts = opts
+		self._handler = handler
 		self._apduCounter = 0;
+		self._smsRef = 0
+		self.bytes_loaded = 0
+		# number of commands executed by the card, from the PoR of the last secured packet
+		self.porCmdCount = None
 
 	def test_rfm(self):
 
@@ -66,13 +78,13 @@ class AppLoaderCommands(object):
 
 		if (1):
 			# SIM: select MF/GSM/EF_IMSI and read content (requires keyset two)
-			if not args.smpp:
+			if not self._opts.smpp:
 				print( self.send_wrapped_apdu_rfm_sim('A0A40000023F00' + 'A0A40000027F20' + 'A0A40000026F07' + 'A0B0000009'));
 			else:
 				self.send_wrapped_apdu_rfm_sim('A0A40000023F00' + 'A0A40000027F20' + 'A0A40000026F07' + 'A0B0000009');
 		else:
 			# USIM: select MF/GSM/EF_IMSI and read content (requires keyset three)
-			if not args.smpp:
+			if not self._opts.smpp:
 				print(self.send_wrapped_apdu_rfm_usim('00A40004023F00' + '00A40004027F20' + '00A40004026F07' + '00B0000009'))
 			else:
 				self.send_wrapped_apdu_rfm_usim('00A40004023F00' + '00A40004027F20' + '00A40004026F07' + '00B0000009');
@@ -82,10 +94,9 @@ class AppLoaderCommands(object):
 	def send_terminal_profile(self):
 		rv = self._tp.send_apdu('A010000011FFFF000000000000000000000000000000')
 		if "91" == rv[1][0:2]:
-			# In case of "91xx" -> Fetch data, execute cmd and reply
-			self._tp.send_apdu('A0120000' + rv[1][2:4]) # FETCH
-			# otherwise "9300" (SIM Busy)
-			return self._tp.send_apdu('A01400000C810301030002028281030100') # TERMINAL RESPONSE
+			# In case of "91xx" -> Fetch data, execute cmd(s) and reply with TERMINAL RESPONSE
+			self._tp.proactive_session.run(rv[1])
+			return (rv[0], '9000')
 		return rv;
 
 	# Wrap an APDU inside an SMS-PP APDU
@@ -150,7 +161,7 @@ class AppLoaderCommands(object):
 			pad_cnt = 0 if (len_cipher % DES3.block_size) == 0 else int(
 				DES3.block_size - (len_cipher % DES3.block_size))  # 8 Byte blocksize for DES-CBC
 			temp_data = temp_data + '00' * pad_cnt
-			key = binascii.a2b_hex(args.kid);
+			key = binascii.a2b_hex(self._opts.kid);
 			iv = binascii.a2b_hex('0000000000000000');
 			cipher = DES3.new(key, DES3.MODE_CBC, iv);
 			ciph = cipher.encrypt(binascii.a2b_hex(temp_data));
@@ -169,7 +180,7 @@ class AppLoaderCommands(object):
 		# Ciphering (CNTR + PCNTR + RC/CC/DS + data)
 
 		if ((spi_1 & 0x04) != 0): # check ciphering bit
-			key = binascii.a2b_hex(args.kic);
+			key = binascii.a2b_hex(self._opts.kic);
 			iv = binascii.a2b_hex('0000000000000000');
 			cipher = DES3.new(key, DES3.MODE_CBC, iv);
 			ciph = cipher.encrypt(binascii.a2b_hex(envelopeData));
@@ -189,49 +200,83 @@ class AppLoaderCommands(object):
 		# two bytes CPL
 		# no CHI
 		#
-		envelopeData = '027000' + ('%04x' % (len(envelopeData) // 2)) + envelopeData;
+		# Command packets exceeding a single SMS are sent as concatenated SMS
+		# (UDH IEI 00), the CPI is only present in the first segment.
+		envelopeData = ('%04x' % (len(envelopeData) // 2)) + envelopeData;
+		if self._opts.sms_segments > 1:
+			segments = concat_sms_segments(binascii.a2b_hex(envelopeData), [OtaDialectSms.cpi_ie], self._smsRef)
+			if len(segments) > self._opts.sms_segments:
+				raise ValueError("Command packet of %d bytes exceeds %d SMS" % (len(envelopeData) // 2, self._opts.sms_segments))
+			self._smsRef = (self._smsRef + 1) & 0xff
+		else:
+			segments = [binascii.a2b_hex('027000' + envelopeData)]
 
 		# For sending via SMPP, those are the data which can be put into
 		# the "hex" field of the "sendwp" XML file (see examples in libsmpp34).
 
-		if args.smpp:
-			print ("SMPP: " + envelopeData);
+		if self._opts.smpp:
+			for segment in segments:
+				print ("SMPP: " + b2h(segment));
 			return ('00', '9000');
 
-		# SMS-TDPU header: MS-Delivery, no more messages, TP-UD header, no reply path,
-		# TP-OA = TON/NPI 55667788, TP-PID = SIM Download, BS timestamp
-		envelopeData = '400881556677887ff600112912000004' + ('%02x' % (len(envelopeData) // 2)) + envelopeData;
-
-		# (82) Device Identities: (83) Network to (81) USIM
-		# (8b) SMS-TPDU
-		envelopeData = '820283818B' + hex_ber_length(envelopeData) + envelopeData
-
-		# d1 = SMS-PP Download, d2 = Cell Broadcast Download
-		envelopeData = 'd1' + hex_ber_length(envelopeData) + envelopeData;
-		my_handler.stillMoreData = False
-		my_handler.isProcessed = False
-
-		#(response, sw) = self._tp.send_apdu_checksw('a0c20000' + ('%02x' % (len(envelopeData) // 2)) + envelopeData+'00')
-		(response, sw) = self._tp.send_apdu('a0c20000' + ('%02x' % (len(envelopeData) // 2)) + envelopeData+'00')
+		self._handler.stillMoreData = False
+		self._handler.isProcessed = False
+		self._handler.parsedCmdCount = None
+		self.porCmdCount = None
+
+		for segment in segments[:-1]:
+			(response, sw) = self.send_sms_pp_download(b2h(segment))
+			if "91" == sw[0:2]:
+				self._tp.proactive_session.run(sw)
+			elif sw != '9000':
+				raise RuntimeError("SMS-PP download of concatenated SMS segment failed with SW %s" % sw)
+		(response, sw) = self.send_sms_pp_download(b2h(segments[-1]))
 		if "9e" == sw[0:2]:  # more bytes available, get response
 			(response, sw) = self._tp.send_apdu_checksw('A0C00000' + sw[2:4])  # GET RESPONSE
 		elif "91" == sw[0:2]:
-			(response, sw) = self._tp.send_apdu_checksw('a0c20000' + ('%02x' % (len(envelopeData) // 2)) + envelopeData+'00')
+			# the PoR is delivered via proactive SEND SHORT MESSAGE command(s), which
+			# are consumed by self._handler within the proactive session
+			self._tp.proactive_session.run(sw)
+			sw = '9000'
 
-		if my_handler.isProcessed:
+		if self._handler.isProcessed:
 			print("returning processed handler")
-			return my_handler.parsedResponse,my_handler.parsedCmdSw
+			self.porCmdCount = self._handler.parsedCmdCount
+			return self._handler.parsedResponse,self._handler.parsedCmdSw
 		if (len(response) == 0):
 			return (response, sw)
 
 		response = response[(int(response[10:12], 16) * 2) + 12:]
+		self.porCmdCount = int(response[0:2], 16)
 		return (response[6:], response[2:6])
-		#return my_handler.parse_response_data(response)
+		#return self._handler.parse_response_data(response)
+
 
 
+	# Deliver the TP-UD of a single SMS via ENVELOPE (SMS-PP Download)
+	def send_sms_pp_download(self, userData):
+		# SMS-TDPU header: MS-Delivery, no more messages, TP-UD header, no reply path,
+		# TP-OA = TON/NPI 55667788, TP-PID = SIM Download, BS timestamp
+		envelopeData = '400881556677887ff600112912000004' + ('%02x' % (len(userData) // 2)) + userData;
+
+		# (82) Device Identities: (83) Network to (81) USIM
+		# (8b) SMS-TPDU
+		envelopeData = '820283818B' + hex_ber_length(envelopeData) + envelopeData
+
+		# d1 = SMS-PP Download, d2 = Cell Broadcast Download
+		envelopeData = 'd1' + hex_ber_length(envelopeData) + envelopeData;
+
+		#return self._tp.send_apdu_checksw('a0c20000' + ('%02x' % (len(envelopeData) // 2)) + envelopeData+'00')
+		return self._tp.send_apdu('a0c20000' + ('%02x' % (len(envelopeData) // 2)) + envelopeData+'00')
+
+	# Number of octets of command APDUs fitting into a single secured packet
+	def wrapped_apdu_budget(self):
+		# CPL(2) + CHL(1) + SPI(2) + KIc(1) + KID(1) + TAR(3) + CNTR(5) + PCNTR(1) +
+		# CC(8) + up to 7 bytes of padding for ciphering
+		return concat_sms_capacity(self._opts.sms_segments, [OtaDialectSms.cpi_ie]) - 31
 
 	def send_wrapped_apdu_ram(self, data):
-		if (len(args.kic) == 0) and (len(args.kid) == 0):
+		if (len(self._opts.kic) == 0) and (len(self._opts.kid) == 0):
 			#  TAR RAM: 000000, no security (JLM SIM)
 			return self.send_wrapped_apdu_internal(data, '000000', 0, 0, 0)
 		else:
@@ -264,6 +309,18 @@ class AppLoaderCommands(object):
 		apdu = '80e400' + ('80' if delete_related else '00') + ('%02x' % (len(aidDesc) // 2)) + aidDesc + '00c0000000'
 		return self.send_wrapped_apdu_checksw(apdu)
 
+	# Send LOAD commands (followed by a GET RESPONSE) in a secured packet; returns the
+	# response and SW of the last LOAD executed and the number of LOADs executed, see Loader
+	def send_wrapped_load(self, apdus):
+		(response, sw) = self.send_wrapped_apdu_ram(''.join(apdus) + '00c0000000')
+		if self.porCmdCount is None:
+			# no PoR (e.g. SMPP output): report the SW of the whole script
+			return (response, sw)
+		if self.porCmdCount > len(apdus):
+			# the script only continues with the GET RESPONSE if all LOADs succeeded
+			return (response, '9000', len(apdus))
+		return (response, sw, self.porCmdCount)
+
 	def load_aid_raw(self, aid, executable, codeSize, volatileDataSize = 0, nonvolatileDataSize = 0):
 		loadParameters = 'c602' + ('%04x' % codeSize)
 		if volatileDataSize > 0:
@@ -276,25 +333,13 @@ class AppLoaderCommands(object):
 		data = ('%02x' % (len(aid) // 2)) + aid + '0000' + ('%02x' % (len(loadParameters) // 2)) + loadParameters + '0000'
 		self.send_wrapped_apdu_checksw('80e60200' + ('%02x' % (len(data) // 2)) + data + '00c0000000')
 
-		# Load APDUs
-		loadData = 'c4' + hex_ber_length(executable) + executable
-		loadBlock = 0;
-		loadBlockSize = 0xbc
-
-		while len(loadData):
-			print("Block: %d" % loadBlock)
-			if len(loadData) > 0xd8:
-				#apdu = '80e800' + ('%02x' % loadBlock) + '6c' + loadData[:0xd8]
-				apdu = '80e800' + ('%02x' % loadBlock) + ('%02x' % int(loadBlockSize // 2)) + loadData[:loadBlockSize]
-				#loadData = loadData[0xd8:]
-				loadData = loadData[loadBlockSize:]
-
-				loadBlock = loadBlock + 1
-			else:
-				apdu = '80e880' + ('%02x' % loadBlock) + ('%02x' % (len(loadData) // 2)) + loadData
-				loadData = ''
-			self.send_wrapped_apdu_checksw(apdu + '00c0000000')
-		print("Done loading %d blocks" % loadBlock)
+		# Load APDUs: as many LOAD commands as fit are sent in each secured
+		# packet, followed by a GET RESPONSE (5 bytes)
+		loader = Loader(self.send_wrapped_load, max_block_len=LOAD_BLOCK_LEN,
+				max_round_trip_len=self.wrapped_apdu_budget() - 5, reports_executed=True)
+		stats = loader.load(binascii.a2b_hex(executable))
+		print(stats)
+		self.bytes_loaded += codeSize
 
 	def generate_load_file(self, capfile):
 		zipcap = zipfile.ZipFile(capfile)
@@ -363,7 +408,9 @@ class AppLoaderCommands(object):
 		aid = self.get_aid_from_load_file(data)
 		self.load_aid_raw(aid, data, len(data) // 2)
 
-	def install_app(self, args):
+	def install_app(self, args=None):
+		if args is None:
+			args = self._opts
 		loadfile = self.generate_load_file(args.install)
 		aid = self.get_aid_from_load_file(loadfile)
 
@@ -393,6 +440,85 @@ class AppLoaderCommands(object):
 		data = ('%02x' % (len(aid) // 2)) + aid + ('%02x' % (len(args.module_aid) // 2)) + args.module_aid + ('%02x' % (len(args.instance_aid) // 2)) + \
 			   args.instance_aid + '0100' + ('%02x' % (len(parameters) // 2)) + parameters + '00'
 		self.send_wrapped_apdu_checksw('80e60c00' + ('%02x' % (len(data) // 2)) + data + '00c0000000')
+
+def provision_card(sc, ac, opts):
+	"""Run the delete/load/install sequence selected by opts on the card behind sc/ac."""
+	if opts.pin:
+		sc.verify_chv(1, opts.pin)
+
+	if opts.delete_app:
+		ac.delete_aid(opts.delete_app)
+
+	if opts.load_app:
+		ac.load_app(opts.load_app)
+
+	if opts.install:
+		ac.install_app(opts)
+
+class ReaderStats(object):
+	"""Per-reader statistics of a batch provisioning run."""
+	def __init__(self, reader):
+		self.reader = reader
+		self.cards_ok = 0
+		self.cards_failed = 0
+		self.bytes_loaded = 0
+		self.elapsed = 0.0
+
+	def __str__(self):
+		cards = self.cards_ok + self.cards_failed
+		rate = (self.bytes_loaded / self.elapsed) if self.elapsed else 0.0
+		per_card = (self.elapsed / cards) if cards else 0.0
+		return "%s: %d ok, %d failed, %.1f s/card, %.1f bytes/s loaded" % (
+			self.reader, self.cards_ok, self.cards_failed, per_card, rate)
+
+def provision_reader(opts, reader_nr):
+	"""Provision opts.cards_per_reader cards in the given PC/SC reader. Each reader gets its
+	own link, proactive handler and AppLoaderCommands, so this can run in its own thread."""
+	from pySim.transport.pcsc import PcscSimLink
+	handler = FetchProactiveHandler()
+	link = PcscSimLink(argparse.Namespace(pcsc_dev=reader_nr, pcsc_shared=False), proactive_handler=handler)
+	scc = SimCardCommands(link)
+	alc = AppLoaderCommands(link, opts, handler)
+	stats = ReaderStats(str(link))
+
+	for card_nr in range(opts.cards_per_reader):
+		# after the first card, always wait for the next one to be inserted
+		link.wait_for_card(newcardonly=opts.new_card_required or card_nr > 0)
+		time.sleep(opts.sleep_after_insertion)
+		t_start = time.monotonic()
+		try:
+			print ("[%s] ICCID: %s" % (link, swap_nibbles(scc.read_binary(['3f00', '2fe2'])[0])))
+			alc.send_terminal_profile()
+			provision_card(scc, alc, opts)
+			stats.cards_ok += 1
+		except Exception as err:
+			print ("[%s] provisioning failed: %s" % (link, err))
+			stats.cards_failed += 1
+		stats.elapsed += time.monotonic() - t_start
+	stats.bytes_loaded = alc.bytes_loaded
+	return stats
+
+def provision_all_readers(opts):
+	"""Provision cards in all PC/SC readers matching opts.pcsc_regex concurrently."""
+	from pySim.transport.pcsc import PcscSimLink
+	reader_nrs = PcscSimLink.match_readers(opts.pcsc_regex)
+	if not reader_nrs:
+		raise RuntimeError("No PC/SC reader matches regex %s" % opts.pcsc_regex)
+	print ("Provisioning via %d readers" % len(reader_nrs))
+
+	t_start = time.monotonic()
+	with ThreadPoolExecutor(max_workers=opts.parallel or len(reader_nrs)) as executor:
+		all_stats = list(executor.map(lambda nr: provision_reader(opts, nr), reader_nrs))
+	elapsed = time.monotonic() - t_start
+
+	for stats in all_stats:
+		print (stats)
+	cards_ok = sum([x.cards_ok for x in all_stats])
+	cards_failed = sum([x.cards_failed for x in all_stats])
+	print ("Total: %d ok, %d failed in %.1f s (%.1f cards/min)" % (cards_ok, cards_failed, elapsed,
+		(cards_ok * 60 / elapsed) if elapsed else 0.0))
+	return all_stats
+
 #------
 
 parser = argparse.ArgumentParser(description='Tool for Toorcamp SIMs.')
@@ -425,9 +551,20 @@ parser.add_argument('--set-phonebook-entry', nargs=4)
 parser.add_argument('--kic', default='')
 parser.add_argument('--kid', default='')
 parser.add_argument('--smpp', action='store_true')
+parser.add_argument('--sms-segments', type=int, default=1, help='Maximum number of concatenated SMS per secured OTA packet (default: 1)')
+parser.add_argument('--proactive-stats', action='store_true', help='Print statistics of the proactive commands handled (not with --smpp)')
+parser.add_argument('--pcsc-regex', help='Provision cards in all PC/SC readers matching this regex concurrently')
+parser.add_argument('--parallel', type=int, default=0, help='Maximum number of readers driven concurrently (default: all)')
+parser.add_argument('--cards-per-reader', type=int, default=1, help='Number of cards to provision per reader')
 
 args = parser.parse_args()
 
+if args.pcsc_regex is not None:
+	provision_all_readers(args)
+	exit(0)
+
+my_handler = FetchProactiveHandler()
+
 if args.pcsc is not None:
 	from pySim.transport.pcsc import PcscSimLink
 	args.pcsc_dev = args.pcsc
@@ -445,7 +582,7 @@ else:
 	raise RuntimeError("Need to specify either --serialport, --pcsc or --smpp")
 
 sc = SimCardCommands(sl)
-ac = AppLoaderCommands(sl)
+ac = AppLoaderCommands(sl, args, my_handler)
 
 if not args.smpp:
 	sl.wait_for_card(newcardonly=args.new_card_required)
@@ -460,17 +597,7 @@ if not args.smpp:
 #ac.test_rfm()
 #exit(0)
 
-if args.pin:
-	sc.verify_chv(1, args.pin)
-
-if args.delete_app:
-	ac.delete_aid(args.delete_app)
-
-if args.load_app:
-	ac.load_app(args.load_app)
-
-if args.install:
-	ac.install_app(args)
+provision_card(sc, ac, args)
 
 if args.print_info:
 	print ("--print-info not implemented yet.")
@@ -481,8 +608,8 @@ if args.disable_pin:
 if args.dump_phonebook:
 	num_records = sc.record_count(['3f00','7f10','6f3a'])
 	print ("Phonebook: %d records available" % num_records)
-	for record_id in range(1, num_records + 1):
-		print (sc.read_record(['3f00','7f10','6f3a'], record_id))
+	for record_id, record in sc.read_records(['3f00','7f10','6f3a'], range(1, num_records + 1)):
+		print (record)
 
 if args.set_phonebook_entry:
 	num_records = sc.record_count(['3f00','7f10','6f3a'])
@@ -519,3 +646,7 @@ if args.list_applets:
 			print ("\tInstance AID: " + aid)
 			data = data[aidlen + 2:]
 			num_instances = num_instances - 1
+
+if args.proactive_stats and not args.smpp:
+	print ("Proactive command statistics:")
+	print (sl.proactive_session.stats_str())